@@ -0,0 +1,124 @@
+import os
+import json
+import math
+from outbox import send_message_sync
+
+STATE_FILE_PATH = "/opt/marzbackup/usage_stats.json"
+NEVER_FLAGGED = -1000000000
+
+DEFAULT_SETTINGS = {
+    "anomaly_alpha": 0.1,             # EWMA weight of the newest period
+    "anomaly_warmup_periods": 12,     # periods seen before a user can be flagged
+    "anomaly_spike_sigma": 4.0,       # spike when usage > mean + sigma * stddev ...
+    "anomaly_spike_ratio": 3.0,       # ... and usage > ratio * mean ...
+    "anomaly_min_spike_mb": 500,      # ... and usage is larger than this
+    "anomaly_quota_hours": 24,        # flag when the quota runs out sooner than this
+    "anomaly_cooldown_periods": 6,    # periods before the same user is flagged again
+}
+
+def format_bytes(value):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(value) < 1024:
+            return f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} TB"
+
+def parse_table(output):
+    # Parse the tab separated output of the mariadb client into a list of dicts
+    lines = [line for line in output.strip().split('\n') if line]
+    if len(lines) < 2:
+        return []
+    header = lines[0].split('\t')
+    return [dict(zip(header, line.split('\t'))) for line in lines[1:]]
+
+class UsageAnomalyDetector:
+    # Keeps an EWMA of the mean and variance of every user's per-period usage.
+    # State is O(users): {user_id: [periods_seen, mean, variance, last_flagged_report]}
+    def __init__(self, config, state_file=STATE_FILE_PATH):
+        self.settings = {key: config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+        self.report_interval = config.get('report_interval', 60)
+        self.state_file = state_file
+        self.users = {}
+        self.last_report = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as file:
+                state = json.load(file)
+            self.users = state.get('users', {})
+            self.last_report = state.get('last_report', 0)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading usage statistics, starting fresh: {e}")
+
+    def save(self):
+        temp_path = f"{self.state_file}.tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'users': self.users, 'last_report': self.last_report}, file)
+        os.replace(temp_path, self.state_file)
+
+    def _can_flag(self, stats, report_number):
+        return report_number - stats[3] >= self.settings['anomaly_cooldown_periods']
+
+    def process_period(self, rows, limits=None):
+        # Feed one period of calculate_usage() rows; returns alert lines for this period.
+        # `limits` maps user_id to (used_traffic, data_limit) for users with a quota.
+        alerts = []
+        if not rows:
+            return alerts
+        report_number = int(rows[0]['report_number'])
+        if report_number <= self.last_report:
+            return alerts  # Already seen, e.g. the tracker ran twice in the same window
+        alpha = self.settings['anomaly_alpha']
+        limits = limits or {}
+
+        for row in rows:
+            user_id = row['user_id']
+            usage = int(row['usage_in_period'])
+            # The first report has no baseline and negative usage means the user was reset
+            if report_number == 1 or usage < 0:
+                continue
+            stats = self.users.setdefault(user_id, [0, 0.0, 0.0, NEVER_FLAGGED])
+            seen, mean, variance = stats[0], stats[1], stats[2]
+
+            if seen >= self.settings['anomaly_warmup_periods'] and self._can_flag(stats, report_number):
+                threshold = mean + self.settings['anomaly_spike_sigma'] * math.sqrt(variance)
+                if (usage > threshold and usage > self.settings['anomaly_spike_ratio'] * mean
+                        and usage > self.settings['anomaly_min_spike_mb'] * 1024 * 1024):
+                    alerts.append(f"⚠️ {row['username']}: {format_bytes(usage)} in the last period "
+                                  f"(usual {format_bytes(mean)})")
+                    stats[3] = report_number
+
+            diff = usage - mean
+            increment = alpha * diff
+            stats[0] = seen + 1
+            stats[1] = mean + increment if seen else float(usage)
+            stats[2] = (1 - alpha) * (variance + diff * increment) if seen else 0.0
+
+            if user_id in limits and stats[0] >= self.settings['anomaly_warmup_periods'] and self._can_flag(stats, report_number):
+                used_traffic, data_limit = limits[user_id]
+                remaining = data_limit - used_traffic
+                if remaining > 0 and stats[1] > 0:
+                    hours_left = remaining / stats[1] * self.report_interval / 60
+                    if hours_left < self.settings['anomaly_quota_hours']:
+                        alerts.append(f"⏳ {row['username']}: quota runs out in about {hours_left:.1f} h "
+                                      f"({format_bytes(remaining)} left)")
+                        stats[3] = report_number
+
+        self.last_report = report_number
+        return alerts
+
+def send_admin_alert(config, alerts, max_lines=40):
+    # Send all alerts of one period as a single message to the admin chat
+    if not alerts:
+        return
+    lines = alerts[:max_lines]
+    if len(alerts) > max_lines:
+        lines.append(f"... and {len(alerts) - max_lines} more")
+    text = "Usage anomalies detected:\n" + "\n".join(lines)
+    try:
+        send_message_sync(config, text)
+    except Exception as e:
+        print(f"Error sending anomaly alert: {e}")
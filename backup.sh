@@ -1,7 +1,9 @@
 #!/bin/bash
 
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
 # Read configuration from JSON file
-CONFIG_FILE="/opt/marzbackup/config.json"
+CONFIG_FILE="${MARZBACKUP_CONFIG:-/opt/marzbackup/config.json}"
 
 if [ ! -f "$CONFIG_FILE" ]; then
     echo "Configuration file not found: $CONFIG_FILE"
@@ -14,6 +16,52 @@ get_json_value() {
     jq -r ".$key" "$CONFIG_FILE"
 }
 
+# Function to read JSON values with a fallback when the key is missing or null
+get_json_value_or_default() {
+    key=$1
+    default=$2
+    jq -r --arg key "$key" --arg default "$default" 'if .[$key] == null then $default else .[$key] end' "$CONFIG_FILE"
+}
+
+# Backup tier to run: "critical" (panel data, frequent) by default, e.g. "analytics" for the usage history
+TIER="critical"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        --tier)
+            TIER=$2
+            shift 2
+            ;;
+        --list-tiers)
+            LIST_TIERS=1
+            shift
+            ;;
+        *)
+            echo "Usage: backup.sh [--tier <name>] [--list-tiers]"
+            exit 1
+            ;;
+    esac
+done
+
+# Built-in tiers, used when backup_tiers is not set in the config file. The bulk usage
+# history is kept out of the frequent panel backup and gets its own daily incremental one.
+DEFAULT_TIERS='{
+    "critical": {
+        "exclude_tables": {"UserUsageAnalytics": ["UsageSnapshots", "PeriodicUsage", "PeriodicTraffic"]},
+        "include_files": true,
+        "compression": "zip:6",
+        "destination": "telegram"
+    },
+    "analytics": {
+        "interval_minutes": 1440,
+        "databases": ["UserUsageAnalytics"],
+        "incremental_tables": {"UserUsageAnalytics": {"UsageSnapshots": "timestamp", "PeriodicUsage": "timestamp", "PeriodicTraffic": "timestamp"}},
+        "full_every_days": 7,
+        "include_files": false,
+        "compression": "zip:9",
+        "destination": "telegram"
+    }
+}'
+
 # Read values from config file
 TOKEN=$(get_json_value "API_TOKEN")
 CHAT_ID=$(get_json_value "ADMIN_CHAT_ID")
@@ -22,21 +70,592 @@ DB_PASSWORD=$(get_json_value "db_password")
 DB_NAME=$(get_json_value "db_name")
 DB_TYPE=$(get_json_value "db_type")
 
+# Print "<tier> <interval_minutes>" for every tier; the critical tier follows backup_interval_minutes
+if [ "$LIST_TIERS" = "1" ]; then
+    jq -r --argjson defaults "$DEFAULT_TIERS" '
+        .backup_interval_minutes as $interval
+        | (.backup_tiers // $defaults) | to_entries[]
+        | "\(.key) \(.value.interval_minutes // (if .key == "critical" then $interval else null end) // "")"' "$CONFIG_FILE"
+    exit 0
+fi
+
+# Policy of the selected tier
+TIER_JSON=$(jq -c --arg tier "$TIER" --argjson defaults "$DEFAULT_TIERS" '(.backup_tiers // $defaults)[$tier] // empty' "$CONFIG_FILE")
+if [ -z "$TIER_JSON" ]; then
+    echo "Unknown backup tier: $TIER"
+    exit 1
+fi
+
+# Function to read a value from the tier policy
+get_tier_value() {
+    echo "$TIER_JSON" | jq -r --arg key "$1" --arg default "$2" 'if .[$key] == null then $default else .[$key] end'
+}
+
+TIER_COMPRESSION=$(get_tier_value "compression" "zip:6")
+# "destination" is one name or a list of names: "telegram", "local" or a key of backup_destinations
+TIER_DESTINATIONS=$(echo "$TIER_JSON" | jq -r '(.destination // "telegram") | if type == "array" then .[] else . end' | tr '\n' ' ')
+TIER_INCLUDE_FILES=$(get_tier_value "include_files" "true")
+TIER_FULL_EVERY_DAYS=$(get_tier_value "full_every_days" "7")
+
 # Other variables
 USER="root"
-BACKUP_DIR="/root/db-backup"
-TEMP_DIR="/tmp/marzban_backup"
+BACKUP_DIR="${MARZBACKUP_BACKUP_DIR:-/root/db-backup}"
+TEMP_DIR="/tmp/marzban_backup_$TIER"
+STATE_FILE="$(dirname "$CONFIG_FILE")/backup_state.json"
+NEW_STATE_FILE="/tmp/marzbackup_state.$$"
 DB_BACKUP_DIR="$TEMP_DIR/var/lib/$DB_NAME/mysql/db-backup"
 
+# Resource governor settings (governed mode keeps the panel responsive during backups)
+GOVERNED=$(get_json_value_or_default "backup_governed" "false")
+GOV_NICE=$(get_json_value_or_default "backup_nice" "10")
+GOV_IONICE_CLASS=$(get_json_value_or_default "backup_ionice_class" "3")
+GOV_IONICE_LEVEL=$(get_json_value_or_default "backup_ionice_level" "7")
+GOV_MAX_RATE_KB=$(get_json_value_or_default "backup_dump_rate_kb" "20480")
+GOV_MIN_RATE_KB=$(get_json_value_or_default "backup_min_rate_kb" "512")
+GOV_UPLOAD_RATE_KB=$(get_json_value_or_default "backup_upload_rate_kb" "0")
+GOV_MAX_LOAD=$(get_json_value_or_default "backup_max_load" "$(nproc)")
+GOV_MAX_DB_THREADS=$(get_json_value_or_default "backup_max_db_threads" "8")
+GOV_INTERVAL=$(get_json_value_or_default "backup_governor_interval" "5")
+GOV_MAX_PAUSE=$(get_json_value_or_default "backup_max_pause" "300")
+GOV_STATE_DIR="/tmp/marzbackup_governor.$$"
+
+# Backup engine: "logical" (SQL dumps) or "physical" (hot copy of the InnoDB data files)
+BACKUP_ENGINE=$(get_json_value_or_default "backup_engine" "logical")
+PHYSICAL_IMAGE=$(get_json_value_or_default "physical_backup_image" "")
+
+# Verification: row counts and table checksums at dump time, optional trial restore into a throwaway container
+VERIFY_CHECKSUMS=$(get_json_value_or_default "backup_verify_checksums" "true")
+VERIFY_RESTORE=$(get_json_value_or_default "backup_verify_restore" "false")
+VERIFY_PARALLEL=$(get_json_value_or_default "backup_verify_parallel" "2")
+VERIFY_CPUS=$(get_json_value_or_default "backup_verify_cpus" "1")
+# Columns the panel keeps updating while it runs ("*" for whole tables). They are left out of the
+# checksums so that a table whose only changes are traffic counters can still be compared.
+DEFAULT_VERIFY_VOLATILE='{
+    "users": ["used_traffic", "lifetime_used_traffic", "online_at", "sub_updated_at", "sub_last_user_agent", "status", "last_status_change"],
+    "system": ["uplink", "downlink"],
+    "nodes": ["uplink", "downlink", "status", "last_status_change", "message", "xray_version", "node_version"],
+    "node_usages": "*",
+    "node_user_usages": "*",
+    "notification_reminders": "*"
+}'
+VERIFY_VOLATILE=$(jq -c --argjson defaults "$DEFAULT_VERIFY_VOLATILE" '.backup_verify_volatile // $defaults' "$CONFIG_FILE")
+VERIFY_DIR="/tmp/marzbackup_verify.$$"
+
+# Encryption: the archive is encrypted with chunked AES-256-GCM while it is written (crypto_stream.py)
+ENCRYPTION=$(get_json_value_or_default "backup_encryption" "false")
+ENCRYPTION_KEY_FILE=$(get_json_value_or_default "backup_encryption_key_file" "/opt/marzbackup/backup.key")
+ENCRYPTION_PASSPHRASE=$(get_json_value_or_default "backup_encryption_passphrase" "")
+ENCRYPT_STATS="/tmp/marzbackup_encrypt.$$"
+
+# Destinations other than the admin chat and the local copy are fed from the archive stream
+# while it is written (destinations.py), so the archive is produced once for all of them
+FANOUT=0
+for destination in $TIER_DESTINATIONS; do
+    case "$destination" in
+        telegram|local) ;;
+        *) FANOUT=1 ;;
+    esac
+done
+# MARZBACKUP_SKIP_UPLOAD=1 keeps the archive local (used by the benchmark)
+if [ "${MARZBACKUP_SKIP_UPLOAD:-0}" = "1" ]; then
+    FANOUT=0
+fi
+FANOUT_STATUS="/tmp/marzbackup_fanout_status.$$"
+FANOUT_REPORT="/tmp/marzbackup_fanout_report.$$"
+
+# Refuse to run rather than upload an unencrypted archive when encryption is on but has no key
+if [ "$ENCRYPTION" = "true" ] && [ -z "$ENCRYPTION_PASSPHRASE" ] && [ ! -r "$ENCRYPTION_KEY_FILE" ]; then
+    echo "Encryption key file $ENCRYPTION_KEY_FILE not found; create one with: python3 $SCRIPT_DIR/crypto_stream.py keygen" >&2
+    exit 1
+fi
+
 # Get the server's IP address
 SERVER_IP=$(hostname -I | awk '{print $1}')
 
+# Only one run of a tier at a time; different tiers use separate work directories
+exec 9>"/tmp/marzbackup_$TIER.lock"
+if ! flock -n 9; then
+    echo "A $TIER backup is already running" >&2
+    exit 1
+fi
+rm -rf "$TEMP_DIR"
+
 # Create backup directory if it doesn't exist
 mkdir -p "$BACKUP_DIR"
 mkdir -p "$DB_BACKUP_DIR"
+mkdir -p "$VERIFY_DIR"
+touch "$VERIFY_DIR/checksums.tsv"
+
+# Stage timings are appended as "<stage> <seconds>" lines when MARZBACKUP_STAGE_LOG is set
+STAGE_LOG="${MARZBACKUP_STAGE_LOG:-}"
+
+# Function to mark the start of a backup stage
+stage_begin() {
+    STAGE_NAME=$1
+    STAGE_START=$(date +%s.%N)
+}
+
+# Function to record the duration of the current backup stage
+stage_end() {
+    if [ -n "$STAGE_LOG" ]; then
+        echo "$STAGE_NAME $(echo "$(date +%s.%N) $STAGE_START" | awk '{printf "%.3f", $1 - $2}')" >> "$STAGE_LOG"
+    fi
+}
+
+# Function to run a command with the backup CPU and IO priority
+governed() {
+    if [ "$GOVERNED" != "true" ]; then
+        "$@"
+        return
+    fi
+    if [ "$GOV_IONICE_CLASS" = "2" ]; then
+        ionice -c 2 -n "$GOV_IONICE_LEVEL" nice -n "$GOV_NICE" "$@"
+    else
+        ionice -c "$GOV_IONICE_CLASS" nice -n "$GOV_NICE" "$@"
+    fi
+}
+
+# Function to build the priority prefix used for commands run inside the DB container
+container_priority_prefix() {
+    if [ "$GOVERNED" != "true" ]; then
+        return
+    fi
+    if docker exec $CONTAINER_NAME sh -c "command -v ionice" >/dev/null 2>&1; then
+        if [ "$GOV_IONICE_CLASS" = "2" ]; then
+            echo "ionice -c 2 -n $GOV_IONICE_LEVEL nice -n $GOV_NICE"
+        else
+            echo "ionice -c $GOV_IONICE_CLASS nice -n $GOV_NICE"
+        fi
+    else
+        echo "nice -n $GOV_NICE"
+    fi
+}
+
+# Function to get the number of running DB threads
+db_threads_running() {
+    docker exec $CONTAINER_NAME $DB_TYPE -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD -N -B -e "SHOW GLOBAL STATUS LIKE 'Threads_running';" 2>/dev/null | awk '{print $2}'
+}
+
+# Function to check host and DB pressure: prints "busy", "idle" or "normal"
+host_pressure() {
+    load=$(cut -d' ' -f1 /proc/loadavg)
+    threads=$(db_threads_running)
+    threads=${threads:-0}
+    awk -v load="$load" -v max_load="$GOV_MAX_LOAD" -v threads="$threads" -v max_threads="$GOV_MAX_DB_THREADS" 'BEGIN {
+        if (load > max_load || threads > max_threads) print "busy";
+        else if (load < max_load / 2 && threads <= max_threads / 2) print "idle";
+        else print "normal";
+    }'
+}
+
+# Function to adapt the dump rate to host load; runs in the background while governed
+governor_loop() {
+    rate=$GOV_MAX_RATE_KB
+    while [ -f "$GOV_STATE_DIR/running" ]; do
+        pressure=$(host_pressure)
+        if [ "$pressure" = "busy" ]; then
+            rate=$(( rate / 2 ))
+            [ "$rate" -lt "$GOV_MIN_RATE_KB" ] && rate=$GOV_MIN_RATE_KB
+        elif [ "$pressure" = "idle" ]; then
+            rate=$(( rate * 2 ))
+            [ "$rate" -gt "$GOV_MAX_RATE_KB" ] && rate=$GOV_MAX_RATE_KB
+        fi
+        echo "$rate" > "$GOV_STATE_DIR/rate"
+        echo "$rate" >> "$GOV_STATE_DIR/samples"
+        # Retune the dump pipe that is currently running, if any
+        if [ -f "$GOV_STATE_DIR/pv.pid" ]; then
+            pv -R "$(cat "$GOV_STATE_DIR/pv.pid")" -L "${rate}k" >/dev/null 2>&1
+        fi
+        sleep "$GOV_INTERVAL"
+    done
+}
+
+# Function to start the resource governor
+start_governor() {
+    if [ "$GOVERNED" != "true" ]; then
+        return
+    fi
+    mkdir -p "$GOV_STATE_DIR"
+    touch "$GOV_STATE_DIR/running"
+    echo "$GOV_MAX_RATE_KB" > "$GOV_STATE_DIR/rate"
+    echo 0 > "$GOV_STATE_DIR/paused"
+    if ! command -v pv >/dev/null 2>&1; then
+        echo "pv is not installed; dump bandwidth will not be capped" >&2
+    fi
+    governor_loop &
+    GOV_PID=$!
+}
+
+# Function to stop the resource governor
+stop_governor() {
+    if [ "$GOVERNED" != "true" ]; then
+        return
+    fi
+    rm -f "$GOV_STATE_DIR/running"
+    kill $GOV_PID 2>/dev/null
+    wait $GOV_PID 2>/dev/null
+}
+
+# Function to wait, within a limit, until the host is no longer busy
+governor_wait_idle() {
+    if [ "$GOVERNED" != "true" ]; then
+        return
+    fi
+    waited=0
+    while [ "$waited" -lt "$GOV_MAX_PAUSE" ] && [ "$(host_pressure)" = "busy" ]; do
+        sleep "$GOV_INTERVAL"
+        waited=$(( waited + GOV_INTERVAL ))
+    done
+    echo $(( $(cat "$GOV_STATE_DIR/paused") + waited )) > "$GOV_STATE_DIR/paused"
+}
+
+# Function to get the current dump rate in KB/s
+governor_rate() {
+    cat "$GOV_STATE_DIR/rate" 2>/dev/null || echo "$GOV_MAX_RATE_KB"
+}
+
+# Function to summarize how much throttling was applied
+governor_report() {
+    if [ "$GOVERNED" != "true" ]; then
+        return
+    fi
+    paused=$(cat "$GOV_STATE_DIR/paused" 2>/dev/null || echo 0)
+    if [ -s "$GOV_STATE_DIR/samples" ]; then
+        awk -v max="$GOV_MAX_RATE_KB" -v paused="$paused" '
+            { n++; sum += $1; if (min == "" || $1 < min) min = $1; if ($1 < max) reduced++ }
+            END { printf "Throttle: reduced %d%% of the time, min %d KB/s, avg %d KB/s, paused %ds", reduced * 100 / n, min, sum / n, paused }
+        ' "$GOV_STATE_DIR/samples"
+    else
+        echo "Throttle: none, paused ${paused}s"
+    fi
+}
+
+# Function to check whether the tier policy includes a database
+tier_includes_database() {
+    echo "$TIER_JSON" | jq -e --arg db "$1" '
+        (if .databases then (.databases | index($db)) != null else true end)
+        and ((.exclude_databases // []) | index($db)) == null' >/dev/null
+}
+
+# Function to list "table column" pairs the tier backs up incrementally for a database
+tier_incremental_tables() {
+    echo "$TIER_JSON" | jq -r --arg db "$1" '(.incremental_tables[$db] // {}) | to_entries[] | "\(.key) \(.value)"'
+}
+
+# Function to list tables the tier leaves out ("exclude_table_data" is the older name of the setting)
+tier_excluded_tables() {
+    echo "$TIER_JSON" | jq -r --arg db "$1" '(.exclude_tables[$db] // .exclude_table_data[$db] // [])[]'
+}
+
+# Function to build dump options that leave the given tables out entirely. Their schema is left
+# out too: a DROP/CREATE for them would wipe the live tables whenever the dump is restored.
+ignore_table_options() {
+    db=$1
+    shift
+    for table in "$@"; do
+        echo -n " --ignore-table=$db.$table"
+    done
+}
+
+# Function to read a value from the backup state file
+get_state_value() {
+    jq -r --arg key "$1" '.[$key] // empty' "$STATE_FILE" 2>/dev/null
+}
+
+# Function to stage a state update; it is saved only once the backup has been delivered
+set_state_value() {
+    echo "$1 $2" >> "$NEW_STATE_FILE"
+}
+
+# Function to save the staged state updates
+commit_state() {
+    if [ ! -s "$NEW_STATE_FILE" ]; then
+        return
+    fi
+    [ -f "$STATE_FILE" ] || echo '{}' > "$STATE_FILE"
+    while read -r key value; do
+        jq --arg key "$key" --arg value "$value" '.[$key] = $value' "$STATE_FILE" > "$STATE_FILE.tmp" && mv "$STATE_FILE.tmp" "$STATE_FILE"
+    done < "$NEW_STATE_FILE"
+}
+
+# Function to check whether the tier is due for a full backup instead of an incremental one
+full_backup_due() {
+    last_full=$(get_state_value "$TIER.last_full")
+    if [ -z "$last_full" ]; then
+        return 0
+    fi
+    [ $(( $(date +%s) - last_full )) -ge $(( TIER_FULL_EVERY_DAYS * 86400 )) ]
+}
+
+# Function to dump only the rows of the incremental tables added since the last backup
+dump_database_incremental() {
+    db=$1
+    # Small tables are always dumped in full. The history tables are left out entirely so
+    # that loading an incremental archive on top of a full one never drops them.
+    for table in $(tier_incremental_tables "$db" | awk '{print $1}'); do
+        DUMP_EXTRA_OPTS="$DUMP_EXTRA_OPTS --ignore-table=$db.$table"
+    done
+    dump_database "$db" || return 1
+
+    while read -r table column; do
+        [ -z "$table" ] && continue
+        since=$(get_state_value "$TIER.$db.$table")
+        until=$(docker exec $CONTAINER_NAME $DB_TYPE -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD -N -B -e \
+            "SELECT MAX(\`$column\`) FROM \`$db\`.\`$table\`;" 2>/dev/null)
+        if [ -z "$until" ] || [ "$until" = "NULL" ]; then
+            continue
+        fi
+        out="$DB_BACKUP_DIR/$db.$table.incremental.sql"
+        {
+            echo "USE \`$db\`;"
+            docker exec $CONTAINER_NAME $(container_priority_prefix) $DUMP_CMD -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD \
+                --no-create-info --insert-ignore --skip-add-locks --single-transaction \
+                --where="\`$column\` > '$since' AND \`$column\` <= '$until'" $db $table 2>/dev/null
+        } > "$out" || return 1
+        set_state_value "$TIER.$db.$table" "$until"
+    done <<< "$(tier_incremental_tables "$db")"
+}
+
+# Function to record the incremental watermarks reached by a full dump
+record_full_watermarks() {
+    db=$1
+    while read -r table column; do
+        [ -z "$table" ] && continue
+        until=$(docker exec $CONTAINER_NAME $DB_TYPE -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD -N -B -e \
+            "SELECT MAX(\`$column\`) FROM \`$db\`.\`$table\`;" 2>/dev/null)
+        if [ -n "$until" ] && [ "$until" != "NULL" ]; then
+            set_state_value "$TIER.$db.$table" "$until"
+        fi
+    done <<< "$(tier_incremental_tables "$db")"
+}
+
+# Function to dump one database, capping the read bandwidth when governed.
+# Both paths take the same transactional dump; the governor only changes its rate and priority.
+dump_database() {
+    db=$1
+    out="$DB_BACKUP_DIR/$db.sql"
+    prefix=$(container_priority_prefix)
+    dump="$DUMP_CMD -h 127.0.0.1 --force --opt --single-transaction --user=$USER --password=$DB_PASSWORD $DUMP_EXTRA_OPTS --databases $db"
+    if [ "$GOVERNED" = "true" ] && command -v pv >/dev/null 2>&1; then
+        governor_wait_idle
+        status_file="$GOV_STATE_DIR/$db.status"
+        { docker exec $CONTAINER_NAME $prefix $dump 2>/dev/null; echo $? > "$status_file"; } | pv -q -L "$(governor_rate)k" > "$out" &
+        echo $! > "$GOV_STATE_DIR/pv.pid"
+        wait $!
+        rm -f "$GOV_STATE_DIR/pv.pid"
+        [ "$(cat "$status_file" 2>/dev/null)" = "0" ]
+    else
+        docker exec $CONTAINER_NAME $prefix $dump > "$out" 2>/dev/null
+    fi
+}
+
+# Function to pick the physical backup tool and its stream extractor for DB_TYPE
+physical_backup_tool() {
+    if [ "$DB_TYPE" = "mariadb" ]; then
+        for tool in mariadb-backup mariabackup; do
+            if docker exec $CONTAINER_NAME sh -c "command -v $tool" >/dev/null 2>&1; then
+                echo "$tool"
+                return
+            fi
+        done
+        echo "mariabackup"
+    elif [ "$DB_TYPE" = "mysql" ]; then
+        echo "xtrabackup"
+    else
+        echo "Unsupported database type: $DB_TYPE" >&2
+        exit 1
+    fi
+}
+
+# Function to get the image used when the backup tool must run beside the DB container
+physical_sidecar_image() {
+    if [ -n "$PHYSICAL_IMAGE" ]; then
+        echo "$PHYSICAL_IMAGE"
+    elif [ "$DB_TYPE" = "mariadb" ]; then
+        # Official MariaDB images ship mariabackup matching the server version
+        docker inspect -f '{{.Config.Image}}' $CONTAINER_NAME
+    else
+        echo "percona/percona-xtrabackup:8.0"
+    fi
+}
+
+# Function to run the physical backup tool inside the DB container, or in a sidecar sharing its volumes and network
+run_physical_tool() {
+    tool=$1
+    shift
+    prefix=$(container_priority_prefix)
+    if docker exec $CONTAINER_NAME sh -c "command -v $tool" >/dev/null 2>&1; then
+        docker exec $CONTAINER_NAME $prefix $tool "$@"
+    else
+        docker run --rm --volumes-from $CONTAINER_NAME --network container:$CONTAINER_NAME \
+            "$(physical_sidecar_image)" $prefix $tool "$@"
+    fi
+}
+
+# Function to take a non-blocking physical copy of all databases as an xbstream
+backup_database_physical() {
+    tool=$(physical_backup_tool)
+    out="$DB_BACKUP_DIR/physical.xbstream"
+    set -- --backup --stream=xbstream --target-dir=/tmp --host=127.0.0.1 --user=$USER --password=$DB_PASSWORD
+    if [ "$GOVERNED" = "true" ] && command -v pv >/dev/null 2>&1; then
+        governor_wait_idle
+        status_file="$GOV_STATE_DIR/physical.status"
+        { run_physical_tool "$tool" "$@" 2>/dev/null; echo $? > "$status_file"; } | pv -q -L "$(governor_rate)k" > "$out" &
+        echo $! > "$GOV_STATE_DIR/pv.pid"
+        wait $!
+        rm -f "$GOV_STATE_DIR/pv.pid"
+        status=$(cat "$status_file" 2>/dev/null)
+    else
+        run_physical_tool "$tool" "$@" > "$out" 2>/dev/null
+        status=$?
+    fi
+    if [ "$status" != "0" ]; then
+        echo "Error taking physical backup with $tool" >&2
+        rm -f "$out"
+        exit 1
+    fi
+
+    # Record what the restore side needs to prepare and copy back the data files
+    server_version=$(docker exec $CONTAINER_NAME $DB_TYPE -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD -N -B -e "SELECT VERSION();" 2>/dev/null)
+    jq -n --arg engine "physical" --arg db_type "$DB_TYPE" --arg tool "$tool" \
+        --arg image "$(physical_sidecar_image)" --arg version "$server_version" \
+        '{engine: $engine, db_type: $db_type, tool: $tool, image: $image, server_version: $version}' \
+        > "$DB_BACKUP_DIR/physical.json"
+}
+
+# Function to print "db.table<TAB>rows<TAB>checksum" for every base table of a database
+table_stats() {
+    container=$1
+    password=$2
+    db=$3
+    # "<table> <column> <column> ..." for every base table
+    columns=$(docker exec $container $DB_TYPE -h 127.0.0.1 --user=$USER --password=$password -N -B -e \
+        "SET SESSION group_concat_max_len = 1000000;
+         SELECT c.table_name, GROUP_CONCAT(c.column_name ORDER BY c.ordinal_position SEPARATOR ' ')
+         FROM information_schema.columns c JOIN information_schema.tables t
+           ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+         WHERE c.table_schema='$db' AND t.table_type='BASE TABLE' GROUP BY c.table_name;" 2>/dev/null)
+    if [ -z "$columns" ]; then
+        return
+    fi
+    # Row count and an order-independent checksum of the stable columns, all in one snapshot
+    stats_sql="START TRANSACTION WITH CONSISTENT SNAPSHOT;"
+    while read -r table table_columns; do
+        volatile=" $(echo "$VERIFY_VOLATILE" | jq -r --arg table "$table" '.[$table] // [] | if type == "array" then join(" ") else . end') "
+        if [ "$volatile" = " * " ]; then
+            continue
+        fi
+        fields=""
+        for column in $table_columns; do
+            case "$volatile" in
+                *" $column "*) continue ;;
+            esac
+            fields="$fields${fields:+, }IFNULL(\`$column\`, 0x00)"
+        done
+        stats_sql="$stats_sql SELECT '$db.$table', COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS(0x1f, ${fields:-''}))), 0) FROM \`$db\`.\`$table\`;"
+    done <<< "$columns"
+    stats_sql="$stats_sql COMMIT;"
+    docker exec $container $DB_TYPE -h 127.0.0.1 --user=$USER --password=$password -N -B -e "$stats_sql" 2>/dev/null
+}
+
+# Function to restore the dumps into a throwaway container and compare its checksums with the recorded ones
+verify_trial_restore() {
+    image=$(docker inspect -f '{{.Config.Image}}' $CONTAINER_NAME)
+    name="marzbackup-verify-$$"
+    password="verify$$"
+    if ! docker run -d --rm --name $name --cpus="$VERIFY_CPUS" --tmpfs /var/lib/mysql \
+        -e MARIADB_ROOT_PASSWORD=$password -e MYSQL_ROOT_PASSWORD=$password "$image" >/dev/null 2>&1; then
+        echo "Trial restore: could not start $image"
+        return
+    fi
+    ready=0
+    for _ in $(seq 1 120); do
+        if docker exec $name $DB_TYPE -h 127.0.0.1 --user=$USER --password=$password -e "SELECT 1" >/dev/null 2>&1; then
+            ready=1
+            break
+        fi
+        sleep 1
+    done
+    if [ "$ready" != "1" ]; then
+        echo "Trial restore: throwaway database did not start"
+        docker rm -f $name >/dev/null 2>&1
+        return
+    fi
+
+    # Load the dumps in parallel, at most VERIFY_PARALLEL at a time. Incremental dumps only hold
+    # rows of tables the base dump leaves out, so there is nothing to load them into; their
+    # tables are not compared either.
+    failed=0
+    for dump in "$DB_BACKUP_DIR"/*.sql; do
+        case "$dump" in
+            *.incremental.sql) continue ;;
+        esac
+        while [ "$(jobs -rp | wc -l)" -ge "$VERIFY_PARALLEL" ]; do
+            wait -n || failed=$(( failed + 1 ))
+        done
+        docker exec -i $name $DB_TYPE --user=$USER --password=$password < "$dump" >/dev/null 2>&1 &
+    done
+    while [ "$(jobs -rp | wc -l)" -gt 0 ]; do
+        wait -n || failed=$(( failed + 1 ))
+    done
+
+    for db in $(cut -f1 "$VERIFY_DIR/checksums.tsv" | cut -d. -f1 | sort -u); do
+        table_stats $name $password $db
+    done > "$VERIFY_DIR/restored.tsv"
+    docker rm -f $name >/dev/null 2>&1
+
+    # Tables that changed while they were dumped have no checksum of the dumped data to compare with
+    awk -F'\t' -v failed="$failed" '
+        FILENAME == ARGV[1] { restored[$1] = $2 "\t" $3; next }
+        $4 == "changed" { skipped = skipped " " $1; next }
+        { total++; if (restored[$1] == $2 "\t" $3) matched++; else bad = bad " " $1 }
+        END {
+            printf "Trial restore: %d/%d tables match", matched, total
+            if (failed) printf ", %d dumps failed to load", failed
+            if (bad != "") printf " (differs:%s)", bad
+            if (skipped != "") printf "; not compared, changed during the dump:%s", skipped
+            printf "\n"
+        }
+    ' "$VERIFY_DIR/restored.tsv" "$VERIFY_DIR/checksums.tsv"
+}
+
+# Function to write per-file hashes and the recorded table checksums into the archive manifest
+write_manifest() {
+    (cd "$TEMP_DIR" && find . -type f ! -name MANIFEST.json -print0 | sort -z | xargs -0 -r sha256sum) \
+        | awk '{ hash = $1; $1 = ""; sub(/^ \.\//, ""); printf "%s\t%s\n", $0, hash }' > "$VERIFY_DIR/files.tsv"
+    while IFS=$'\t' read -r path hash; do
+        printf "%s\t%s\t%s\n" "$path" "$(stat -c %s "$TEMP_DIR/$path")" "$hash"
+    done < "$VERIFY_DIR/files.tsv" > "$VERIFY_DIR/files_sized.tsv"
+    jq -n --arg created "$(date -Iseconds)" --arg system "$SYSTEM" --arg engine "$BACKUP_ENGINE" \
+        --rawfile files "$VERIFY_DIR/files_sized.tsv" --rawfile tables "$VERIFY_DIR/checksums.tsv" '
+        def rows: split("\n") | map(select(length > 0) | split("\t"));
+        {
+            created: $created, system: $system, engine: $engine,
+            files: ($files | rows | map({key: .[0], value: {size: (.[1] | tonumber), sha256: .[2]}}) | from_entries),
+            tables: ($tables | rows | map({key: .[0], value: {rows: (.[1] | tonumber? // null), checksum: .[2], changed_during_dump: (.[3] == "changed")}}) | from_entries)
+        }' > "$TEMP_DIR/MANIFEST.json"
+}
+
+# Function to summarize verification results for the backup report
+verify_report() {
+    files=$(wc -l < "$VERIFY_DIR/files.tsv")
+    tables=$(wc -l < "$VERIFY_DIR/checksums.tsv")
+    changed=$(awk -F'\t' '$4 == "changed"' "$VERIFY_DIR/checksums.tsv" | wc -l)
+    echo "Verify: $files files hashed, $tables tables checksummed ($changed changed during the dump)"
+    if [ -s "$VERIFY_DIR/restore.txt" ]; then
+        cat "$VERIFY_DIR/restore.txt"
+    fi
+}
 
 # Function to backup database
 backup_database() {
+    if [ "$BACKUP_ENGINE" = "physical" ]; then
+        # A physical copy always covers the whole server, whatever the tier policy says
+        BACKUP_KIND="full"
+        backup_database_physical
+        return
+    fi
+
     # Determine the correct dump command based on DB_TYPE
     if [ "$DB_TYPE" = "mariadb" ]; then
         DUMP_CMD="mariadb-dump"
@@ -50,39 +669,113 @@ backup_database() {
     # Get list of databases
     databases=$(docker exec $CONTAINER_NAME $DB_TYPE -h 127.0.0.1 --user=$USER --password=$DB_PASSWORD -e "SHOW DATABASES;" 2>/dev/null | tr -d "| " | grep -v Database)
 
+    if [ "$(echo "$TIER_JSON" | jq '.incremental_tables // {} | length')" = "0" ]; then
+        BACKUP_KIND="full"
+    elif full_backup_due; then
+        BACKUP_KIND="full"
+        set_state_value "$TIER.last_full" "$(date +%s)"
+    else
+        BACKUP_KIND="incremental"
+    fi
+
     # Backup each database
     for db in $databases; do
         # Check if the database is not a system database
         if [[ "$db" != "information_schema" && "$db" != "mysql" && "$db" != "performance_schema" && "$db" != "sys" ]]; then
+            tier_includes_database "$db" || continue
+            excluded=$(tier_excluded_tables "$db")
+            DUMP_EXTRA_OPTS=$(ignore_table_options "$db" $excluded)
+            # Tables that are not dumped in full cannot be compared after a trial restore
+            partial=" $(echo $excluded $(tier_incremental_tables "$db" | awk '{print $1}') | sed "s/[^ ]*/$db.&/g") "
+
+            # The checksums cannot run inside the dump's snapshot, so they are taken just before and
+            # just after it. A table with the same result both times held that data in the dump too.
+            if [ "$VERIFY_CHECKSUMS" = "true" ]; then
+                table_stats $CONTAINER_NAME $DB_PASSWORD $db > "$VERIFY_DIR/$db.before.tsv"
+            fi
+
             # Backup the database and save it as a .sql file
-            if ! docker exec $CONTAINER_NAME $DUMP_CMD -h 127.0.0.1 --force --opt --user=$USER --password=$DB_PASSWORD --databases $db > "$DB_BACKUP_DIR/$db.sql" 2>/dev/null; then
+            if [ -n "$(tier_incremental_tables "$db")" ] && [ "$BACKUP_KIND" = "incremental" ]; then
+                dump_database_incremental "$db"
+            else
+                record_full_watermarks "$db"
+                dump_database "$db"
+            fi
+            if [ $? -ne 0 ]; then
                 echo "Error dumping database: $db" >&2
+            elif [ "$VERIFY_CHECKSUMS" = "true" ]; then
+                # "db.table<TAB>rows<TAB>checksum<TAB>stable|changed"
+                table_stats $CONTAINER_NAME $DB_PASSWORD $db \
+                    | awk -F'\t' -v OFS='\t' -v partial="$partial" -v before_file="$VERIFY_DIR/$db.before.tsv" '
+                        BEGIN { while ((getline line < before_file) > 0) { split(line, f, "\t"); before[f[1]] = f[2] "\t" f[3] } }
+                        index(partial, " " $1 " ") == 0 { print $1, $2, $3, (before[$1] == $2 "\t" $3 ? "stable" : "changed") }
+                    ' >> "$VERIFY_DIR/checksums.tsv"
             fi
         fi
     done
+
+    # The trial restore runs alongside the file copy and archive stages
+    if [ "$VERIFY_RESTORE" = "true" ] && [ "$VERIFY_CHECKSUMS" = "true" ]; then
+        verify_trial_restore > "$VERIFY_DIR/restore.txt" 2>&1 &
+        VERIFY_PID=$!
+    fi
+}
+
+# Function to get the rsync bandwidth option for the current governed rate
+rsync_limit() {
+    if [ "$GOVERNED" = "true" ]; then
+        echo "--bwlimit=$(governor_rate)"
+    fi
 }
 
 # Function to backup Marzban
 backup_marzban() {
+    stage_begin dump
     backup_database
+    stage_end
     
+    if [ "$TIER_INCLUDE_FILES" != "true" ]; then
+        return
+    fi
+
     # Copy Marzban directories excluding 'mysql'
-    rsync -av --exclude='mysql' /opt/marzban "$TEMP_DIR/opt" >/dev/null 2>&1
-    rsync -av --exclude='mysql' /var/lib/marzban "$TEMP_DIR/var/lib" >/dev/null 2>&1
+    stage_begin files
+    governor_wait_idle
+    governed rsync -av $(rsync_limit) --exclude='mysql' /opt/marzban "$TEMP_DIR/opt" >/dev/null 2>&1
+    governed rsync -av $(rsync_limit) --exclude='mysql' /var/lib/marzban "$TEMP_DIR/var/lib" >/dev/null 2>&1
+    stage_end
 }
 
 # Function to backup Marzneshin
 backup_marzneshin() {
+    stage_begin dump
     backup_database
+    stage_end
     
+    if [ "$TIER_INCLUDE_FILES" != "true" ]; then
+        return
+    fi
+
     # Copy Marzneshin directories
+    stage_begin files
     mkdir -p "$TEMP_DIR/etc/opt"
-    rsync -av /etc/opt/marzneshin "$TEMP_DIR/etc/opt" >/dev/null 2>&1
+    governor_wait_idle
+    governed rsync -av $(rsync_limit) /etc/opt/marzneshin "$TEMP_DIR/etc/opt" >/dev/null 2>&1
     
     mkdir -p "$TEMP_DIR/var/lib"
-    rsync -av /var/lib/marzneshin "$TEMP_DIR/var/lib" >/dev/null 2>&1
+    governed rsync -av $(rsync_limit) /var/lib/marzneshin "$TEMP_DIR/var/lib" >/dev/null 2>&1
+    stage_end
+}
+
+# Function to stop background helpers when the script exits
+cleanup_on_exit() {
+    stop_governor
+    docker rm -f "marzbackup-verify-$$" >/dev/null 2>&1
 }
 
+start_governor
+trap cleanup_on_exit EXIT
+
 # Determine which system is installed based on DB_NAME
 if [ "$DB_NAME" = "marzban" ]; then
     SYSTEM="Marzban"
@@ -95,27 +788,136 @@ else
     exit 1
 fi
 
+write_manifest
+
 # Change to the temporary directory
 cd "$TEMP_DIR" || exit
 
-# Create a zip file with all backups
+if [ -z "$(find "$DB_BACKUP_DIR" -type f)" ] && [ "$TIER_INCLUDE_FILES" != "true" ]; then
+    echo "Nothing to back up for tier $TIER"
+    exit 0
+fi
+
+# Create the archive with the tier's compression ("zip:<level>", "gzip:<level>" or "zstd:<level>")
 CAPITALIZED_SYSTEM=$(echo "$SYSTEM" | sed 's/./\U&/')
-ZIP_FILE="$BACKUP_DIR/${CAPITALIZED_SYSTEM}_Backup_$(date +%F).zip"
-if ! zip -r "$ZIP_FILE" . >/dev/null 2>&1; then
-    echo "Error creating zip file" >&2
+if [ "$TIER" = "critical" ]; then
+    ARCHIVE_BASE="$BACKUP_DIR/${CAPITALIZED_SYSTEM}_Backup_$(date +%F)"
+else
+    ARCHIVE_BASE="$BACKUP_DIR/${CAPITALIZED_SYSTEM}_Backup_${TIER}_${BACKUP_KIND}_$(date +%F_%H%M)"
+fi
+COMPRESSION_FORMAT=${TIER_COMPRESSION%%:*}
+COMPRESSION_LEVEL=${TIER_COMPRESSION#*:}
+[ "$COMPRESSION_LEVEL" = "$TIER_COMPRESSION" ] && COMPRESSION_LEVEL=6
+stage_begin archive
+governor_wait_idle
+# Encrypted archives are written as one stream: compressor | crypto_stream.py > file.enc
+ARCHIVE_SUFFIX=""
+if [ "$ENCRYPTION" = "true" ]; then
+    ARCHIVE_SUFFIX=".enc"
+fi
+seal_archive() {
+    if [ "$ENCRYPTION" = "true" ]; then
+        MARZBACKUP_CONFIG="$CONFIG_FILE" governed python3 "$SCRIPT_DIR/crypto_stream.py" encrypt --stats "$ENCRYPT_STATS"
+    else
+        cat
+    fi
+}
+# Function to write the compressed archive stream to stdout
+produce_archive() {
+    case "$COMPRESSION_FORMAT" in
+        zip) governed zip -r -"$COMPRESSION_LEVEL" - . 2>/dev/null ;;
+        gzip) governed tar -cf - . 2>/dev/null | governed gzip -"$COMPRESSION_LEVEL" ;;
+        zstd) governed tar -cf - . 2>/dev/null | governed zstd -q -T0 -"$COMPRESSION_LEVEL" ;;
+    esac
+}
+case "$COMPRESSION_FORMAT" in
+    zip) ARCHIVE_FILE="$ARCHIVE_BASE.zip$ARCHIVE_SUFFIX" ;;
+    gzip) ARCHIVE_FILE="$ARCHIVE_BASE.tar.gz$ARCHIVE_SUFFIX" ;;
+    zstd) ARCHIVE_FILE="$ARCHIVE_BASE.tar.zst$ARCHIVE_SUFFIX" ;;
+    *)
+        echo "Unsupported compression: $TIER_COMPRESSION" >&2
+        exit 1
+        ;;
+esac
+UPLOAD_RATE_KB=0
+if [ "$GOVERNED" = "true" ]; then
+    UPLOAD_RATE_KB=$GOV_UPLOAD_RATE_KB
+fi
+CAPTION=$'Backup '"$SYSTEM"$'\n'"$SERVER_IP"
+if [ "$TIER" != "critical" ]; then
+    CAPTION="$CAPTION"$'\n'"Tier: $TIER ($BACKUP_KIND)"
+fi
+set -o pipefail
+if [ "$FANOUT" = "1" ]; then
+    # destinations.py writes $ARCHIVE_FILE and uploads it at the same time; the pipeline's exit
+    # status is written before the stream closes, so incomplete archives are never finalized remotely
+    rm -f "$FANOUT_STATUS"
+    { produce_archive | seal_archive; echo $? > "$FANOUT_STATUS"; } \
+        | MARZBACKUP_CONFIG="$CONFIG_FILE" governed python3 "$SCRIPT_DIR/destinations.py" send --file "$ARCHIVE_FILE" \
+            --status-file "$FANOUT_STATUS" --caption "$CAPTION" --rate-limit-kb "$UPLOAD_RATE_KB" --report "$FANOUT_REPORT" \
+            $TIER_DESTINATIONS >/dev/null
+    FANOUT_RESULT=$?
+    ARCHIVE_STATUS=$(cat "$FANOUT_STATUS" 2>/dev/null || echo 1)
+elif [ "$COMPRESSION_FORMAT" = "zip" ] && [ "$ENCRYPTION" != "true" ]; then
+    governed zip -r -"$COMPRESSION_LEVEL" "$ARCHIVE_FILE" . >/dev/null 2>&1
+    ARCHIVE_STATUS=$?
+else
+    produce_archive | seal_archive > "$ARCHIVE_FILE"
+    ARCHIVE_STATUS=$?
+fi
+set +o pipefail
+if [ $ARCHIVE_STATUS -ne 0 ]; then
+    echo "Error creating archive" >&2
+    rm -f "$ARCHIVE_FILE" "$FANOUT_STATUS" "$FANOUT_REPORT"
     exit 1
 fi
+stage_end
 
-# Send the zip file to Telegram with caption
-CAPTION=$'Backup '"$SYSTEM"$'\n'"$SERVER_IP"
+stop_governor
 
-if ! curl -s -F "chat_id=$CHAT_ID" -F "document=@$ZIP_FILE" -F "caption=$CAPTION" "https://api.telegram.org/bot$TOKEN/sendDocument" >/dev/null 2>&1; then
-    echo "Error sending file to Telegram" >&2
-    exit 1
+# Wait for the trial restore, if one is running, before reporting
+if [ -n "$VERIFY_PID" ]; then
+    wait $VERIFY_PID
+fi
+
+CAPTION="$CAPTION"$'\n'"$(verify_report)"
+if [ -s "$ENCRYPT_STATS" ]; then
+    CAPTION="$CAPTION"$'\n'"$(cat "$ENCRYPT_STATS")"
+fi
+if [ "$GOVERNED" = "true" ]; then
+    CAPTION="$CAPTION"$'\n'"$(governor_report)"
+fi
+
+# Send the archive to the tier's destination; "local" keeps it in $BACKUP_DIR only
+stage_begin upload
+if [ "$FANOUT" = "1" ]; then
+    # The uploads already ran while the archive was written; report how each destination did
+    REPORT="$CAPTION"$'\n'"$(cat "$FANOUT_REPORT" 2>/dev/null)"
+    echo "$REPORT"
+    MARZBACKUP_CONFIG="$CONFIG_FILE" python3 "$SCRIPT_DIR/outbox.py" message --text "$REPORT" >/dev/null
+    rm -f "$FANOUT_STATUS" "$FANOUT_REPORT"
+    if [ $FANOUT_RESULT -ne 0 ]; then
+        echo "Error sending the backup to some destinations" >&2
+        exit 1
+    fi
+elif [ "${MARZBACKUP_SKIP_UPLOAD:-0}" != "1" ] && [[ " $TIER_DESTINATIONS " == *" telegram "* ]]; then
+    # The outbox helper splits long captions and honours Telegram's retry_after
+    if ! MARZBACKUP_CONFIG="$CONFIG_FILE" governed python3 "$SCRIPT_DIR/outbox.py" document --file "$ARCHIVE_FILE" --caption "$CAPTION" --rate-limit-kb "$UPLOAD_RATE_KB" >/dev/null; then
+        echo "Error sending file to Telegram" >&2
+        exit 1
+    fi
 fi
+stage_end
+
+# Incremental watermarks only move forward once the backup has been delivered
+commit_state
 
 # Clean up temporary files
 rm -rf "$TEMP_DIR"
+rm -rf "$GOV_STATE_DIR"
+rm -rf "$VERIFY_DIR"
+rm -f "$NEW_STATE_FILE"
+rm -f "$ENCRYPT_STATS"
 
 # Final success message
-echo "Backup file for $SYSTEM created and sent successfully."
+echo "$TIER backup file for $SYSTEM created and sent successfully."
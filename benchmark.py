@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+import pytz
+
+# Reproducible benchmark for the usage tracker procedures, the backup stages and the restore.
+# Everything runs against a throwaway local MariaDB container, never against the panel database.
+#
+#   python3 benchmark.py run --users 10000 --periods 720 --output results.json
+#   python3 benchmark.py compare old.json new.json
+
+INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))
+SQL_FILE_PATH = os.path.join(INSTALL_DIR, "hourlyUsage.sql")
+BACKUP_SCRIPT_PATH = os.path.join(INSTALL_DIR, "backup.sh")
+
+BENCH_CONTAINER = "marzbackup-bench"
+BENCH_PASSWORD = "marzbackup-bench"
+DB_TYPE = "mariadb"
+
+tehran_tz = pytz.timezone('Asia/Tehran')
+
+def docker_sql(sql, database="", check=True):
+    command = ["docker", "exec", "-i", BENCH_CONTAINER, DB_TYPE, "-u", "root", f"-p{BENCH_PASSWORD}", "-N", "-B"]
+    if database:
+        command.append(database)
+    result = subprocess.run(command, input=sql, capture_output=True, text=True)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"SQL failed: {result.stderr.strip()}\n{sql[:200]}")
+    return result.stdout
+
+def run_measured(command, stdin=None, env=None):
+    # Run a command and return (seconds, peak RSS in KiB of the process tree it waited for)
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.DEVNULL, stderr=stderr_file, env=env)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+    if process.returncode != 0:
+        raise RuntimeError(f"{command[0]} exited with {process.returncode}: {stderr.strip()}")
+    return elapsed, rusage.ru_maxrss
+
+def parse_size(value):
+    units = {"B": 1, "KIB": 1024, "MIB": 1024 ** 2, "GIB": 1024 ** 3, "KB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+    value = value.strip().upper()
+    for unit in sorted(units, key=len, reverse=True):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * units[unit])
+    return int(float(value or 0))
+
+class ContainerMemorySampler:
+    # Samples the DB container's memory with `docker stats` to find the server-side peak of a step
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            result = subprocess.run(
+                ["docker", "stats", "--no-stream", "--format", "{{.MemUsage}}", BENCH_CONTAINER],
+                capture_output=True, text=True
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                self.peak = max(self.peak, parse_size(result.stdout.split("/")[0]))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def datadir_size():
+    output = subprocess.run(
+        ["docker", "exec", BENCH_CONTAINER, "du", "-sb", "/var/lib/mysql"],
+        capture_output=True, text=True
+    ).stdout
+    return int(output.split()[0]) if output else 0
+
+def start_container(image):
+    subprocess.run(["docker", "rm", "-f", BENCH_CONTAINER], capture_output=True)
+    subprocess.run(
+        ["docker", "run", "-d", "--name", BENCH_CONTAINER, "-e", f"MARIADB_ROOT_PASSWORD={BENCH_PASSWORD}", image],
+        check=True, capture_output=True
+    )
+    for _ in range(120):
+        if subprocess.run(
+            ["docker", "exec", BENCH_CONTAINER, DB_TYPE, "-u", "root", f"-p{BENCH_PASSWORD}", "-e", "SELECT 1"],
+            capture_output=True
+        ).returncode == 0:
+            break
+        time.sleep(1)
+    else:
+        raise RuntimeError("Benchmark database did not become ready in time")
+    # get_tehran_time() needs the time zone tables
+    subprocess.run(
+        f"docker exec {BENCH_CONTAINER} sh -c 'mariadb-tzinfo-to-sql /usr/share/zoneinfo 2>/dev/null"
+        f" | {DB_TYPE} -u root -p{BENCH_PASSWORD} mysql'",
+        shell=True, check=True, capture_output=True
+    )
+
+def stop_container():
+    subprocess.run(["docker", "rm", "-f", BENCH_CONTAINER], capture_output=True)
+
+def generate_data(users, periods, interval_minutes, seed):
+    # Synthetic Marzban users table plus `periods` report periods of history ending now
+    docker_sql(f"""
+        CREATE DATABASE IF NOT EXISTS marzban;
+        USE marzban;
+        CREATE TABLE users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(34) NOT NULL UNIQUE,
+            used_traffic BIGINT DEFAULT 0,
+            data_limit BIGINT NULL
+        );
+        INSERT INTO users (id, username, used_traffic, data_limit)
+        SELECT seq, CONCAT('user', seq), 0, IF(seq % 3 = 0, 50 * POW(1024, 3), NULL) FROM seq_1_to_{users};
+    """)
+    with open(SQL_FILE_PATH) as sql_file:
+        docker_sql(sql_file.read())
+
+    if periods <= 0:
+        return
+    now = datetime.now(tehran_tz).replace(tzinfo=None)
+    first = now - timedelta(minutes=interval_minutes * periods)
+    # Per-period traffic is deterministic for a given seed: a long tail with a few heavy users
+    traffic = f"(CRC32(CONCAT({seed}, '-', u.id)) % IF(u.id % 50 = 0, 2000000000, 20000000))"
+    docker_sql(f"""
+        USE UserUsageAnalytics;
+        INSERT INTO UsageSnapshots (user_id, timestamp, total_usage)
+        SELECT u.id, TIMESTAMP('{first:%Y-%m-%d %H:%M:%S}') + INTERVAL (p.seq * {interval_minutes}) MINUTE,
+               p.seq * {traffic}
+        FROM marzban.users u JOIN seq_1_to_{periods} p;
+        INSERT INTO PeriodicUsage (user_id, username, usage_in_period, timestamp, report_number)
+        SELECT u.id, u.username, {traffic},
+               TIMESTAMP('{first:%Y-%m-%d %H:%M:%S}') + INTERVAL (p.seq * {interval_minutes}) MINUTE, p.seq
+        FROM marzban.users u JOIN seq_1_to_{periods} p;
+        UPDATE marzban.users u SET used_traffic = (
+            SELECT MAX(total_usage) FROM UsageSnapshots s WHERE s.user_id = u.id
+        );
+    """)
+
+def time_sql(results, name, sql, database="UserUsageAnalytics"):
+    with ContainerMemorySampler() as sampler:
+        start = time.perf_counter()
+        docker_sql(sql, database)
+        elapsed = time.perf_counter() - start
+    results.setdefault(name, {"seconds": [], "db_peak_bytes": 0})
+    results[name]["seconds"].append(round(elapsed, 4))
+    results[name]["db_peak_bytes"] = max(results[name]["db_peak_bytes"], sampler.peak)
+
+def bench_tracker(results, cycles, seed):
+    for cycle in range(cycles):
+        docker_sql(f"UPDATE users SET used_traffic = used_traffic + CRC32(CONCAT({seed}, '-live-', {cycle}, '-', id)) % 20000000;", "marzban")
+        now = datetime.now(tehran_tz)
+        time_sql(results, "tracker.insert_current_usage", f"CALL insert_current_usage('{now:%Y-%m-%d %H:%M:%S}');")
+        time_sql(results, "tracker.calculate_usage", "CALL calculate_usage();")
+
+def bench_backup(results, workdir):
+    config_path = os.path.join(workdir, "config.json")
+    with open(config_path, "w") as file:
+        json.dump({
+            "API_TOKEN": "", "ADMIN_CHAT_ID": "",
+            "db_container": BENCH_CONTAINER, "db_password": BENCH_PASSWORD,
+            "db_name": "marzban", "db_type": DB_TYPE
+        }, file)
+    backup_dir = os.path.join(workdir, "backups")
+    stage_log = os.path.join(workdir, "stages.log")
+    env = dict(os.environ, MARZBACKUP_CONFIG=config_path, MARZBACKUP_BACKUP_DIR=backup_dir,
+               MARZBACKUP_STAGE_LOG=stage_log, MARZBACKUP_SKIP_UPLOAD="1")
+
+    archives = []
+    for tier in ("critical", "analytics"):
+        if os.path.exists(stage_log):
+            os.remove(stage_log)
+        before = set(os.listdir(backup_dir)) if os.path.isdir(backup_dir) else set()
+        with ContainerMemorySampler() as sampler:
+            elapsed, peak_rss = run_measured(["/bin/bash", BACKUP_SCRIPT_PATH, "--tier", tier], env=env)
+        results[f"backup.{tier}.total"] = {"seconds": [round(elapsed, 4)], "peak_rss_kib": peak_rss, "db_peak_bytes": sampler.peak}
+        with open(stage_log) as file:
+            for line in file:
+                stage, seconds = line.split()
+                results[f"backup.{tier}.{stage}"] = {"seconds": [float(seconds)]}
+        archive = os.path.join(backup_dir, (set(os.listdir(backup_dir)) - before).pop())
+        results[f"backup.{tier}.archive"] = {"bytes": os.path.getsize(archive)}
+        archives.append(archive)
+    return archives
+
+def bench_restore(results, archives, workdir):
+    # Same command the restore handlers run, one database dump at a time
+    dumps = []
+    for index, archive in enumerate(archives):
+        extract_dir = os.path.join(workdir, f"extract{index}")
+        with zipfile.ZipFile(archive) as zf:
+            members = [name for name in zf.namelist() if name.endswith(".sql")]
+            zf.extractall(extract_dir, members=members)
+        dumps += [(extract_dir, member) for member in members]
+    for extract_dir, dump in dumps:
+        db = os.path.basename(dump)[:-len(".sql")]
+        path = os.path.join(extract_dir, dump)
+        with open(path, "rb") as sql_file, ContainerMemorySampler() as sampler:
+            elapsed, peak_rss = run_measured(
+                ["docker", "exec", "-i", BENCH_CONTAINER, DB_TYPE, "-u", "root", f"-p{BENCH_PASSWORD}", db],
+                stdin=sql_file
+            )
+        results[f"restore.{db}"] = {
+            "seconds": [round(elapsed, 4)], "peak_rss_kib": peak_rss,
+            "db_peak_bytes": sampler.peak, "dump_bytes": os.path.getsize(path)
+        }
+
+def git_revision():
+    result = subprocess.run(["git", "-C", INSTALL_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or "unknown"
+
+def run(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="marzbackup-bench-")
+    try:
+        start_container(args.image)
+        generate_data(args.users, args.periods, args.interval, args.seed)
+        results["disk.after_generate"] = {"bytes": datadir_size()}
+
+        bench_tracker(results, args.cycles, args.seed)
+        archives = bench_backup(results, workdir)
+        bench_restore(results, archives, workdir)
+
+        # Cleanup with a clock far enough ahead that half of the generated history expires
+        cutoff = datetime.now(tehran_tz) + timedelta(days=365) - timedelta(minutes=args.interval * args.periods // 2)
+        time_sql(results, "tracker.cleanup_old_data", f"CALL cleanup_old_data('{cutoff:%Y-%m-%d %H:%M:%S}');")
+        results["disk.after_cleanup"] = {"bytes": datadir_size()}
+    finally:
+        if not args.keep:
+            stop_container()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for metric in results.values():
+        if "seconds" in metric:
+            samples = sorted(metric["seconds"])
+            metric["median"] = samples[len(samples) // 2]
+
+    report = {
+        "meta": {
+            "revision": git_revision(), "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "image": args.image, "users": args.users, "periods": args.periods,
+            "interval_minutes": args.interval, "cycles": args.cycles, "seed": args.seed
+        },
+        "results": results
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+
+def metric_value(metric):
+    for key in ("median", "bytes"):
+        if key in metric:
+            return key, metric[key]
+    return None, None
+
+def compare(args):
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    if old["meta"]["users"] != new["meta"]["users"] or old["meta"]["periods"] != new["meta"]["periods"]:
+        print("Warning: the two runs used different data sizes")
+    print(f"{'metric':40} {old['meta']['revision']:>14} {new['meta']['revision']:>14} {'change':>9}")
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        key, before = metric_value(old["results"].get(name, {}))
+        _, after = metric_value(new["results"].get(name, {}))
+        if before is None or after is None:
+            print(f"{name:40} {str(before):>14} {str(after):>14}")
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        unit = "s" if key == "median" else "B"
+        print(f"{name:40} {before:>13}{unit} {after:>13}{unit} {change:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="MarzBackup benchmark suite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Generate data and time tracker, backup and restore")
+    run_parser.add_argument("--users", type=int, default=1000)
+    run_parser.add_argument("--periods", type=int, default=168, help="Report periods of history to generate")
+    run_parser.add_argument("--interval", type=int, default=60, help="Report interval in minutes")
+    run_parser.add_argument("--cycles", type=int, default=3, help="Live tracker cycles to time")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--image", default="mariadb:lts")
+    run_parser.add_argument("--output", help="Write the JSON results to this file")
+    run_parser.add_argument("--keep", action="store_true", help="Keep the benchmark container afterwards")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        if not shutil.which("docker"):
+            print("docker is required to run the benchmark")
+            sys.exit(1)
+        run(args)
+    else:
+        compare(args)
+
+if __name__ == "__main__":
+    main()
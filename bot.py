@@ -10,7 +10,10 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import FSInputFile, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from aiogram.types import FSInputFile, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from outbox import setup_outbox, PRIORITY_HIGH
+from crypto_stream import ENCRYPTED_SUFFIX, verify_file, decrypt_command
+from selective_restore import RESTORE_DIR, BackupArchive, archive_kind, restore_entries, restore_entry
 
 CONFIG_FILE = 'config.json'
 
@@ -37,22 +40,27 @@ db_password = config.get("db_password")
 class BackupSettings(StatesGroup):
     waiting_for_schedule = State()
 
+# Archives opened for selective restore, per chat: (BackupArchive, entries, lock)
+selective_archives = {}
+MAX_RESTORE_BUTTONS = 90
+
 bot = None
 dp = None
 loop = None
 backup_task = None
+outbox = None
 
 async def create_and_send_backup():
     try:
         result = subprocess.run(['/bin/bash', '/opt/MarzBackup/backup.sh'], capture_output=True, text=True)
         if result.returncode == 0:
-            await bot.send_message(chat_id=ADMIN_CHAT_ID, text="پشتیبان‌گیری با موفقیت انجام شد.")
+            outbox.send_message(ADMIN_CHAT_ID, "پشتیبان‌گیری با موفقیت انجام شد.", digest_key="پشتیبان‌گیری")
             return True
         else:
-            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {result.stderr}")
+            outbox.send_message(ADMIN_CHAT_ID, f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {result.stderr}", PRIORITY_HIGH, digest_key="خطای پشتیبان‌گیری")
             return False
     except Exception as e:
-        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {str(e)}")
+        outbox.send_message(ADMIN_CHAT_ID, f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {str(e)}", PRIORITY_HIGH, digest_key="خطای پشتیبان‌گیری")
         return False
 
 async def restore_backup(file: types.Document):
@@ -70,7 +78,7 @@ async def restore_backup(file: types.Document):
             mysql_backup_dir = "/var/lib/marzneshin/mysql/db-backup"
             database_name = "marzneshin"
         else:
-            await bot.send_message(chat_id=ADMIN_CHAT_ID, text="هیچ دایرکتوری Marzban یا Marzneshin یافت نشد.")
+            outbox.send_message(ADMIN_CHAT_ID, "هیچ دایرکتوری Marzban یا Marzneshin یافت نشد.")
             return False
 
         os.makedirs(mysql_backup_dir, exist_ok=True)
@@ -82,17 +90,23 @@ async def restore_backup(file: types.Document):
         db_container = get_db_container_name(system)
         password = get_db_password(system)
 
-        restore_command = f"docker exec -i {db_container} mariadb -u root -p\"{password}\" {database_name} < {file_path}"
-        result = subprocess.run(restore_command, shell=True, capture_output=True, text=True)
+        restore_command = f"docker exec -i {db_container} mariadb -u root -p\"{password}\" {database_name}"
+        if file_path.endswith(ENCRYPTED_SUFFIX):
+            # Check every chunk's MAC first, then decrypt straight into the database
+            await asyncio.to_thread(verify_file, file_path, load_config())
+            restore_command = f"set -o pipefail; {decrypt_command(file_path, os.path.abspath(CONFIG_FILE))} | {restore_command}"
+        else:
+            restore_command = f"{restore_command} < {file_path}"
+        result = subprocess.run(["/bin/bash", "-c", restore_command], capture_output=True, text=True)
         
         if result.returncode != 0:
             raise Exception(f"Restore failed: {result.stderr}")
 
         print(f"{system.capitalize()} database restored successfully.")
-        await bot.send_message(chat_id=ADMIN_CHAT_ID, text="دیتابیس با موفقیت بازیابی شد.")
+        outbox.send_message(ADMIN_CHAT_ID, "دیتابیس با موفقیت بازیابی شد.")
         return True
     except Exception as e:
-        await bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"خطایی در فرآیند بازیابی رخ داد: {str(e)}")
+        outbox.send_message(ADMIN_CHAT_ID, f"خطایی در فرآیند بازیابی رخ داد: {str(e)}", PRIORITY_HIGH)
         print(f"An error occurred during the restore process: {str(e)}")
         return False
 
@@ -102,7 +116,7 @@ async def schedule_backup(interval_minutes):
         await asyncio.sleep(interval_minutes * 60)
 
 async def initialize_bot():
-    global API_TOKEN, ADMIN_CHAT_ID, bot, dp, loop, config, backup_interval_minutes, backup_task
+    global API_TOKEN, ADMIN_CHAT_ID, bot, dp, loop, config, backup_interval_minutes, backup_task, outbox
 
     if not API_TOKEN:
         API_TOKEN = input("Please enter your bot token: ").strip()
@@ -117,11 +131,16 @@ async def initialize_bot():
     bot = Bot(token=API_TOKEN)
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
+    outbox = setup_outbox(bot, config)
+    outbox.start()
+
+    def reply(message, text, **kwargs):
+        return outbox.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
 
     @dp.message(Command("start"))
     async def send_welcome(message: types.Message):
         if str(message.from_user.id) != ADMIN_CHAT_ID:
-            await message.reply("شما مجاز به استفاده از این ربات نیستید.")
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
             return
 
         keyboard = ReplyKeyboardMarkup(
@@ -133,29 +152,29 @@ async def initialize_bot():
             resize_keyboard=True
         )
 
-        await message.reply("خوش آمدید! لطفاً یک گزینه را انتخاب کنید:", reply_markup=keyboard)
+        reply(message, "خوش آمدید! لطفاً یک گزینه را انتخاب کنید:", reply_markup=keyboard)
 
     @dp.message(lambda message: message.text == "پشتیبان‌گیری فوری")
     async def handle_get_backup(message: types.Message):
         if str(message.from_user.id) != ADMIN_CHAT_ID:
-            await message.reply("شما مجاز به استفاده از این ربات نیستید.")
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
             return
 
-        await message.reply("در حال شروع فرآیند پشتیبان‌گیری...")
+        reply(message, "در حال شروع فرآیند پشتیبان‌گیری...")
         success = await create_and_send_backup()
         if success:
-            await message.reply("پشتیبان‌گیری با موفقیت انجام و ارسال شد.")
+            reply(message, "پشتیبان‌گیری با موفقیت انجام و ارسال شد.")
         else:
-            await message.reply("پشتیبان‌گیری با شکست مواجه شد. لطفاً لاگ‌ها را بررسی کنید.")
+            reply(message, "پشتیبان‌گیری با شکست مواجه شد. لطفاً لاگ‌ها را بررسی کنید.")
 
     @dp.message(lambda message: message.text == "تنظیم فاصله زمانی پشتیبان‌گیری")
     async def set_backup(message: types.Message, state: FSMContext):
         if str(message.from_user.id) != ADMIN_CHAT_ID:
-            await message.reply("شما مجاز به استفاده از این ربات نیستید.")
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
             return
 
         await state.set_state(BackupSettings.waiting_for_schedule)
-        await message.reply("لطفاً فاصله زمانی پشتیبان‌گیری را به دقیقه وارد کنید (مثلاً '60' برای هر ساعت):", reply_markup=ReplyKeyboardRemove())
+        reply(message, "لطفاً فاصله زمانی پشتیبان‌گیری را به دقیقه وارد کنید (مثلاً '60' برای هر ساعت):", reply_markup=ReplyKeyboardRemove())
 
     @dp.message(BackupSettings.waiting_for_schedule)
     async def process_schedule(message: types.Message, state: FSMContext):
@@ -180,32 +199,118 @@ async def initialize_bot():
                 resize_keyboard=True
             )
 
-            await message.reply(f"زمان‌بندی پشتیبان‌گیری با موفقیت به هر {interval_minutes} دقیقه تنظیم شد.", reply_markup=keyboard)
+            reply(message, f"زمان‌بندی پشتیبان‌گیری با موفقیت به هر {interval_minutes} دقیقه تنظیم شد.", reply_markup=keyboard)
             await state.clear()
         except ValueError:
-            await message.reply("فرمت نامعتبر. لطفاً یک عدد به عنوان دقیقه وارد کنید.")
+            reply(message, "فرمت نامعتبر. لطفاً یک عدد به عنوان دقیقه وارد کنید.")
 
     @dp.message(lambda message: message.text == "بازیابی پشتیبان")
     async def handle_restore_backup(message: types.Message):
         if str(message.from_user.id) != ADMIN_CHAT_ID:
-            await message.reply("شما مجاز به استفاده از این ربات نیستید.")
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
             return
 
-        await message.reply("لطفاً فایل SQL را برای بازیابی ارسال کنید.")
+        reply(message, "لطفاً فایل SQL را برای بازیابی ارسال کنید.")
 
-    @dp.message(lambda message: message.document and message.document.file_name.endswith('.sql'))
+    @dp.message(lambda message: message.document and message.document.file_name.endswith(('.sql', '.sql' + ENCRYPTED_SUFFIX)))
     async def handle_document(message: types.Message):
         if str(message.from_user.id) != ADMIN_CHAT_ID:
-            await message.reply("شما مجاز به استفاده از این ربات نیستید.")
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
             return
 
         document = message.document
-        await message.reply("در حال بازیابی دیتابیس...")
+        reply(message, "در حال بازیابی دیتابیس...")
         success = await restore_backup(document)
         if success:
-            await message.reply("دیتابیس با موفقیت بازیابی شد.")
+            reply(message, "دیتابیس با موفقیت بازیابی شد.")
         else:
-            await message.reply("بازیابی با شکست مواجه شد. لطفاً لاگ‌ها را بررسی کنید.")
+            reply(message, "بازیابی با شکست مواجه شد. لطفاً لاگ‌ها را بررسی کنید.")
+
+    def is_backup_archive(message):
+        if not message.document or not message.document.file_name:
+            return False
+        try:
+            archive_kind(message.document.file_name.lower())
+            return True
+        except ValueError:
+            return False
+
+    @dp.message(is_backup_archive)
+    async def handle_archive(message: types.Message):
+        if str(message.from_user.id) != ADMIN_CHAT_ID:
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
+            return
+
+        try:
+            os.makedirs(RESTORE_DIR, exist_ok=True)
+            file_info = await bot.get_file(message.document.file_id)
+            file_path = os.path.join(RESTORE_DIR, os.path.basename(message.document.file_name))
+            await bot.download_file(file_info.file_path, file_path)
+
+            # Only the archive index is read; members are extracted when they are picked
+            archive = BackupArchive(file_path, load_config())
+            entries = await asyncio.to_thread(restore_entries, archive)
+        except Exception as e:
+            reply(message, f"خطا در خواندن فایل پشتیبان: {str(e)}")
+            return
+
+        previous = selective_archives.pop(message.chat.id, None)
+        if previous:
+            async with previous[2]:
+                previous[0].close()
+        # BackupArchive is not thread-safe; the lock keeps one restore at a time reading it
+        selective_archives[message.chat.id] = (archive, entries, asyncio.Lock())
+        buttons = [[InlineKeyboardButton(text=entry["label"], callback_data=f"restore:{index}")]
+                   for index, entry in enumerate(entries[:MAX_RESTORE_BUTTONS])]
+        text = "مورد مورد نظر برای بازیابی را انتخاب کنید:"
+        if len(entries) > MAX_RESTORE_BUTTONS:
+            text += f"\n(فقط {MAX_RESTORE_BUTTONS} مورد اول نمایش داده شده است؛ برای موارد دیگر نام آن را ارسال کنید)"
+        reply(message, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+
+    async def run_selective_restore(chat_id, entry):
+        selected = selective_archives.get(chat_id)
+        if not selected:
+            outbox.send_message(chat_id, "فایل پشتیبان دیگر در دسترس نیست. لطفاً دوباره ارسال کنید.")
+            return
+        archive, _, lock = selected
+        outbox.send_message(chat_id, f"در حال بازیابی {entry['label']}...")
+        try:
+            async with lock:
+                await asyncio.to_thread(restore_entry, archive, entry, load_config())
+            outbox.send_message(chat_id, f"{entry['label']} با موفقیت بازیابی شد.")
+        except Exception as e:
+            outbox.send_message(chat_id, f"خطایی در فرآیند بازیابی رخ داد: {str(e)}", PRIORITY_HIGH)
+
+    @dp.callback_query(lambda callback: callback.data and callback.data.startswith("restore:"))
+    async def handle_restore_selection(callback: types.CallbackQuery):
+        await callback.answer()
+        if str(callback.from_user.id) != ADMIN_CHAT_ID:
+            return
+        selected = selective_archives.get(callback.message.chat.id)
+        if not selected:
+            outbox.send_message(callback.message.chat.id, "فایل پشتیبان دیگر در دسترس نیست. لطفاً دوباره ارسال کنید.")
+            return
+
+        entries = selected[1]
+        await run_selective_restore(callback.message.chat.id, entries[int(callback.data.split(":", 1)[1])])
+
+    def find_restore_entry(message):
+        # Entries beyond the inline-button limit are picked by sending their name
+        selected = selective_archives.get(message.chat.id)
+        if not selected or not message.text:
+            return None
+        name = message.text.strip()
+        for entry in selected[1]:
+            if name in (entry["label"], entry["member"]):
+                return entry
+        return None
+
+    @dp.message(lambda message: find_restore_entry(message) is not None)
+    async def handle_restore_name(message: types.Message):
+        if str(message.from_user.id) != ADMIN_CHAT_ID:
+            reply(message, "شما مجاز به استفاده از این ربات نیستید.")
+            return
+        await run_selective_restore(message.chat.id, find_restore_entry(message))
 
     def shutdown_handler(signum, frame):
         print("Shutting down...")
@@ -0,0 +1,282 @@
+import io
+import os
+import sys
+import json
+import time
+import shlex
+import struct
+import hashlib
+import argparse
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# Chunked AES-256-GCM for backup archives, applied while the archive is being written.
+#
+# File layout:
+#   header: MAGIC | key mode (1) | chunk size (4) | nonce prefix (7) | salt (16) | key check (8)
+#   body:   one ciphertext + 16 byte tag per chunk of `chunk size` plaintext bytes, the last chunk shorter
+#
+# Each chunk's nonce is nonce prefix | chunk index (4) | final flag (1) and the header is the
+# associated data, so reordered, truncated, appended or corrupted chunks all fail their tag.
+# Every chunk except the last has the same size, which keeps the file seekable for selective restore.
+
+MAGIC = b"MZBKENC1"
+HEADER = struct.Struct(">8sBI7s16s8s")
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+ENCRYPTED_SUFFIX = ".enc"
+
+KEY_MODE_FILE = 1
+KEY_MODE_PASSPHRASE = 2
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 15, 8, 1
+
+CONFIG_FILE_PATH = os.environ.get("MARZBACKUP_CONFIG", "/opt/marzbackup/config.json")
+DEFAULT_KEY_FILE = "/opt/marzbackup/backup.key"
+SCRIPT_PATH = os.path.abspath(__file__)
+
+class DecryptionError(Exception):
+    pass
+
+def key_check(key):
+    return hashlib.sha256(b"marzbackup-key-check" + key).digest()[:8]
+
+def derive_key(passphrase, salt):
+    return Scrypt(salt=salt, length=32, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P).derive(passphrase.encode())
+
+def read_key_file(path):
+    with open(path, 'rb') as file:
+        key = bytes.fromhex(file.read().decode().strip())
+    if len(key) != 32:
+        raise ValueError(f"{path} must contain a 256 bit key as 64 hex characters")
+    return key
+
+def generate_key_file(path):
+    # The key never leaves the server; keep a copy elsewhere or the backups cannot be restored
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as file:
+        file.write(os.urandom(32).hex() + "\n")
+    return path
+
+def key_for_encryption(config):
+    # Returns (key, key mode, salt); a passphrase takes precedence over the key file
+    passphrase = config.get("backup_encryption_passphrase")
+    if passphrase:
+        salt = os.urandom(16)
+        return derive_key(passphrase, salt), KEY_MODE_PASSPHRASE, salt
+    return read_key_file(config.get("backup_encryption_key_file", DEFAULT_KEY_FILE)), KEY_MODE_FILE, bytes(16)
+
+def key_for_header(config, header):
+    if header["mode"] == KEY_MODE_PASSPHRASE:
+        passphrase = config.get("backup_encryption_passphrase")
+        if not passphrase:
+            raise DecryptionError("Backup is passphrase protected but backup_encryption_passphrase is not set")
+        key = derive_key(passphrase, header["salt"])
+    else:
+        key = read_key_file(config.get("backup_encryption_key_file", DEFAULT_KEY_FILE))
+    if key_check(key) != header["key_check"]:
+        raise DecryptionError("Backup was encrypted with a different key")
+    return key
+
+def parse_header(data):
+    if len(data) < HEADER.size:
+        raise DecryptionError("File is too short to be an encrypted backup")
+    magic, mode, chunk_size, nonce_prefix, salt, check = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise DecryptionError("Not an encrypted MarzBackup archive")
+    return {"raw": data[:HEADER.size], "mode": mode, "chunk_size": chunk_size,
+            "nonce_prefix": nonce_prefix, "salt": salt, "key_check": check}
+
+def chunk_nonce(nonce_prefix, index, final):
+    return nonce_prefix + struct.pack(">IB", index, 1 if final else 0)
+
+def read_full(stream, size):
+    # Pipes return short reads; keep reading until `size` bytes or end of stream
+    data = bytearray()
+    while len(data) < size:
+        block = stream.read(size - len(data))
+        if not block:
+            break
+        data += block
+    return bytes(data)
+
+def encrypt_stream(source, target, key, mode=KEY_MODE_FILE, salt=bytes(16), chunk_size=DEFAULT_CHUNK_SIZE):
+    # Returns (plaintext bytes, seconds spent encrypting)
+    aesgcm = AESGCM(key)
+    nonce_prefix = os.urandom(7)
+    header = HEADER.pack(MAGIC, mode, chunk_size, nonce_prefix, salt, key_check(key))
+    target.write(header)
+    total = 0
+    crypto_seconds = 0.0
+    index = 0
+    chunk = read_full(source, chunk_size)
+    while True:
+        # Read one chunk ahead so the last chunk can be marked final
+        following = read_full(source, chunk_size) if len(chunk) == chunk_size else b""
+        final = not following
+        started = time.perf_counter()
+        sealed = aesgcm.encrypt(chunk_nonce(nonce_prefix, index, final), chunk, header)
+        crypto_seconds += time.perf_counter() - started
+        target.write(sealed)
+        total += len(chunk)
+        if final:
+            break
+        chunk = following
+        index += 1
+    target.flush()
+    return total, crypto_seconds
+
+def decrypt_stream(source, target, config):
+    # Writes plaintext to `target` (or only checks the tags when it is None); returns plaintext bytes
+    header = parse_header(read_full(source, HEADER.size))
+    aesgcm = AESGCM(key_for_header(config, header))
+    sealed_size = header["chunk_size"] + TAG_SIZE
+    total = 0
+    index = 0
+    sealed = read_full(source, sealed_size)
+    while True:
+        following = read_full(source, sealed_size) if len(sealed) == sealed_size else b""
+        final = not following
+        try:
+            chunk = aesgcm.decrypt(chunk_nonce(header["nonce_prefix"], index, final), sealed, header["raw"])
+        except InvalidTag:
+            raise DecryptionError(f"Chunk {index} failed authentication; the backup is corrupted or truncated")
+        if target is not None:
+            target.write(chunk)
+        total += len(chunk)
+        if final:
+            break
+        sealed = following
+        index += 1
+    if target is not None:
+        target.flush()
+    return total
+
+def verify_file(path, config):
+    # Check every chunk tag before anything is restored
+    with open(path, 'rb') as source:
+        return decrypt_stream(source, None, config)
+
+def decrypt_file(path, target_path, config):
+    with open(path, 'rb') as source, open(target_path, 'wb') as target:
+        return decrypt_stream(source, target, config)
+
+class EncryptedReader(io.RawIOBase):
+    # Seekable read-only view of the plaintext; only the chunks that are read get decrypted and authenticated
+    def __init__(self, path, config):
+        self.file = open(path, 'rb')
+        try:
+            self.header = parse_header(read_full(self.file, HEADER.size))
+            self.aesgcm = AESGCM(key_for_header(config, self.header))
+        except Exception:
+            self.file.close()
+            raise
+        self.chunk_size = self.header["chunk_size"]
+        sealed_size = self.chunk_size + TAG_SIZE
+        body_size = os.fstat(self.file.fileno()).st_size - HEADER.size
+        self.chunk_count = max((body_size + sealed_size - 1) // sealed_size, 1)
+        self.size = body_size - self.chunk_count * TAG_SIZE
+        if self.size < 0:
+            raise DecryptionError("Encrypted backup is truncated")
+        self.position = 0
+        self.cached_index = None
+        self.cached_chunk = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def _chunk(self, index):
+        if index != self.cached_index:
+            self.file.seek(HEADER.size + index * (self.chunk_size + TAG_SIZE))
+            sealed = read_full(self.file, self.chunk_size + TAG_SIZE)
+            final = index == self.chunk_count - 1
+            try:
+                self.cached_chunk = self.aesgcm.decrypt(chunk_nonce(self.header["nonce_prefix"], index, final),
+                                                        sealed, self.header["raw"])
+            except InvalidTag:
+                raise DecryptionError(f"Chunk {index} failed authentication; the backup is corrupted or truncated")
+            self.cached_index = index
+        return self.cached_chunk
+
+    def readinto(self, buffer):
+        # Fill the whole buffer, crossing chunk boundaries, so callers never see short reads
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.chunk_size)
+            data = self._chunk(index)[offset:offset + len(view) - filled]
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self.position += len(data)
+        return filled
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def is_encrypted(path):
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+def decrypt_command(path, config_path=CONFIG_FILE_PATH):
+    # Shell command writing the decrypted contents of `path` to stdout, for piping into a restore
+    return (f"MARZBACKUP_CONFIG={shlex.quote(config_path)} python3 {shlex.quote(SCRIPT_PATH)} "
+            f"decrypt < {shlex.quote(path)}")
+
+def _load_config():
+    with open(CONFIG_FILE_PATH, 'r') as file:
+        return json.load(file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt MarzBackup archives (stdin to stdout)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    encrypt_parser = subparsers.add_parser("encrypt")
+    encrypt_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    encrypt_parser.add_argument("--stats", help="Write throughput statistics to this file")
+    subparsers.add_parser("decrypt")
+    verify_parser = subparsers.add_parser("verify")
+    verify_parser.add_argument("file")
+    keygen_parser = subparsers.add_parser("keygen")
+    keygen_parser.add_argument("--key-file", default=DEFAULT_KEY_FILE)
+    args = parser.parse_args()
+
+    if args.command == "keygen":
+        print(generate_key_file(args.key_file))
+        return
+
+    config = _load_config()
+    try:
+        if args.command == "encrypt":
+            key, mode, salt = key_for_encryption(config)
+            started = time.monotonic()
+            total, crypto_seconds = encrypt_stream(sys.stdin.buffer, sys.stdout.buffer, key, mode, salt, args.chunk_size)
+            wall_seconds = time.monotonic() - started
+            if args.stats:
+                megabytes = total / 1024 ** 2
+                with open(args.stats, 'w') as file:
+                    file.write(f"Encrypted {megabytes:.1f} MB: {crypto_seconds:.2f}s AES-GCM "
+                               f"({megabytes / max(crypto_seconds, 1e-6):.0f} MB/s) in {wall_seconds:.2f}s total\n")
+        elif args.command == "decrypt":
+            decrypt_stream(sys.stdin.buffer, sys.stdout.buffer, config)
+        else:
+            print(f"OK: {verify_file(args.file, config)} bytes authenticated")
+    except (DecryptionError, OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
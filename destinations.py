@@ -0,0 +1,465 @@
+import os
+import sys
+import json
+import time
+import argparse
+import posixpath
+import threading
+import contextlib
+from collections import deque
+from outbox import send_document_sync
+
+# Fan-out of one backup stream to several destinations.
+# backup.sh pipes the archive into `destinations.py send`. Every chunk is written to the local
+# archive file (the spool) and handed to each destination's uploader thread through its own
+# bounded buffer. A destination that falls more than its buffer behind is detached from the live
+# stream and continues from the spool file, so a slow upload never holds up the others.
+# Uploads are only finalized once backup.sh reports that the archive was produced completely,
+# and a failed upload is retried from the spool file.
+#
+# Destinations are named in the tier's "destination" (a name or a list of names):
+#   "telegram"  the admin chat (sent once the archive is complete, like before)
+#   "local"     the archive in the backup directory, which is always kept
+#   any key of backup_destinations, e.g.
+#     "offsite": {"type": "s3", "bucket": "backups", "prefix": "marzban/", "endpoint_url": "https://...",
+#                 "access_key": "...", "secret_key": "...", "region": "us-east-1", "part_size_mb": 16}
+#     "nas":     {"type": "sftp", "host": "10.0.0.5", "port": 22, "username": "backup", "password": "...",
+#                 "key_file": "/root/.ssh/id_ed25519", "path": "/backups", "host_key_policy": "reject"}
+#     "usb":     {"type": "local", "path": "/mnt/usb/marzbackup"}
+# Every destination also accepts "retries" and "buffer_mb".
+
+CONFIG_FILE_PATH = os.environ.get("MARZBACKUP_CONFIG", "/opt/marzbackup/config.json")
+CHUNK_SIZE = 1024 * 1024
+
+DEFAULT_SETTINGS = {
+    "backup_fanout_buffer_mb": 64,      # live stream kept in memory per destination before it reads from disk
+    "backup_destination_retries": 3,    # attempts per destination
+}
+
+class Spool:
+    # The local archive file, readable by the uploaders while it is still being written
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.size = 0
+        self.finished = False
+        self.cond = threading.Condition()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.file.flush()
+        with self.cond:
+            self.size += len(chunk)
+            self.cond.notify_all()
+
+    def finish(self):
+        if not self.file.closed:
+            os.fsync(self.file.fileno())
+            self.file.close()
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def read_at(self, fd, position, size):
+        # Wait until there is data at `position` or the spool is complete
+        with self.cond:
+            while position >= self.size and not self.finished:
+                self.cond.wait()
+            available = min(size, self.size - position)
+        if available <= 0:
+            return b""
+        return os.pread(fd, available, position)
+
+class SpoolReader:
+    def __init__(self, spool, position=0):
+        self.spool = spool
+        self.position = position
+        self.fd = os.open(spool.path, os.O_RDONLY)
+
+    def read(self, size=CHUNK_SIZE):
+        data = self.spool.read_at(self.fd, self.position, size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+class Feed:
+    # The live stream for one destination, holding at most `limit` bytes
+    def __init__(self, spool, limit):
+        self.spool = spool
+        self.limit = limit
+        self.chunks = deque()
+        self.buffered = 0
+        self.position = 0
+        self.detached = False
+        self.ended = False
+        self.reader = None
+        self.cond = threading.Condition()
+
+    def offer(self, chunk):
+        with self.cond:
+            if self.detached:
+                return
+            if self.buffered + len(chunk) > self.limit:
+                # Too far behind: from here on this destination reads the spool file instead
+                self.detached = True
+            else:
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+            self.cond.notify_all()
+
+    def abandon(self):
+        # The live attempt failed; stop buffering for it
+        with self.cond:
+            self.detached = True
+            self.chunks.clear()
+            self.buffered = 0
+
+    def close(self):
+        with self.cond:
+            self.ended = True
+            self.cond.notify_all()
+
+    def read(self, size=CHUNK_SIZE):
+        with self.cond:
+            while not self.chunks and not self.detached and not self.ended:
+                self.cond.wait()
+            if self.chunks:
+                chunk = self.chunks.popleft()
+                self.buffered -= len(chunk)
+                self.position += len(chunk)
+                return chunk
+            if not self.detached:
+                return b""
+        if self.reader is None:
+            self.reader = SpoolReader(self.spool, self.position)
+        return self.reader.read(size)
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+# Sinks receive the archive through begin/write and keep it under a temporary name until commit
+
+class LocalSink:
+    from_file = False
+
+    def __init__(self, name, settings, config):
+        self.directory = settings["path"]
+        self.file = None
+
+    def begin(self, filename):
+        os.makedirs(self.directory, exist_ok=True)
+        self.target = os.path.join(self.directory, filename)
+        self.temp = self.target + ".part"
+        self.file = open(self.temp, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp, self.target)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.temp)
+
+class S3Sink:
+    from_file = False
+
+    def __init__(self, name, settings, config):
+        # boto3 is only needed when an S3 destination is configured
+        import boto3
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=settings.get("endpoint_url"),
+            region_name=settings.get("region"),
+            aws_access_key_id=settings.get("access_key"),
+            aws_secret_access_key=settings.get("secret_key"),
+        )
+        self.bucket = settings["bucket"]
+        self.prefix = settings.get("prefix", "")
+        # S3 requires at least 5 MB for every part but the last
+        self.part_size = max(int(settings.get("part_size_mb", 16)), 5) * 1024 * 1024
+        self.upload_id = None
+
+    def begin(self, filename):
+        self.key = self.prefix + filename
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+
+    def _upload_part(self, body):
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def commit(self):
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": self.parts})
+        self.upload_id = None
+
+    def abort(self):
+        if self.upload_id is not None:
+            upload_id, self.upload_id = self.upload_id, None
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+
+class SftpSink:
+    from_file = False
+
+    def __init__(self, name, settings, config):
+        # paramiko is only needed when an SFTP destination is configured
+        import paramiko
+        self.paramiko = paramiko
+        self.settings = settings
+        self.client = None
+        self.file = None
+
+    def begin(self, filename):
+        settings = self.settings
+        self.client = self.paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        if settings.get("host_key_policy") == "auto_add":
+            self.client.set_missing_host_key_policy(self.paramiko.AutoAddPolicy())
+        self.client.connect(settings["host"], port=int(settings.get("port", 22)), username=settings.get("username"),
+                            password=settings.get("password"), key_filename=settings.get("key_file"), timeout=30)
+        self.sftp = self.client.open_sftp()
+        self.target = posixpath.join(settings.get("path", "."), filename)
+        self.temp = self.target + ".part"
+        self.file = self.sftp.open(self.temp, 'wb')
+        self.file.set_pipelined(True)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        self.file = None
+        self.sftp.posix_rename(self.temp, self.target)
+        self._disconnect()
+
+    def abort(self):
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.sftp.remove(self.temp)
+        finally:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+class TelegramSink:
+    # Telegram needs the file size up front, so the document is sent from the finished archive
+    from_file = True
+
+    def __init__(self, name, settings, config):
+        self.settings = settings
+        self.config = config
+
+    def send(self, path, caption, rate_limit_kb):
+        send_document_sync(self.config, path, caption, chat_id=self.settings.get("chat_id"), rate_limit_kb=rate_limit_kb)
+
+SINK_TYPES = {
+    "local": LocalSink,
+    "s3": S3Sink,
+    "sftp": SftpSink,
+    "telegram": TelegramSink,
+}
+
+class Destination:
+    def __init__(self, name, config):
+        self.name = name
+        settings = config.get("backup_destinations", {}).get(name)
+        if settings is None and name == "telegram":
+            settings = {"type": "telegram"}
+        self.type = (settings or {}).get("type", "?")
+        self.retries = max(int((settings or {}).get("retries", config.get("backup_destination_retries", DEFAULT_SETTINGS["backup_destination_retries"]))), 1)
+        buffer_mb = (settings or {}).get("buffer_mb", config.get("backup_fanout_buffer_mb", DEFAULT_SETTINGS["backup_fanout_buffer_mb"]))
+        self.buffer_limit = int(buffer_mb * 1024 * 1024)
+        self.status = "pending"
+        self.error = None
+        self.attempts = 0
+        self.seconds = 0.0
+        self.sent = 0
+        self.feed = None
+        self.sink = None
+        try:
+            if settings is None:
+                raise ValueError("not configured in backup_destinations")
+            if self.type not in SINK_TYPES:
+                raise ValueError(f"unknown destination type {self.type}")
+            self.sink = SINK_TYPES[self.type](name, settings, config)
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+
+    def _stream(self, stream, filename, fanout):
+        self.sink.begin(filename)
+        self.sent = 0
+        while chunk := stream.read():
+            self.sink.write(chunk)
+            self.sent += len(chunk)
+        if not fanout.wait_for_archive():
+            self.sink.abort()
+            return False
+        self.sink.commit()
+        return True
+
+    def run(self, fanout):
+        started = time.monotonic()
+        for attempt in range(1, self.retries + 1):
+            self.attempts = attempt
+            # The first attempt follows the live stream; retries start over from the spool file
+            stream = None
+            if not self.sink.from_file:
+                stream = self.feed if attempt == 1 else SpoolReader(fanout.spool)
+            try:
+                if self.sink.from_file:
+                    if not fanout.wait_for_archive():
+                        self.status = "aborted"
+                        break
+                    self.sink.send(fanout.spool.path, fanout.caption, fanout.rate_limit_kb)
+                    self.sent = os.path.getsize(fanout.spool.path)
+                elif not self._stream(stream, os.path.basename(fanout.spool.path), fanout):
+                    self.status = "aborted"
+                    break
+                self.status = "ok"
+                break
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}"
+                if stream is not None:
+                    if stream is self.feed:
+                        self.feed.abandon()
+                    with contextlib.suppress(Exception):
+                        self.sink.abort()
+                if attempt < self.retries:
+                    time.sleep(min(2 ** attempt, 60))
+            finally:
+                if stream is None:
+                    pass
+                elif stream is self.feed:
+                    self.feed.close_reader()
+                else:
+                    stream.close()
+        else:
+            self.status = "failed"
+        self.seconds = time.monotonic() - started
+
+    def report(self):
+        if self.status == "ok":
+            megabytes = self.sent / 1024 ** 2
+            line = f"{self.name} ({self.type}): ok in {self.seconds:.1f}s, {megabytes:.1f} MB ({megabytes / max(self.seconds, 1e-6):.1f} MB/s)"
+            if self.feed is not None and self.feed.detached and self.attempts == 1:
+                line += ", caught up from disk"
+            if self.attempts > 1:
+                line += f", {self.attempts} attempts"
+            return line
+        if self.status == "aborted":
+            return f"{self.name} ({self.type}): not sent, the archive was incomplete"
+        if self.attempts == 0:
+            return f"{self.name} ({self.type}): not set up: {self.error}"
+        return f"{self.name} ({self.type}): failed after {self.attempts} attempts in {self.seconds:.1f}s: {self.error}"
+
+class FanOut:
+    def __init__(self, path, destinations, caption="", rate_limit_kb=0):
+        self.path = path
+        self.destinations = destinations
+        self.caption = caption
+        self.rate_limit_kb = rate_limit_kb
+        self.spool = None
+        self.archive_ok = False
+        self.archive_done = threading.Event()
+
+    def wait_for_archive(self):
+        self.archive_done.wait()
+        return self.archive_ok
+
+    def run(self, source, status_file):
+        self.spool = Spool(self.path)
+        active = [destination for destination in self.destinations if destination.sink is not None]
+        feeds = []
+        for destination in active:
+            if not destination.sink.from_file:
+                destination.feed = Feed(self.spool, destination.buffer_limit)
+                feeds.append(destination.feed)
+        threads = [threading.Thread(target=destination.run, args=(self,), name=f"upload-{destination.name}", daemon=True)
+                   for destination in active]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while chunk := source.read(CHUNK_SIZE):
+                self.spool.write(chunk)
+                for feed in feeds:
+                    feed.offer(chunk)
+            self.spool.finish()
+            # backup.sh writes the exit status of the archive pipeline before closing the stream
+            with open(status_file) as file:
+                self.archive_ok = file.read().strip() == "0"
+        except OSError as e:
+            print(f"Error writing {self.path}: {e}", file=sys.stderr)
+        finally:
+            self.spool.finish()
+            for feed in feeds:
+                feed.close()
+            self.archive_done.set()
+        for thread in threads:
+            thread.join()
+        return self.archive_ok and all(destination.status == "ok" for destination in self.destinations)
+
+def _load_config():
+    with open(CONFIG_FILE_PATH, 'r') as file:
+        return json.load(file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a backup stream from stdin to the archive file and upload it to several destinations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    send_parser = subparsers.add_parser("send")
+    send_parser.add_argument("--file", required=True, help="Local archive file to write")
+    send_parser.add_argument("--status-file", required=True, help="File holding the exit status of the archive pipeline")
+    send_parser.add_argument("--caption", default="")
+    send_parser.add_argument("--rate-limit-kb", type=int, default=0)
+    send_parser.add_argument("--report", help="Write the per-destination report to this file")
+    send_parser.add_argument("destinations", nargs="+")
+    args = parser.parse_args()
+
+    config = _load_config()
+    destinations = [Destination(name, config) for name in args.destinations if name != "local"]
+    fanout = FanOut(args.file, destinations, args.caption, args.rate_limit_kb)
+    ok = fanout.run(sys.stdin.buffer, args.status_file)
+
+    lines = ["Destinations:"]
+    if "local" in args.destinations:
+        lines.append(f"local: {args.file}")
+    lines += [destination.report() for destination in destinations]
+    report = "\n".join(lines)
+    print(report)
+    if args.report:
+        with open(args.report, 'w') as file:
+            file.write(report + "\n")
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 import os
 import asyncio
-import subprocess
 from aiogram import Router, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram import Dispatcher
-from config import save_config, load_config
+from config import save_config, load_config, ADMIN_CHAT_ID
+from outbox import get_outbox
+from reports import get_report_renderer, report_range, REPORT_FORMATS
+from physical_restore import is_physical_backup, restore_physical_backup
+from crypto_stream import ENCRYPTED_SUFFIX, DecryptionError, verify_file, decrypt_command
+from selective_restore import RESTORE_DIR, BackupArchive, archive_kind, restore_entries, restore_entry
+from monitoring import get_monitor, format_profile
 
 # Define states
 class BackupStates(StatesGroup):
@@ -16,9 +21,26 @@ class BackupStates(StatesGroup):
 class ReportIntervalStates(StatesGroup):
     waiting_for_interval = State()
 
+class UsageReportStates(StatesGroup):
+    waiting_for_range = State()
+
+class SelectiveRestoreStates(StatesGroup):
+    waiting_for_archive = State()
+    waiting_for_selection = State()
+
+# Inline keyboards are limited to 100 buttons; further entries can be typed by name
+MAX_RESTORE_BUTTONS = 90
+
+# Archives opened for selective restore, per chat: (path, BackupArchive, lock)
+open_archives = {}
+
 # Create a router instance
 router = Router()
 
+# Works for messages and callback queries alike
+def is_admin(message: types.Message):
+    return str(message.from_user.id) == str(ADMIN_CHAT_ID)
+
 # Create a keyboard markup with the three buttons in a single row
 keyboard = types.ReplyKeyboardMarkup(
     keyboard=[
@@ -28,40 +50,78 @@ keyboard = types.ReplyKeyboardMarkup(
             types.KeyboardButton(text="بکاپ فوری")
         ,   
         ],
-        [types.KeyboardButton(text="تغییر زمان گزارش مصرف کاربران")]
+        [types.KeyboardButton(text="تغییر زمان گزارش مصرف کاربران")],
+        [types.KeyboardButton(text="دریافت گزارش مصرف")],
+        [types.KeyboardButton(text="بازیابی انتخابی")]
     ],
     resize_keyboard=True
 )
 
 @router.message(Command("start"))
 async def send_welcome(message: types.Message):
-    await message.reply("به ربات MarzBackup خوش آمدید! لطفاً یکی از گزینه‌های زیر را انتخاب کنید:", reply_markup=keyboard)
+    get_outbox().send_message(message.chat.id, "به ربات MarzBackup خوش آمدید! لطفاً یکی از گزینه‌های زیر را انتخاب کنید:", reply_to_message_id=message.message_id, reply_markup=keyboard)
 
 @router.message(F.text == "بکاپ فوری")
 async def handle_get_backup(message: types.Message):
     try:
-        result = subprocess.run(['/bin/bash', '/opt/MarzBackup/backup.sh'], capture_output=True, text=True)
-        if result.returncode == 0:
-            await message.answer("پشتیبان‌گیری با موفقیت انجام شد و فایل ارسال گردید.")
+        # Run the backup without blocking the event loop for its whole duration
+        process = await asyncio.create_subprocess_exec(
+            '/bin/bash', '/opt/MarzBackup/backup.sh',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode == 0:
+            get_outbox().send_message(message.chat.id, "پشتیبان‌گیری با موفقیت انجام شد و فایل ارسال گردید.")
         else:
-            await message.answer(f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {result.stderr}")
+            get_outbox().send_message(message.chat.id, f"خطایی در فرآیند پشتیبان‌گیری رخ داد: {stderr.decode()}")
     except Exception as e:
-        await message.answer(f"خطا در پشتیبان‌گیری: {e}")
+        get_outbox().send_message(message.chat.id, f"خطا در پشتیبان‌گیری: {e}")
 
 @router.message(F.text == "فاصله زمانی بکاپ")
 async def set_backup(message: types.Message, state: FSMContext):
     await state.set_state(BackupStates.waiting_for_schedule)
-    await message.answer("لطفاً زمانبندی پشتیبان‌گیری را به صورت دقیقه ارسال کنید (مثال: '60' برای هر 60 دقیقه یکبار).")
+    get_outbox().send_message(message.chat.id, "لطفاً زمانبندی پشتیبان‌گیری را به صورت دقیقه ارسال کنید (مثال: '60' برای هر 60 دقیقه یکبار).")
 
-def update_cron_job(interval):
-    cron_schedule = f"*/{interval} * * * *"
-    cron_command = f"/bin/bash /opt/MarzBackup/backup.sh"
-    
-    # Remove existing cron job
-    subprocess.run("crontab -l | grep -v '/opt/MarzBackup/backup.sh' | crontab -", shell=True)
-    
-    # Add new cron job
-    subprocess.run(f"(crontab -l ; echo '{cron_schedule} {cron_command}') | crontab -", shell=True)
+def cron_schedule(minutes):
+    if minutes < 60:
+        return f"*/{minutes} * * * *"
+    if minutes < 1440:
+        return f"0 */{max(round(minutes / 60), 1)} * * *"
+    return f"30 3 */{max(round(minutes / 1440), 1)} * *"
+
+async def run_shell(command):
+    # Shell-outs from handlers run as subprocesses of the event loop so they never block it
+    process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    return stdout.decode()
+
+async def get_backup_tiers():
+    # backup.sh owns the tier policies; ask it for each tier's interval
+    output = await run_shell("/bin/bash /opt/MarzBackup/backup.sh --list-tiers")
+    tiers = {}
+    for line in output.splitlines():
+        name, _, interval = line.partition(' ')
+        if interval.strip().isdigit():
+            tiers[name] = int(interval)
+    return tiers
+
+async def update_cron_job(interval):
+    # Under the supervisor the backup scheduler reads the intervals from the config on every tick
+    if os.environ.get("MARZBACKUP_SUPERVISED") == "1":
+        return
+
+    # Remove existing cron jobs for every tier
+    await run_shell("crontab -l | grep -v '/opt/MarzBackup/backup.sh' | crontab -")
+
+    tiers = await get_backup_tiers()
+    tiers["critical"] = interval
+    for tier, minutes in tiers.items():
+        cron_command = "/bin/bash /opt/MarzBackup/backup.sh"
+        if tier != "critical":
+            cron_command += f" --tier {tier}"
+        # Add new cron job
+        await run_shell(f"(crontab -l ; echo '{cron_schedule(minutes)} {cron_command}') | crontab -")
 
 @router.message(BackupStates.waiting_for_schedule)
 async def process_schedule(message: types.Message, state: FSMContext):
@@ -75,29 +135,34 @@ async def process_schedule(message: types.Message, state: FSMContext):
         save_config(config)
         
         # Update cron job
-        update_cron_job(minutes)
+        await update_cron_job(minutes)
         
-        await message.answer(f"زمانبندی پشتیبان‌گیری به هر {minutes} دقیقه یکبار تنظیم شد.")
+        get_outbox().send_message(message.chat.id, f"زمانبندی پشتیبان‌گیری به هر {minutes} دقیقه یکبار تنظیم شد.")
     except ValueError:
-        await message.answer("لطفاً یک عدد صحیح مثبت برای دقیقه وارد کنید.")
+        get_outbox().send_message(message.chat.id, "لطفاً یک عدد صحیح مثبت برای دقیقه وارد کنید.")
     except Exception as e:
-        await message.answer(f"خطا در پردازش زمانبندی: {e}")
+        get_outbox().send_message(message.chat.id, f"خطا در پردازش زمانبندی: {e}")
     finally:
         await state.clear()
 
 @router.message(F.text == "بازیابی بکاپ")
 async def request_sql_file(message: types.Message, state: FSMContext):
     await state.set_state(BackupStates.waiting_for_sql_file)
-    await message.answer("لطفاً فایل SQL پشتیبان را ارسال کنید.")
+    get_outbox().send_message(message.chat.id, "لطفاً فایل SQL پشتیبان یا آرشیو پشتیبان فیزیکی (zip، tar.gz یا tar.zst) را ارسال کنید.")
 
 @router.message(BackupStates.waiting_for_sql_file)
 async def process_sql_file(message: types.Message, state: FSMContext):
     if not message.document:
-        await message.answer("لطفاً یک فایل ارسال کنید.")
+        get_outbox().send_message(message.chat.id, "لطفاً یک فایل ارسال کنید.")
         return
     
-    if not message.document.file_name.lower().endswith('.sql'):
-        await message.answer("فایل ارسالی معتبر نیست. لطفاً یک فایل با پسوند .sql ارسال کنید.")
+    file_name = message.document.file_name.lower()
+    encrypted = file_name.endswith(ENCRYPTED_SUFFIX)
+    if encrypted:
+        file_name = file_name[:-len(ENCRYPTED_SUFFIX)]
+    is_archive = file_name.endswith(('.zip', '.tar.gz', '.tgz', '.tar.zst'))
+    if not file_name.endswith('.sql') and not is_archive:
+        get_outbox().send_message(message.chat.id, "فایل ارسالی معتبر نیست. لطفاً یک فایل با پسوند .sql، .zip، .tar.gz یا .tar.zst (یا .enc) ارسال کنید.")
         return
 
     try:
@@ -113,38 +178,59 @@ async def process_sql_file(message: types.Message, state: FSMContext):
         file_path = os.path.join(backup_dir, message.document.file_name)
         await message.bot.download_file(file.file_path, file_path)
 
+        # Authenticate every chunk of an encrypted backup before anything is restored
+        if encrypted:
+            get_outbox().send_message(message.chat.id, "در حال بررسی صحت فایل رمزنگاری‌شده...")
+            await asyncio.to_thread(verify_file, file_path, config)
+
+        # Archives are read in place, decrypting on the fly when needed
+        if is_archive:
+            if not await asyncio.to_thread(is_physical_backup, file_path):
+                get_outbox().send_message(message.chat.id, "آرشیو ارسالی شامل پشتیبان فیزیکی نیست.")
+                return
+            get_outbox().send_message(message.chat.id, "در حال آماده‌سازی و بازیابی پشتیبان فیزیکی...")
+            previous_dir = await restore_physical_backup(file_path)
+            get_outbox().send_message(message.chat.id, f"بازیابی پشتیبان فیزیکی با موفقیت انجام شد. دیتابیس قبلی در {previous_dir} نگهداری شد.")
+            return
+
         # Extract database information from config
         db_container = config.get("db_container")
         db_password = config.get("db_password")
         db_name = config.get("db_name")
 
         if not db_container or not db_password or not db_name:
-            await message.answer("اطلاعات پایگاه داده در فایل کانفیگ یافت نشد.")
+            get_outbox().send_message(message.chat.id, "اطلاعات پایگاه داده در فایل کانفیگ یافت نشد.")
             return
 
-        # Restore the database
-        restore_command = f"docker exec -i {db_container} mariadb -u root -p{db_password} {db_name} < {file_path}"
-        process = await asyncio.create_subprocess_shell(
-            restore_command,
+        # Restore the database; encrypted dumps are decrypted on the way into the container
+        restore_command = f"docker exec -i {db_container} mariadb -u root -p{db_password} {db_name}"
+        if encrypted:
+            restore_command = f"set -o pipefail; {decrypt_command(file_path)} | {restore_command}"
+        else:
+            restore_command = f"{restore_command} < {file_path}"
+        process = await asyncio.create_subprocess_exec(
+            "/bin/bash", "-c", restore_command,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
         stdout, stderr = await process.communicate()
 
         if process.returncode == 0:
-            await message.answer("بازیابی پایگاه داده با موفقیت انجام شد.")
+            get_outbox().send_message(message.chat.id, "بازیابی پایگاه داده با موفقیت انجام شد.")
         else:
-            await message.answer(f"خطا در بازیابی پایگاه داده: {stderr.decode()}")
+            get_outbox().send_message(message.chat.id, f"خطا در بازیابی پایگاه داده: {stderr.decode()}")
 
+    except DecryptionError as e:
+        get_outbox().send_message(message.chat.id, f"فایل رمزنگاری‌شده معتبر نیست و بازیابی انجام نشد: {e}")
     except Exception as e:
-        await message.answer(f"خطا در پردازش فایل SQL: {e}")
+        get_outbox().send_message(message.chat.id, f"خطا در پردازش فایل SQL: {e}")
     finally:
         await state.clear()
 
 @router.message(F.text == "تغییر زمان گزارش مصرف کاربران")
 async def change_report_interval(message: types.Message, state: FSMContext):
     await state.set_state(ReportIntervalStates.waiting_for_interval)
-    await message.answer("لطفا زمان گزارش مصرف کاربران را بر اساس دقیقه وارد کنید (توجه کنید مدت زمان‌های پایین باعث افزایش حجم پایگاه داده می‌شود. عدد پیشنهادی 60 است):")
+    get_outbox().send_message(message.chat.id, "لطفا زمان گزارش مصرف کاربران را بر اساس دقیقه وارد کنید (توجه کنید مدت زمان‌های پایین باعث افزایش حجم پایگاه داده می‌شود. عدد پیشنهادی 60 است):")
 
 @router.message(ReportIntervalStates.waiting_for_interval)
 async def process_report_interval(message: types.Message, state: FSMContext):
@@ -166,13 +252,193 @@ async def process_report_interval(message: types.Message, state: FSMContext):
         stdout, stderr = await process.communicate()
         
         if process.returncode == 0:
-            await message.answer(f"زمان گزارش مصرف کاربران به {interval} دقیقه تغییر یافت و سیستم گزارش‌گیری مجدداً راه‌اندازی شد.")
+            get_outbox().send_message(message.chat.id, f"زمان گزارش مصرف کاربران به {interval} دقیقه تغییر یافت و سیستم گزارش‌گیری مجدداً راه‌اندازی شد.")
         else:
-            await message.answer(f"خطا در تنظیم زمان گزارش: {stderr.decode()}")
+            get_outbox().send_message(message.chat.id, f"خطا در تنظیم زمان گزارش: {stderr.decode()}")
     except ValueError:
-        await message.answer("لطفاً یک عدد صحیح مثبت وارد کنید.")
+        get_outbox().send_message(message.chat.id, "لطفاً یک عدد صحیح مثبت وارد کنید.")
     finally:
         await state.clear()
 
+@router.message(F.text == "دریافت گزارش مصرف")
+async def request_usage_report(message: types.Message, state: FSMContext):
+    if not is_admin(message):
+        return
+    await state.set_state(UsageReportStates.waiting_for_range)
+    get_outbox().send_message(message.chat.id, "لطفاً بازه گزارش را به ساعت، فرمت (png، csv یا xlsx) و در صورت نیاز نام کاربری را وارد کنید. مثال: '24 png' یا '168 xlsx user1'")
+
+@router.message(UsageReportStates.waiting_for_range)
+async def process_usage_report(message: types.Message, state: FSMContext):
+    if not is_admin(message):
+        return
+    await state.clear()
+    parts = (message.text or "").split()
+    try:
+        hours = int(parts[0])
+        report_format = parts[1].lower() if len(parts) > 1 else "png"
+        username_filter = parts[2] if len(parts) > 2 else None
+        if hours <= 0 or report_format not in REPORT_FORMATS:
+            raise ValueError
+    except (ValueError, IndexError):
+        get_outbox().send_message(message.chat.id, "ورودی نامعتبر است. مثال: '24 png' یا '168 xlsx user1'")
+        return
+
+    get_outbox().send_message(message.chat.id, "در حال تهیه گزارش...")
+    try:
+        start, end = report_range(hours, load_config().get('report_interval', 60))
+        renderer = get_report_renderer()
+        path = await renderer.render(start, end, report_format, username_filter)
+        caption = f"گزارش مصرف از {start:%Y-%m-%d %H:%M} تا {end:%Y-%m-%d %H:%M}"
+        if username_filter:
+            caption += f" ({username_filter})"
+        try:
+            sent = get_outbox().send_document(message.chat.id, types.FSInputFile(path), caption=caption)
+        except Exception:
+            renderer.release(path)
+            raise
+        # Keep the file out of cache eviction until the outbox has sent it
+        sent.add_done_callback(lambda _: renderer.release(path))
+    except LookupError:
+        get_outbox().send_message(message.chat.id, "در این بازه داده‌ای برای گزارش وجود ندارد.")
+    except Exception as e:
+        get_outbox().send_message(message.chat.id, f"خطا در تهیه گزارش: {e}")
+
+def restore_menu(entries):
+    rows = [
+        [types.InlineKeyboardButton(text=entry["label"], callback_data=f"restore:{index}")]
+        for index, entry in enumerate(entries[:MAX_RESTORE_BUTTONS])
+    ]
+    rows.append([types.InlineKeyboardButton(text="پایان", callback_data="restore:done")])
+    return types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+def get_open_archive(chat_id, path):
+    current = open_archives.get(chat_id)
+    if current and current[0] == path:
+        return current
+    close_archive(chat_id)
+    open_archives[chat_id] = (path, BackupArchive(path, load_config()), asyncio.Lock())
+    return open_archives[chat_id]
+
+def close_archive(chat_id, remove=False):
+    current = open_archives.pop(chat_id, None)
+    if current:
+        current[1].close()
+        if remove and os.path.exists(current[0]):
+            os.remove(current[0])
+
+@router.message(F.text == "بازیابی انتخابی")
+async def request_selective_archive(message: types.Message, state: FSMContext):
+    if not is_admin(message):
+        return
+    await state.set_state(SelectiveRestoreStates.waiting_for_archive)
+    get_outbox().send_message(message.chat.id, "لطفاً فایل پشتیبان کامل (zip، tar.gz یا tar.zst، رمزنگاری‌شده یا بدون رمز) را ارسال کنید.")
+
+@router.message(SelectiveRestoreStates.waiting_for_archive)
+async def process_selective_archive(message: types.Message, state: FSMContext):
+    if not is_admin(message):
+        return
+    if not message.document:
+        get_outbox().send_message(message.chat.id, "لطفاً یک فایل ارسال کنید.")
+        return
+    try:
+        archive_kind(message.document.file_name.lower())
+    except ValueError:
+        get_outbox().send_message(message.chat.id, "فایل ارسالی معتبر نیست. لطفاً فایل پشتیبان zip، tar.gz یا tar.zst ارسال کنید.")
+        return
+
+    try:
+        os.makedirs(RESTORE_DIR, exist_ok=True)
+        file = await message.bot.get_file(message.document.file_id)
+        file_path = os.path.join(RESTORE_DIR, os.path.basename(message.document.file_name))
+        await message.bot.download_file(file.file_path, file_path)
+
+        # Only the archive index (and the manifest) is read here
+        _, archive, lock = get_open_archive(message.chat.id, file_path)
+        async with lock:
+            entries = await asyncio.to_thread(restore_entries, archive)
+        if not entries:
+            close_archive(message.chat.id, remove=True)
+            get_outbox().send_message(message.chat.id, "موردی برای بازیابی در این فایل یافت نشد.")
+            await state.clear()
+            return
+
+        await state.update_data(archive=file_path, entries=entries)
+        await state.set_state(SelectiveRestoreStates.waiting_for_selection)
+        text = "مورد مورد نظر برای بازیابی را انتخاب کنید:"
+        if len(entries) > MAX_RESTORE_BUTTONS:
+            text += f"\n(فقط {MAX_RESTORE_BUTTONS} مورد اول نمایش داده شده است؛ برای موارد دیگر نام آن را ارسال کنید)"
+        get_outbox().send_message(message.chat.id, text, reply_markup=restore_menu(entries))
+    except DecryptionError as e:
+        close_archive(message.chat.id, remove=True)
+        get_outbox().send_message(message.chat.id, f"فایل رمزنگاری‌شده قابل خواندن نیست: {e}")
+        await state.clear()
+    except Exception as e:
+        close_archive(message.chat.id, remove=True)
+        get_outbox().send_message(message.chat.id, f"خطا در خواندن فایل پشتیبان: {e}")
+        await state.clear()
+
+async def run_selective_restore(chat_id, entry, archive_path):
+    get_outbox().send_message(chat_id, f"در حال بازیابی {entry['label']}...")
+    try:
+        _, archive, lock = get_open_archive(chat_id, archive_path)
+        async with lock:
+            await asyncio.to_thread(restore_entry, archive, entry, load_config())
+        get_outbox().send_message(chat_id, f"{entry['label']} با موفقیت بازیابی شد.")
+    except DecryptionError as e:
+        get_outbox().send_message(chat_id, f"فایل رمزنگاری‌شده معتبر نیست و بازیابی انجام نشد: {e}")
+    except Exception as e:
+        get_outbox().send_message(chat_id, f"خطا در بازیابی {entry['label']}: {e}")
+
+@router.callback_query(SelectiveRestoreStates.waiting_for_selection, F.data.startswith("restore:"))
+async def process_restore_selection(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    if not is_admin(callback):
+        return
+    chat_id = callback.message.chat.id
+    data = await state.get_data()
+    choice = callback.data.split(":", 1)[1]
+    if choice == "done":
+        close_archive(chat_id, remove=True)
+        await state.clear()
+        get_outbox().send_message(chat_id, "بازیابی انتخابی به پایان رسید.", reply_markup=keyboard)
+        return
+    await run_selective_restore(chat_id, data["entries"][int(choice)], data["archive"])
+
+@router.message(SelectiveRestoreStates.waiting_for_selection)
+async def process_restore_selection_text(message: types.Message, state: FSMContext):
+    if not is_admin(message):
+        return
+    data = await state.get_data()
+    name = (message.text or "").strip()
+    for entry in data["entries"]:
+        if name in (entry["label"], entry["member"]):
+            await run_selective_restore(message.chat.id, entry, data["archive"])
+            return
+    get_outbox().send_message(message.chat.id, "این مورد در فایل پشتیبان وجود ندارد. یکی از گزینه‌ها را انتخاب کنید یا نام دقیق آن را ارسال کنید.")
+
+@router.message(Command("stats"))
+async def handle_stats(message: types.Message):
+    if not is_admin(message):
+        return
+    get_outbox().send_message(message.chat.id, get_monitor().stats_text())
+
+@router.message(Command("profile"))
+async def handle_profile(message: types.Message):
+    if not is_admin(message):
+        return
+    parts = (message.text or "").split()
+    try:
+        seconds = int(parts[1]) if len(parts) > 1 else 30
+    except ValueError:
+        get_outbox().send_message(message.chat.id, "استفاده: /profile [ثانیه]")
+        return
+
+    get_outbox().send_message(message.chat.id, f"در حال پروفایل‌گیری از ربات به مدت {seconds} ثانیه...")
+    try:
+        seconds, report = await get_monitor().profile(seconds)
+        get_outbox().send_message(message.chat.id, f"نتیجه پروفایل {seconds} ثانیه:\n{format_profile(report)}")
+    except RuntimeError as e:
+        get_outbox().send_message(message.chat.id, f"خطا در پروفایل‌گیری: {e}")
+
 def register_handlers(dp: Dispatcher):
     dp.include_router(router)
@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 import pytz
 import traceback
 import os
+from anomaly import UsageAnomalyDetector, parse_table, send_admin_alert
 
 CONFIG_FILE_PATH = "/opt/marzbackup/config.json"
 SQL_FILE_PATH = "/opt/MarzBackup/hourlyUsage.sql"  # Path to hourlyUsage.sql
@@ -22,6 +23,14 @@ REPORT_INTERVAL = config.get('report_interval', 60)  # Default to 60 minutes if
 if not all([DB_CONTAINER, DB_PASSWORD]):
     raise ValueError("Missing database configuration in config file")
 
+def refresh_config():
+    # Long-running callers (the supervisor) pick up config changes before each run
+    global config, DB_CONTAINER, DB_PASSWORD, REPORT_INTERVAL
+    config = load_config()
+    DB_CONTAINER = config.get('db_container')
+    DB_PASSWORD = config.get('db_password')
+    REPORT_INTERVAL = config.get('report_interval', 60)
+
 # Set Tehran timezone
 tehran_tz = pytz.timezone('Asia/Tehran')
 
@@ -46,6 +55,17 @@ def execute_sql_file(sql_file_path):
         print(f"Error output: {e.stderr}")
         return None
 
+def execute_sql_script(sql):
+    # Feed a multi-statement script through stdin instead of the command line
+    full_command = ["docker", "exec", "-i", DB_CONTAINER, "mariadb", "-u", "root", f"-p{DB_PASSWORD}", "UserUsageAnalytics"]
+    try:
+        result = subprocess.run(full_command, input=sql, check=True, capture_output=True, text=True)
+        return result.stdout
+    except subprocess.CalledProcessError as e:
+        print(f"An error occurred: {e}")
+        print(f"Error output: {e.stderr}")
+        return None
+
 def update_database_structure():
     if not os.path.exists(SQL_FILE_PATH):
         print(f"SQL file not found: {SQL_FILE_PATH}")
@@ -81,6 +101,27 @@ def calculate_and_display_usage():
         print(f"Usage in the last period:\n{result}")
     else:
         print("Failed to calculate usage")
+    return result
+
+def get_quota_usage():
+    sql = "SELECT id AS user_id, used_traffic, data_limit FROM v_users WHERE data_limit > 0;"
+    result = execute_sql(sql)
+    if result is None:
+        return {}
+    return {row['user_id']: (int(row['used_traffic']), int(row['data_limit'])) for row in parse_table(result)}
+
+def detect_usage_anomalies(period_output):
+    detect_anomalies_in_rows(parse_table(period_output))
+
+def detect_anomalies_in_rows(rows):
+    if not rows:
+        return
+    detector = UsageAnomalyDetector(config)
+    alerts = detector.process_period(rows, get_quota_usage())
+    detector.save()
+    if alerts:
+        print(f"Detected {len(alerts)} usage anomalies")
+        send_admin_alert(config, alerts)
 
 def cleanup_old_data():
     now = datetime.now(tehran_tz)
@@ -113,9 +154,10 @@ def is_within_schedule():
     seconds_past_minute = now.second
     return minutes_past_hour == 0 and seconds_past_minute < 60  # Allow execution within the first minute of each interval
 
-def run_tasks():
+def run_tasks(scheduled=False):
+    # `scheduled` is set by the supervisor, which already starts us on the interval boundary
     now = datetime.now(tehran_tz)
-    if not is_within_schedule():
+    if not scheduled and not is_within_schedule():
         print(f"Current time {now} is outside the scheduled execution window. Skipping execution.")
         return
 
@@ -123,7 +165,9 @@ def run_tasks():
     try:
         if update_database_structure():
             insert_usage_data()
-            calculate_and_display_usage()
+            period_output = calculate_and_display_usage()
+            if period_output and config.get('anomaly_detection', True):
+                detect_usage_anomalies(period_output)
             if should_run_cleanup():
                 cleanup_old_data()
         else:
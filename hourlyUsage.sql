@@ -40,9 +40,20 @@ CREATE TABLE IF NOT EXISTS PeriodicUsage (
     INDEX idx_report_number (report_number)
 );
 
+-- Per-period uplink/downlink split, written when usage comes from the Xray stats API
+CREATE TABLE IF NOT EXISTS PeriodicTraffic (
+    user_id INT NOT NULL,
+    report_number INT NOT NULL,
+    uplink BIGINT NOT NULL,
+    downlink BIGINT NOT NULL,
+    timestamp DATETIME NOT NULL,
+    PRIMARY KEY (user_id, report_number),
+    INDEX idx_timestamp (timestamp)
+);
+
 -- Create or replace the view that links to the users table in the main database
 CREATE OR REPLACE SQL SECURITY INVOKER VIEW v_users AS
-SELECT id, username, used_traffic
+SELECT id, username, used_traffic, data_limit
 FROM marzban.users;
 
 -- Create or replace procedure to insert current usage for all users
@@ -112,6 +123,9 @@ BEGIN
     
     DELETE FROM PeriodicUsage
     WHERE timestamp < DATE_SUB(p_current_time, INTERVAL 1 YEAR);
+
+    DELETE FROM PeriodicTraffic
+    WHERE timestamp < DATE_SUB(p_current_time, INTERVAL 1 YEAR);
     
     INSERT INTO CleanupLog (cleanup_time) VALUES (p_current_time);
 END //
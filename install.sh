@@ -132,7 +132,7 @@ sudo apt update
 
 # Install required packages
 echo "Installing required packages..."
-sudo apt install -y python3 python3-pip git
+sudo apt install -y python3 python3-pip git jq pv
 
 # Clone or update the repository
 if [ -d "$INSTALL_DIR" ]; then
@@ -1,10 +1,16 @@
 import logging
 import sys
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters.command import Command
 from config import load_config, save_config, DB_NAME, DB_CONTAINER, DB_PASSWORD, DB_TYPE
 from handlers import register_handlers
+from outbox import setup_outbox
+from webhook import run_webhook
+from reports import get_report_renderer
+from monitoring import setup_monitor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,10 +24,15 @@ if not API_TOKEN or not ADMIN_CHAT_ID:
     logging.error("API_TOKEN or ADMIN_CHAT_ID is missing. Please run setup.py first.")
     sys.exit(1)
 
-# Initialize bot and dispatcher
-bot = Bot(token=API_TOKEN)
+# Initialize bot and dispatcher; bot_api_server points the bot at a local Bot API server or stand-in
+session = None
+if config.get('bot_api_server'):
+    session = AiohttpSession(api=TelegramAPIServer.from_base(config['bot_api_server']))
+bot = Bot(token=API_TOKEN, session=session)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+outbox = setup_outbox(bot, config)
+monitor = setup_monitor(dp, config)
 
 async def validate_config():
     config = load_config()
@@ -68,8 +79,15 @@ async def validate_config():
         logging.info("Config file is up to date")
 
 async def on_startup(bot: Bot):
+    outbox.start()
+    monitor.start()
     await validate_config()
-    await bot.send_message(chat_id=ADMIN_CHAT_ID, text="MarzBackup bot has been successfully started!")
+    outbox.send_message(ADMIN_CHAT_ID, "MarzBackup bot has been successfully started!")
+
+async def on_shutdown(bot: Bot):
+    get_report_renderer().shutdown()
+    await monitor.stop()
+    await outbox.stop()
 
 async def main():
     # Register all handlers
@@ -77,8 +95,16 @@ async def main():
 
     # Set up startup hook
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    # Receive updates through a webhook when configured, falling back to polling
+    if config.get('delivery_mode') == 'webhook':
+        if await run_webhook(dp, bot, config):
+            return
+        logging.warning("Webhook mode unavailable, falling back to long polling")
 
-    # Start polling
+    # A webhook left over from an earlier run would make getUpdates fail
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
 if __name__ == '__main__':
@@ -18,7 +18,46 @@ VERSION_FILE="$CONFIG_DIR/version.json"
 
 CONFIG_FILE="$CONFIG_DIR/config.json"
 
-USAGE_PID_FILE="/var/run/marzbackup_usage.pid"
+SERVICE_NAME="marzbackup"
+
+SERVICE_FILE="/etc/systemd/system/$SERVICE_NAME.service"
+
+has_systemd() {
+    command -v systemctl > /dev/null 2>&1 && [ -d /run/systemd/system ]
+}
+
+supervisor() {
+    python3 "$INSTALL_DIR/supervisor.py" "$@"
+}
+
+# The supervisor schedules backups and usage tracking itself; drop the cron entries of older versions
+remove_cron_jobs() {
+    crontab -l 2>/dev/null | grep -v "$INSTALL_DIR/backup.sh" | grep -v "$INSTALL_DIR/hourlyReport.py" | crontab -
+}
+
+install_service() {
+    cat > "$SERVICE_FILE" <<EOF
+[Unit]
+Description=MarzBackup supervisor (bot, backup scheduler, usage tracker)
+After=network-online.target docker.service
+Wants=network-online.target
+
+[Service]
+Type=simple
+WorkingDirectory=$INSTALL_DIR
+ExecStart=$(command -v python3) $INSTALL_DIR/supervisor.py run
+Restart=on-failure
+RestartSec=5
+KillSignal=SIGTERM
+TimeoutStopSec=60
+StandardOutput=append:$LOG_FILE
+StandardError=append:$LOG_FILE
+
+[Install]
+WantedBy=multi-user.target
+EOF
+    systemctl daemon-reload
+}
 
 get_current_version() {
     if [ -f "$VERSION_FILE" ]; then
@@ -92,35 +131,30 @@ start() {
                 exit 1
             fi
         fi
-        if [ -f "$PID_FILE" ]; then
-            PID=$(cat "$PID_FILE")
-            if ps -p $PID > /dev/null; then
-                echo "MarzBackup is already running. Use 'marzbackup restart' to restart it."
-                return
-            else
-                echo "Stale PID file found. Removing it."
-                rm "$PID_FILE"
-            fi
+        if supervisor status > /dev/null 2>&1; then
+            echo "MarzBackup is already running. Use 'marzbackup restart' to restart it."
+            return
         fi
-        nohup python3 main.py > "$LOG_FILE" 2>&1 & echo $! > "$PID_FILE"
-        sleep 2
         if [ -f "$PID_FILE" ]; then
-            PID=$(cat "$PID_FILE")
-            if ps -p $PID > /dev/null; then
-                echo "Bot is running in the background. PID: $PID"
-                echo "You can check its status with 'marzbackup status'."
-                echo "To view logs, use: tail -f $LOG_FILE"
-                # Start user usage tracking if it's installed
-                if jq -e '.user_usage_installed == true' "$CONFIG_FILE" > /dev/null; then
-                    start_user_usage
-                fi
-            else
-                echo "Failed to start the bot. Check logs for details."
-                cat "$LOG_FILE"
-            fi
+            echo "Stale PID file found. Removing it."
+            rm "$PID_FILE"
+        fi
+        remove_cron_jobs
+        # One supervisor process hosts the bot, the backup scheduler and the usage tracker
+        if has_systemd; then
+            install_service
+            systemctl enable --now "$SERVICE_NAME" > /dev/null 2>&1
+        else
+            nohup python3 supervisor.py run > "$LOG_FILE" 2>&1 &
+        fi
+        sleep 3
+        if supervisor status > /dev/null 2>&1; then
+            echo "MarzBackup is running in the background. PID: $(cat "$PID_FILE")"
+            echo "You can check its status with 'marzbackup status'."
+            echo "To view logs, use: tail -f $LOG_FILE"
         else
-            echo "Failed to start the bot. PID file not created."
-            cat "$LOG_FILE"
+            echo "Failed to start MarzBackup. Check logs for details."
+            tail -n 20 "$LOG_FILE"
         fi
     else
         echo "MarzBackup is not installed. Please install it first."
@@ -130,15 +164,22 @@ start() {
 
 stop() {
     echo "Stopping MarzBackup..."
-    if [ -f "$PID_FILE" ]; then
+    if has_systemd && [ -f "$SERVICE_FILE" ]; then
+        systemctl stop "$SERVICE_NAME"
+        echo "MarzBackup stopped."
+    elif [ -f "$PID_FILE" ]; then
         PID=$(cat "$PID_FILE")
-        kill $PID
-        rm "$PID_FILE"
+        # SIGTERM lets the supervisor stop the bot and any running backup cleanly
+        kill $PID 2>/dev/null
+        for _ in $(seq 1 60); do
+            ps -p $PID > /dev/null || break
+            sleep 1
+        done
+        rm -f "$PID_FILE"
         echo "MarzBackup stopped."
     else
         echo "MarzBackup is not running or PID file not found."
     fi
-    stop_user_usage
 }
 
 restart() {
@@ -148,44 +189,28 @@ restart() {
 }
 
 status() {
-    if [ -f "$PID_FILE" ]; then
-        PID=$(cat "$PID_FILE")
-        if ps -p $PID > /dev/null; then
-            echo "MarzBackup is running. PID: $PID"
-            echo "Last 10 lines of log:"
-            tail -n 10 "$LOG_FILE"
-        else
-            echo "MarzBackup is not running, but PID file exists. It may have crashed."
-            echo "Last 20 lines of log:"
-            tail -n 20 "$LOG_FILE"
-            rm "$PID_FILE"
-        fi
+    if supervisor status; then
+        echo "Last 10 lines of log:"
+        tail -n 10 "$LOG_FILE"
+    elif [ -f "$LOG_FILE" ]; then
+        echo "Last 20 lines of log:"
+        tail -n 20 "$LOG_FILE"
     else
-        echo "MarzBackup is not running."
-        if [ -f "$LOG_FILE" ]; then
-            echo "Last 20 lines of log:"
-            tail -n 20 "$LOG_FILE"
-        else
-            echo "No log file found."
-        fi
-    fi
-    # Check status of user usage tracking
-    if [ -f "$USAGE_PID_FILE" ]; then
-        PID=$(cat "$USAGE_PID_FILE")
-        if ps -p $PID > /dev/null; then
-            echo "User usage tracking system is running. PID: $PID"
-        else
-            echo "User usage tracking system is not running, but PID file exists. It may have crashed."
-            rm "$USAGE_PID_FILE"
-        fi
-    else
-        echo "User usage tracking system is not running."
+        echo "No log file found."
     fi
 }
 
 uninstall() {
     echo "Uninstalling MarzBackup..."
 
+    # Remove the supervisor service
+    if has_systemd && [ -f "$SERVICE_FILE" ]; then
+        systemctl disable --now "$SERVICE_NAME" > /dev/null 2>&1
+        rm -f "$SERVICE_FILE"
+        systemctl daemon-reload
+    fi
+    remove_cron_jobs
+
     # Stop all running .sh and .py files in the installation directory
     pkill -f "$INSTALL_DIR/.*\.sh"
     pkill -f "$INSTALL_DIR/.*\.py"
@@ -215,19 +240,26 @@ uninstall() {
     echo "MarzBackup has been completely uninstalled."
 }
 
+# Usage tracking runs inside the supervisor; these toggle it and restart the service
+set_user_usage_stopped() {
+    jq ". + {\"user_usage_stopped\": $1}" "$CONFIG_FILE" > "$CONFIG_FILE.tmp" && mv "$CONFIG_FILE.tmp" "$CONFIG_FILE"
+}
+
 start_user_usage() {
-    echo "Setting up user usage tracking cron job..."
-    # Remove any existing cron job for hourlyReport.py
-    crontab -l | grep -v "$INSTALL_DIR/hourlyReport.py" | crontab -
-    # Add new cron job to run every 5 minutes
-    (crontab -l 2>/dev/null; echo "*/5 * * * * python3 $INSTALL_DIR/hourlyReport.py >> $LOG_FILE 2>&1") | crontab -
-    echo "User usage tracking cron job set up to run every 5 minutes."
+    echo "Starting user usage tracking..."
+    set_user_usage_stopped false
+    if supervisor restart usage > /dev/null 2>&1; then
+        echo "User usage tracking started."
+    else
+        echo "User usage tracking will start with MarzBackup ('marzbackup start')."
+    fi
 }
 
 stop_user_usage() {
-    echo "Removing user usage tracking cron job..."
-    crontab -l | grep -v "$INSTALL_DIR/hourlyReport.py" | crontab -
-    echo "User usage tracking cron job removed."
+    echo "Stopping user usage tracking..."
+    set_user_usage_stopped true
+    supervisor restart usage > /dev/null 2>&1
+    echo "User usage tracking stopped."
 }
 
 restart_user_usage() {
@@ -238,15 +270,9 @@ restart_user_usage() {
 
 install_user_usage() {
     echo "Installing user usage tracking system..."
-    if [ -f "$USAGE_PID_FILE" ]; then
-        PID=$(cat "$USAGE_PID_FILE")
-        if ps -p $PID > /dev/null; then
-            echo "User usage tracking system is already running."
-            return
-        else
-            echo "Stale PID file found. Removing it."
-            rm "$USAGE_PID_FILE"
-        fi
+    if supervisor status usage > /dev/null 2>&1; then
+        echo "User usage tracking system is already running."
+        return
     fi
     # Check if jq is installed
     if ! command -v jq &> /dev/null; then
@@ -326,11 +352,18 @@ case "$1" in
             exit 1
         fi
         ;;
+    restore)
+        if [ -z "$2" ]; then
+            echo "Usage: marzbackup restore <backup archive (.zip, .tar.gz or .tar.zst, optionally .enc)>"
+            exit 1
+        fi
+        cd "$INSTALL_DIR" && python3 physical_restore.py "$(realpath "$2")"
+        ;;
     uninstall)
         uninstall
         ;;
     *)
-        echo "Usage: marzbackup {update [dev|stable]|start|stop [user-usage]|restart [user-usage]|status|install user-usage|uninstall}"
+        echo "Usage: marzbackup {update [dev|stable]|start|stop [user-usage]|restart [user-usage]|status|install user-usage|restore <backup.zip>|uninstall}"
         exit 1
         ;;
 esac
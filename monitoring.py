@@ -0,0 +1,196 @@
+import io
+import sys
+import time
+import asyncio
+import logging
+import cProfile
+import pstats
+import threading
+import traceback
+from collections import deque
+from aiogram import BaseMiddleware
+
+# Runtime instrumentation for the bot process:
+# - a lag monitor task that measures how late the event loop wakes up,
+# - a watchdog thread that grabs the loop thread's stack while the loop is stalled,
+# - per-handler latency histograms collected by an aiogram middleware,
+# - an on-demand cProfile run of the live process.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+DEFAULT_SETTINGS = {
+    "monitor_lag_interval": 0.5,     # seconds between lag probes
+    "monitor_stall_seconds": 1.0,    # capture a traceback when the loop is blocked this long
+    "monitor_max_stalls": 20,        # stall tracebacks kept for /stats
+    "profile_max_seconds": 120,      # upper bound for /profile
+}
+
+class LatencyHistogram:
+    # Fixed buckets, so memory does not grow with the number of observations
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested percentile (the max for the last bucket)
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return "no samples"
+        return (f"n={self.count} avg={self.total / self.count * 1000:.0f}ms "
+                f"p50≤{self.percentile(0.5) * 1000:.0f}ms p95≤{self.percentile(0.95) * 1000:.0f}ms "
+                f"max={self.max * 1000:.0f}ms")
+
+class RuntimeMonitor:
+    def __init__(self, config):
+        self.settings = {key: config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+        self.loop_lag = LatencyHistogram()
+        self.handlers = {}
+        self.stalls = deque(maxlen=int(self.settings["monitor_max_stalls"]))
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.started = time.time()
+        self.profile_lock = asyncio.Lock()
+        self._task = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._probe_lag())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=2)
+            self._watchdog = None
+
+    async def _probe_lag(self):
+        interval = self.settings["monitor_lag_interval"]
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            self.loop_lag.observe(max(now - expected, 0.0))
+            self.heartbeat = now
+
+    def _watch(self):
+        # Runs outside the loop, so it still sees a stall while a callback blocks the loop thread
+        threshold = self.settings["monitor_stall_seconds"] + self.settings["monitor_lag_interval"]
+        captured_for = None
+        while not self._stopping.wait(threshold / 4):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat < threshold or captured_for == heartbeat:
+                continue
+            captured_for = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            self.stalls.append((time.time(), stack))
+            logging.warning(f"Event loop blocked for more than {threshold:.1f}s, loop thread is at:\n{stack}")
+
+    def observe_handler(self, name, seconds):
+        self.handlers.setdefault(name, LatencyHistogram()).observe(seconds)
+
+    def stats_text(self, max_stack_lines=12):
+        uptime = int(time.time() - self.started)
+        lines = [
+            f"Uptime: {uptime // 3600}h {uptime % 3600 // 60}m",
+            f"Loop lag: {self.loop_lag.summary()}",
+            f"Stalls captured: {len(self.stalls)}",
+            "",
+            "Handlers:",
+        ]
+        for name, histogram in sorted(self.handlers.items(), key=lambda item: item[1].total, reverse=True):
+            lines.append(f"{name}: {histogram.summary()}")
+        if self.stalls:
+            captured_at, stack = self.stalls[-1]
+            lines += ["", f"Last stall at {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(captured_at))}:"]
+            lines += stack.rstrip().splitlines()[-max_stack_lines:]
+        return "\n".join(lines)
+
+    async def profile(self, seconds, top=25):
+        # cProfile only sees the thread it is enabled in; enabling it here profiles the event loop thread
+        seconds = min(max(seconds, 1), self.settings["profile_max_seconds"])
+        if self.profile_lock.locked():
+            raise RuntimeError("A profile is already running")
+        async with self.profile_lock:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.strip_dirs().sort_stats("tottime").print_stats(top)
+        return seconds, output.getvalue()
+
+class HandlerLatencyMiddleware(BaseMiddleware):
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_object = data.get("handler")
+            callback = getattr(handler_object, "callback", None)
+            name = getattr(callback, "__name__", type(event).__name__)
+            self.monitor.observe_handler(name, time.perf_counter() - started)
+
+def format_profile(text, max_lines=40):
+    # Keep the pstats header and the rows of the top functions
+    lines = [line.rstrip() for line in text.splitlines() if line.strip()]
+    return "\n".join(lines[:max_lines])
+
+_monitor = None
+
+def setup_monitor(dp, config=None):
+    global _monitor
+    _monitor = RuntimeMonitor(config or {})
+    middleware = HandlerLatencyMiddleware(_monitor)
+    dp.message.middleware(middleware)
+    dp.callback_query.middleware(middleware)
+    return _monitor
+
+def get_monitor():
+    if _monitor is None:
+        raise RuntimeError("Monitor is not set up; call setup_monitor(dp) first")
+    return _monitor
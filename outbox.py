@@ -0,0 +1,336 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import uuid
+import asyncio
+import logging
+import argparse
+import itertools
+import urllib.error
+import urllib.request
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+# Single outbound path for everything MarzBackup sends to Telegram.
+# In the bot process messages go through the async Outbox (priority queue, token buckets,
+# digests, retry_after). Other processes (backup.sh, the usage tracker) use the synchronous
+# helpers below, which share the chunking and retry rules and pace themselves through a lock file.
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+CONFIG_FILE_PATH = os.environ.get("MARZBACKUP_CONFIG", "/opt/marzbackup/config.json")
+PACING_FILE_PATH = "/tmp/marzbackup_outbox.lock"
+
+def utf16_length(text):
+    # Telegram counts message length in UTF-16 code units
+    return len(text.encode('utf-16-le')) // 2
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+    # Split text into chunks Telegram accepts, preferring line and then word boundaries
+    chunks = []
+    while utf16_length(text) > limit:
+        cut = limit
+        while utf16_length(text[:cut]) > limit:
+            cut -= 1
+        boundary = text.rfind('\n', 0, cut)
+        if boundary < cut // 2:
+            boundary = text.rfind(' ', 0, cut)
+        if boundary < cut // 2:
+            boundary = cut
+        chunks.append(text[:boundary])
+        text = text[boundary:].lstrip('\n')
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+class Outbox:
+    def __init__(self, bot, global_rate=25, chat_rate=1.0, chat_burst=3, digest_window=10, max_retries=5):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.queue = asyncio.PriorityQueue()
+        self.digests = {}
+        self.sequence = itertools.count()
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        # Flush pending digests and give queued messages a chance to go out
+        for key in list(self.digests):
+            self._flush_digest(key)
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Outbox stopped with {self.queue.qsize()} undelivered messages")
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+
+    def _enqueue(self, priority, method, chat_id, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.sequence), method, chat_id, kwargs, future))
+        return future
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, digest_key=None, **kwargs):
+        # Queue a text message; long texts are split. Messages sharing a digest_key that arrive
+        # within digest_window seconds are merged into one. Returns a future with the last sent message.
+        if digest_key is not None:
+            return self._add_to_digest(chat_id, text, priority, digest_key, kwargs)
+        future = None
+        for chunk in split_text(str(text)):
+            future = self._enqueue(priority, "send_message", chat_id, dict(kwargs, text=chunk))
+        return future
+
+    def send_document(self, chat_id, document, caption=None, priority=PRIORITY_NORMAL, **kwargs):
+        overflow = None
+        if caption and utf16_length(caption) > MAX_CAPTION_LENGTH:
+            caption, overflow = split_text(caption, MAX_CAPTION_LENGTH)[0], caption
+            overflow = overflow[len(caption):].lstrip('\n')
+        future = self._enqueue(priority, "send_document", chat_id, dict(kwargs, document=document, caption=caption))
+        if overflow:
+            self.send_message(chat_id, overflow, priority)
+        return future
+
+    def _add_to_digest(self, chat_id, text, priority, digest_key, kwargs):
+        key = (chat_id, digest_key)
+        future = asyncio.get_running_loop().create_future()
+        if key not in self.digests:
+            handle = asyncio.get_running_loop().call_later(self.digest_window, self._flush_digest, key)
+            self.digests[key] = {"texts": [], "futures": [], "priority": priority, "kwargs": kwargs, "handle": handle}
+        digest = self.digests[key]
+        digest["texts"].append(str(text))
+        digest["futures"].append(future)
+        digest["priority"] = min(digest["priority"], priority)
+        return future
+
+    def _flush_digest(self, key):
+        digest = self.digests.pop(key, None)
+        if digest is None:
+            return
+        digest["handle"].cancel()
+        chat_id, digest_key = key
+        texts = digest["texts"]
+        if len(texts) == 1:
+            text = texts[0]
+        else:
+            text = f"{len(texts)} × {digest_key}:\n\n" + "\n\n".join(texts)
+        sent = self.send_message(chat_id, text, digest["priority"], **digest["kwargs"])
+        for future in digest["futures"]:
+            sent.add_done_callback(lambda done, future=future: future.done() or future.set_result(done.result()))
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            priority, sequence, method, chat_id, kwargs, future = await self.queue.get()
+            try:
+                result = await self._deliver(method, chat_id, kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                logging.error(f"Failed to deliver {method} to {chat_id}: {e}")
+                if not future.done():
+                    future.set_result(None)
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, method, chat_id, kwargs):
+        chat_bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            wait = max(self.global_bucket.wait_time(), chat_bucket.wait_time())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.global_bucket.consume()
+            chat_bucket.consume()
+            try:
+                return await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                logging.warning(f"Flood limit hit, retrying {method} after {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 60))
+                logging.warning(f"Retrying {method} after error: {e}")
+
+_outbox = None
+
+def setup_outbox(bot, config=None):
+    global _outbox
+    config = config or {}
+    _outbox = Outbox(
+        bot,
+        global_rate=config.get("outbox_global_rate", 25),
+        chat_rate=config.get("outbox_chat_rate", 1.0),
+        chat_burst=config.get("outbox_chat_burst", 3),
+        digest_window=config.get("outbox_digest_window", 10),
+    )
+    return _outbox
+
+def get_outbox():
+    if _outbox is None:
+        raise RuntimeError("Outbox is not set up; call setup_outbox(bot) first")
+    return _outbox
+
+# Synchronous helpers for processes that do not run the bot
+
+def _load_config():
+    with open(CONFIG_FILE_PATH, 'r') as file:
+        return json.load(file)
+
+def _wait_for_pacing(min_interval):
+    # Keep separate processes from bursting into the same chat at the same moment
+    with open(PACING_FILE_PATH, 'a+') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        lock_file.seek(0)
+        try:
+            last_sent = float(lock_file.read() or 0)
+        except ValueError:
+            last_sent = 0
+        delay = last_sent + min_interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(time.time()))
+
+def _call_api(config, method, body, content_type, content_length=None, max_retries=5, min_interval=1.0):
+    base = config.get("bot_api_server") or "https://api.telegram.org"
+    url = f"{base.rstrip('/')}/bot{config.get('API_TOKEN')}/{method}"
+    for attempt in range(max_retries + 1):
+        _wait_for_pacing(min_interval)
+        data = body() if callable(body) else body
+        request = urllib.request.Request(url, data=data, headers={"Content-Type": content_type})
+        if content_length is not None:
+            request.add_header("Content-Length", str(content_length))
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                error = json.load(e)
+            except ValueError:
+                error = {}
+            retry_after = error.get("parameters", {}).get("retry_after")
+            if e.code == 429 and retry_after is not None:
+                time.sleep(retry_after)
+            elif e.code >= 500 and attempt < max_retries:
+                time.sleep(min(2 ** attempt, 60))
+            else:
+                raise Exception(f"Telegram API error {e.code}: {error.get('description', e.reason)}")
+        except urllib.error.URLError:
+            if attempt >= max_retries:
+                raise
+            time.sleep(min(2 ** attempt, 60))
+    raise Exception(f"Telegram API {method} failed after {max_retries} retries")
+
+def send_message_sync(config, text, chat_id=None):
+    chat_id = chat_id or config.get("ADMIN_CHAT_ID")
+    min_interval = 1 / config.get("outbox_chat_rate", 1.0)
+    for chunk in split_text(str(text)):
+        body = json.dumps({"chat_id": chat_id, "text": chunk}).encode()
+        _call_api(config, "sendMessage", body, "application/json", min_interval=min_interval)
+
+def send_document_sync(config, file_path, caption="", chat_id=None, rate_limit_kb=0):
+    # Stream the file as multipart/form-data without reading it into memory
+    chat_id = chat_id or config.get("ADMIN_CHAT_ID")
+    min_interval = 1 / config.get("outbox_chat_rate", 1.0)
+    overflow = ""
+    if utf16_length(caption) > MAX_CAPTION_LENGTH:
+        first = split_text(caption, MAX_CAPTION_LENGTH)[0]
+        caption, overflow = first, caption[len(first):].lstrip('\n')
+
+    boundary = uuid.uuid4().hex
+    fields = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in (("chat_id", chat_id), ("caption", caption))
+    )
+    file_header = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="document"; '
+        f'filename="{os.path.basename(file_path)}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    footer = f'\r\n--{boundary}--\r\n'.encode()
+    length = len(fields) + len(file_header) + os.path.getsize(file_path) + len(footer)
+
+    def body():
+        yield fields + file_header
+        chunk_size = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+                sent += len(chunk)
+                if rate_limit_kb:
+                    ahead = sent / (rate_limit_kb * 1024) - (time.monotonic() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        yield footer
+
+    _call_api(config, "sendDocument", body, f"multipart/form-data; boundary={boundary}",
+              content_length=length, min_interval=min_interval)
+    if overflow:
+        send_message_sync(config, overflow, chat_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a message or document to the MarzBackup admin chat")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    message_parser = subparsers.add_parser("message")
+    message_parser.add_argument("--text", help="Message text (read from stdin when omitted)")
+    document_parser = subparsers.add_parser("document")
+    document_parser.add_argument("--file", required=True)
+    document_parser.add_argument("--caption", default="")
+    document_parser.add_argument("--rate-limit-kb", type=int, default=0)
+    args = parser.parse_args()
+
+    config = _load_config()
+    try:
+        if args.command == "message":
+            send_message_sync(config, args.text if args.text is not None else sys.stdin.read())
+        else:
+            send_document_sync(config, args.file, args.caption, rate_limit_kb=args.rate_limit_kb)
+    except Exception as e:
+        print(f"Error sending to Telegram: {e}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
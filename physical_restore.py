@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import shlex
+import shutil
+import tarfile
+import zipfile
+import asyncio
+import tempfile
+import subprocess
+from datetime import datetime
+from config import load_config
+from crypto_stream import DecryptionError
+from selective_restore import COPY_CHUNK_SIZE, BackupArchive, archive_kind
+
+DATADIR_IN_CONTAINER = "/var/lib/mysql"
+PHYSICAL_STREAM_NAME = "physical.xbstream"
+PHYSICAL_INFO_NAME = "physical.json"
+
+# Tool used to extract the xbstream for each database type
+STREAM_EXTRACTORS = {
+    "mariadb": "mbstream",
+    "mysql": "xbstream",
+}
+
+# Names the backup tool goes by in different images
+TOOL_ALIASES = {
+    "mariabackup": ("mariabackup", "mariadb-backup"),
+    "mariadb-backup": ("mariadb-backup", "mariabackup"),
+    "xtrabackup": ("xtrabackup",),
+}
+
+# Return the (stream, info) member names if the archive holds a physical backup.
+# Works for every archive backup.sh writes: zip, tar.gz, tar.zst, encrypted or not.
+def find_physical_members(archive):
+    names = archive.members()
+    stream_member = next((n for n in names if n.endswith(f"db-backup/{PHYSICAL_STREAM_NAME}")), None)
+    info_member = next((n for n in names if n.endswith(f"db-backup/{PHYSICAL_INFO_NAME}")), None)
+    return stream_member, info_member
+
+def is_physical_backup(archive_path):
+    try:
+        archive_kind(archive_path)
+        archive = BackupArchive(archive_path, load_config())
+        try:
+            stream_member, _ = find_physical_members(archive)
+        finally:
+            archive.close()
+        return stream_member is not None
+    except (ValueError, OSError, zipfile.BadZipFile, tarfile.TarError, DecryptionError):
+        return False
+
+def physical_tool_for(db_type):
+    if db_type == "mariadb":
+        return "mariabackup"
+    elif db_type == "mysql":
+        return "xtrabackup"
+    raise ValueError(f"Unsupported database type: {db_type}")
+
+async def run_command(command):
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise Exception(f"Command failed: {command.split()[0]} ...: {stderr.decode().strip()}")
+    return stdout.decode().strip()
+
+# Stream one archive member into a command's stdin, without unpacking the archive
+def stream_member_to_command(archive, member, command):
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+        try:
+            with archive.open_member(member) as stream:
+                shutil.copyfileobj(stream, process.stdin, COPY_CHUNK_SIZE)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # The command exited early; its error output explains why
+        except Exception:
+            process.kill()
+            raise
+        finally:
+            process.wait()
+        if process.returncode != 0:
+            errors.seek(0)
+            raise Exception(f"Command failed: {command[0]} ...: {errors.read().decode(errors='replace').strip()}")
+
+# Return the name the backup tool has in `image`, or fail before anything is stopped
+async def find_tool_in_image(image, tool, extractor):
+    for name in TOOL_ALIASES.get(tool, (tool,)):
+        try:
+            await run_command(f"docker run --rm --entrypoint sh {shlex.quote(image)} -c "
+                              f"{shlex.quote(f'command -v {name} && command -v {extractor}')}")
+            return name
+        except Exception:
+            continue
+    raise Exception(f"The image {image} has no {tool}/{extractor}. Set physical_backup_image in the config to an "
+                    f"image that provides them in the same version as the backup (e.g. mariadb:<server version> "
+                    f"or percona/percona-xtrabackup:8.0).")
+
+# Find the host directory mounted as the container's data directory
+async def get_host_datadir(db_container):
+    mounts = json.loads(await run_command(f"docker inspect -f '{{{{json .Mounts}}}}' {db_container}"))
+    for mount in mounts:
+        if mount.get("Destination") == DATADIR_IN_CONTAINER:
+            return mount["Source"]
+    raise Exception(f"No host volume mounted at {DATADIR_IN_CONTAINER} in {db_container}")
+
+# Prepare a physical backup from the archive and move it into the DB container's data directory.
+# The current data directory is kept as <datadir>.pre-restore-<timestamp> and put back if any step fails.
+async def restore_physical_backup(archive_path):
+    config = load_config()
+    db_container = config.get("db_container")
+    db_type = config.get("db_type", "mariadb")
+    if not db_container:
+        raise Exception("Database information not found in config file")
+
+    archive = BackupArchive(archive_path, config)
+    try:
+        return await restore_physical_archive(archive, config, db_container, db_type)
+    finally:
+        archive.close()
+
+async def restore_physical_archive(archive, config, db_container, db_type):
+    stream_member, info_member = await asyncio.to_thread(find_physical_members, archive)
+    if not stream_member:
+        raise Exception("The archive does not contain a physical backup")
+
+    info = {}
+    if info_member:
+        with archive.open_member(info_member) as stream:
+            info = json.load(stream)
+    if info.get("db_type", db_type) != db_type:
+        raise Exception(f"Backup was taken from {info['db_type']} but this host runs {db_type}")
+
+    extractor = STREAM_EXTRACTORS[db_type]
+    image = (config.get("physical_backup_image") or info.get("image")
+             or await run_command(f"docker inspect -f '{{{{.Config.Image}}}}' {db_container}"))
+    # The server's own image may not ship the backup tool; check before touching anything
+    tool = await find_tool_in_image(image, info.get("tool") or physical_tool_for(db_type), extractor)
+
+    datadir = await get_host_datadir(db_container)
+    # The restored files get the numeric owner of the current data directory; the "mysql" user
+    # of the sidecar image may have a different uid than the server's
+    owner = os.stat(datadir)
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    staging_dir = f"{datadir}.restore-{timestamp}"
+    previous_dir = f"{datadir}.pre-restore-{timestamp}"
+    os.makedirs(staging_dir)
+
+    sidecar = f"docker run --rm -i --entrypoint '' -v {shlex.quote(staging_dir)}:/restore"
+
+    # Extract and prepare while the server keeps running
+    await asyncio.to_thread(
+        stream_member_to_command, archive, stream_member,
+        ["docker", "run", "--rm", "-i", "--entrypoint", "", "-v", f"{staging_dir}:/restore", image, extractor, "-x", "-C", "/restore"],
+    )
+    await run_command(f"{sidecar} {image} {tool} --prepare --target-dir=/restore")
+
+    await run_command(f"docker stop {db_container}")
+    try:
+        os.rename(datadir, previous_dir)
+        os.makedirs(datadir)
+        await run_command(
+            f"{sidecar} -v {shlex.quote(datadir)}:{DATADIR_IN_CONTAINER} {image} "
+            f"sh -c '{tool} --move-back --target-dir=/restore && chown -R {owner.st_uid}:{owner.st_gid} {DATADIR_IN_CONTAINER}'"
+        )
+        # Keep the uploaded backups that live inside the data directory
+        if os.path.isdir(os.path.join(previous_dir, "db-backup")):
+            os.rename(os.path.join(previous_dir, "db-backup"), os.path.join(datadir, "db-backup"))
+    except Exception:
+        if os.path.isdir(previous_dir):
+            if os.path.isdir(datadir):
+                os.rename(datadir, f"{datadir}.failed-{timestamp}")
+            os.rename(previous_dir, datadir)
+        raise
+    finally:
+        await run_command(f"docker start {db_container}")
+        await run_command(f"rm -rf {shlex.quote(staging_dir)}")
+
+    return previous_dir
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 physical_restore.py <backup archive>")
+        sys.exit(1)
+    previous = asyncio.run(restore_physical_backup(sys.argv[1]))
+    print(f"Physical backup restored. Previous data directory kept at {previous}")
@@ -0,0 +1,230 @@
+import os
+import re
+import csv
+import gzip
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import pytz
+from anomaly import parse_table, format_bytes
+from config import load_config
+
+REPORTS_DIR = "/opt/marzbackup/reports"
+REPORT_FORMATS = ("png", "csv", "xlsx")
+TOP_USERS_IN_CHART = 10
+
+# Rendering functions run in worker processes, so they only take and return plain data
+
+def render_png(rows, path, title):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    totals = defaultdict(int)
+    per_user = defaultdict(int)
+    for row in rows:
+        totals[row["timestamp"]] += int(row["usage_in_period"])
+        per_user[row["username"]] += int(row["usage_in_period"])
+    timestamps = sorted(totals)
+    top_users = sorted(per_user.items(), key=lambda item: item[1], reverse=True)[:TOP_USERS_IN_CHART]
+
+    figure, (timeline, ranking) = plt.subplots(2, 1, figsize=(10, 9))
+    timeline.plot([datetime.strptime(ts, "%Y-%m-%d %H:%M:%S") for ts in timestamps],
+                  [totals[ts] / 1024 ** 3 for ts in timestamps])
+    timeline.set_title(title)
+    timeline.set_ylabel("GB per period")
+    timeline.grid(True, alpha=0.3)
+    figure.autofmt_xdate()
+
+    ranking.barh([name for name, _ in reversed(top_users)], [usage / 1024 ** 3 for _, usage in reversed(top_users)])
+    ranking.set_title(f"Top {len(top_users)} users")
+    ranking.set_xlabel("GB")
+
+    figure.tight_layout()
+    figure.savefig(path, dpi=120)
+    plt.close(figure)
+    return path
+
+def render_csv(rows, path, title):
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["timestamp", "user_id", "username", "usage_in_period", "report_number"])
+        for row in rows:
+            writer.writerow([row["timestamp"], row["user_id"], row["username"], row["usage_in_period"], row["report_number"]])
+    return path
+
+def render_xlsx(rows, path, title):
+    from openpyxl import Workbook
+
+    # Write-only mode streams rows to disk instead of building the sheet in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("usage")
+    sheet.append(["timestamp", "user_id", "username", "usage_in_period", "report_number"])
+    for row in rows:
+        sheet.append([row["timestamp"], int(row["user_id"]), row["username"], int(row["usage_in_period"]), int(row["report_number"])])
+
+    totals = defaultdict(int)
+    for row in rows:
+        totals[row["username"]] += int(row["usage_in_period"])
+    summary = workbook.create_sheet("totals")
+    summary.append(["username", "usage", "usage_readable"])
+    for username, usage in sorted(totals.items(), key=lambda item: item[1], reverse=True):
+        summary.append([username, usage, format_bytes(usage)])
+    workbook.save(path)
+    return path
+
+RENDERERS = {
+    "png": (render_png, "png"),
+    "csv": (render_csv, "csv.gz"),
+    "xlsx": (render_xlsx, "xlsx"),
+}
+
+class ReportCache:
+    # Rendered files keyed by (start, end, filter, format); least recently used files are deleted.
+    # Files held by a caller (e.g. still queued in the outbox) are only deleted once released.
+    def __init__(self, directory=REPORTS_DIR, max_entries=16):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.holds = defaultdict(int)
+        self.evicted = {}
+
+    def path_for(self, key, extension):
+        # The readable part of the name may collide between filters; the hash of the whole key does not
+        start, end, username_filter, _ = key
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:12]
+        label = "_" + re.sub(r"[^A-Za-z0-9_-]", "_", username_filter)[:32] if username_filter else ""
+        return os.path.join(self.directory, f"usage_{start:%Y%m%d%H%M}_{end:%Y%m%d%H%M}{label}_{digest}.{extension}")
+
+    def get(self, key):
+        # An evicted file that is still held comes back instead of being rendered over
+        path = self.entries.get(key) or self.evicted.pop(key, None)
+        if path and os.path.exists(path):
+            self.entries[key] = path
+            self.entries.move_to_end(key)
+            return path
+        self.entries.pop(key, None)
+        return None
+
+    def put(self, key, path):
+        self.entries[key] = path
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            if self.holds.get(evicted):
+                self.evicted[evicted_key] = evicted
+            else:
+                self._remove(evicted)
+
+    def hold(self, path):
+        self.holds[path] += 1
+
+    def release(self, path):
+        self.holds[path] -= 1
+        if self.holds[path] > 0:
+            return
+        del self.holds[path]
+        for key, evicted in list(self.evicted.items()):
+            if evicted == path:
+                del self.evicted[key]
+                self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class ReportRenderer:
+    def __init__(self, max_workers=2, max_entries=16):
+        self.max_workers = max_workers
+        self.cache = ReportCache(max_entries=max_entries)
+        self.pending = {}
+        self.pool = None
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.pool
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def fetch_usage(self, start, end, username_filter=None):
+        config = load_config()
+        command = [
+            "docker", "exec", "-i", config.get("db_container"), config.get("db_type", "mariadb"),
+            "-u", "root", f"-p{config.get('db_password')}", "UserUsageAnalytics",
+            "-e", f"CALL get_historical_usage('{start:%Y-%m-%d %H:%M:%S}', '{end:%Y-%m-%d %H:%M:%S}');"
+        ]
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise Exception(f"Error fetching usage data: {stderr.decode()}")
+        rows = await asyncio.get_running_loop().run_in_executor(None, parse_table, stdout.decode())
+        if username_filter:
+            rows = [row for row in rows if username_filter.lower() in row["username"].lower()]
+        return rows
+
+    async def render(self, start, end, report_format, username_filter=None):
+        # Return the path of a rendered report, rendering it in the process pool on a cache miss.
+        # The file is held for the caller until release(path), so eviction cannot delete it mid-send.
+        if report_format not in RENDERERS:
+            raise ValueError(f"Unknown report format: {report_format}")
+        key = (start, end, (username_filter or "").lower(), report_format)
+        path = self.cache.get(key)
+        if not path:
+            # Concurrent requests for the same report share one render
+            task = self.pending.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._render(key, start, end, report_format, username_filter))
+                self.pending[key] = task
+                task.add_done_callback(lambda _: self.pending.pop(key, None))
+            path = await asyncio.shield(task)
+        self.cache.hold(path)
+        return path
+
+    def release(self, path):
+        self.cache.release(path)
+
+    async def _render(self, key, start, end, report_format, username_filter):
+        rows = await self.fetch_usage(start, end, username_filter)
+        if not rows:
+            raise LookupError("No usage data in this range")
+        renderer, extension = RENDERERS[report_format]
+        os.makedirs(self.cache.directory, exist_ok=True)
+        path = self.cache.path_for(key, extension)
+        title = f"Usage {start:%Y-%m-%d %H:%M} to {end:%Y-%m-%d %H:%M}"
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._get_pool(), renderer, rows, path, title)
+        self.cache.put(key, path)
+        logging.info(f"Rendered {report_format} report with {len(rows)} rows to {path}")
+        return path
+
+def report_range(hours, report_interval, now=None):
+    # Align the end of the range to the report interval so repeated requests hit the cache
+    # PeriodicUsage timestamps are stored in Tehran time
+    now = now or datetime.now(pytz.timezone('Asia/Tehran')).replace(tzinfo=None)
+    interval = max(int(report_interval), 1)
+    minutes = (now.hour * 60 + now.minute) // interval * interval
+    end = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(minutes=minutes)
+    return end - timedelta(hours=hours), end
+
+_renderer = None
+
+def get_report_renderer():
+    global _renderer
+    if _renderer is None:
+        config = load_config()
+        _renderer = ReportRenderer(
+            max_workers=config.get("report_workers", 2),
+            max_entries=config.get("report_cache_entries", 16),
+        )
+    return _renderer
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import contextlib
+import subprocess
+from crypto_stream import ENCRYPTED_SUFFIX, EncryptedReader
+
+# Restore single members of a backup.sh archive without unpacking the rest of it.
+# Zip archives (also when encrypted) are opened through their central directory, so only the
+# chosen member is read and decompressed. tar.gz / tar.zst have no index and are read as a stream,
+# stopping as soon as the member has been restored.
+
+RESTORE_DIR = "/opt/marzbackup/restore"
+MANIFEST_NAME = "MANIFEST.json"
+DUMP_DIR = re.compile(r"(^|/)mysql/db-backup/[^/]+$")
+# The directories backup.sh archives; no other member is ever written back to disk
+PANEL_ROOTS = ("opt/marzban", "var/lib/marzban", "etc/opt/marzneshin", "var/lib/marzneshin")
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# mariadb-dump / mysqldump section comments; the text in backquotes is the table or database
+SECTION = re.compile(rb"^-- (Table structure for table|Dumping data for table|Temporary table structure for view|"
+                     rb"Final view structure for view|Current Database:|Dumping routines|Dumping events)(?: `(.*)`)?")
+TABLE_SECTIONS = (b"Table structure for table", b"Dumping data for table")
+COMMON_SECTIONS = (b"Current Database:",)
+
+def normalize_member(name):
+    # tar members start with "./"; zip members do not
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+def archive_kind(path):
+    name = path[:-len(ENCRYPTED_SUFFIX)] if path.endswith(ENCRYPTED_SUFFIX) else path
+    if name.endswith(".zip"):
+        return "zip"
+    if name.endswith((".tar.gz", ".tgz")):
+        return "gzip"
+    if name.endswith(".tar.zst"):
+        return "zstd"
+    raise ValueError(f"Unsupported archive type: {os.path.basename(path)}")
+
+class BackupArchive:
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.kind = archive_kind(path)
+        self.encrypted = path.endswith(ENCRYPTED_SUFFIX)
+        self._zip = None
+        self._zip_source = None
+        self._members = None
+
+    def _open_raw(self):
+        # Encrypted archives are decrypted (and authenticated) chunk by chunk as they are read
+        if self.encrypted:
+            return EncryptedReader(self.path, self.config)
+        return open(self.path, 'rb')
+
+    def _zipfile(self):
+        if self._zip is None:
+            self._zip_source = self._open_raw()
+            self._zip = zipfile.ZipFile(self._zip_source)
+        return self._zip
+
+    @contextlib.contextmanager
+    def _tar_stream(self):
+        raw = self._open_raw()
+        try:
+            if self.kind == "gzip":
+                with tarfile.open(fileobj=raw, mode="r|gz") as tar:
+                    yield tar
+                return
+            process = subprocess.Popen(["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            def feed():
+                try:
+                    shutil.copyfileobj(raw, process.stdin, COPY_CHUNK_SIZE)
+                except (BrokenPipeError, ValueError):
+                    pass  # The reader stopped early
+                finally:
+                    with contextlib.suppress(BrokenPipeError):
+                        process.stdin.close()
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            try:
+                with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+                    yield tar
+            finally:
+                process.kill()
+                process.wait()
+                feeder.join()
+                process.stdout.close()
+        finally:
+            raw.close()
+
+    def members(self):
+        # {normalized name: file mode} for every regular file in the archive
+        if self._members is None:
+            self._members = {}
+            if self.kind == "zip":
+                for info in self._zipfile().infolist():
+                    if not info.is_dir():
+                        self._members[normalize_member(info.filename)] = (info.external_attr >> 16) & 0o7777
+            else:
+                with self._tar_stream() as tar:
+                    for member in tar:
+                        if member.isfile():
+                            self._members[normalize_member(member.name)] = member.mode
+        return self._members
+
+    @contextlib.contextmanager
+    def open_member(self, name):
+        if self.kind == "zip":
+            for info in self._zipfile().infolist():
+                if normalize_member(info.filename) == name:
+                    with self._zipfile().open(info) as stream:
+                        yield stream
+                    return
+        else:
+            with self._tar_stream() as tar:
+                for member in tar:
+                    if member.isfile() and normalize_member(member.name) == name:
+                        yield tar.extractfile(member)
+                        return
+        raise KeyError(f"{name} is not in the archive")
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip_source.close()
+            self._zip = None
+
+def dump_tables(stream):
+    # Table names in a dump, for archives whose manifest has no table list
+    tables = []
+    for line in stream:
+        match = SECTION.match(line)
+        if match and match.group(1) == TABLE_SECTIONS[0]:
+            tables.append(match.group(2).decode())
+    return tables
+
+def table_statements(stream, table):
+    # Yield the lines of a dump that recreate one table: the session settings at the top,
+    # the database selection, the table's own sections and the settings restored at the end
+    wanted = table.encode()
+    keep = True
+    for line in stream:
+        match = SECTION.match(line)
+        if match:
+            keep = match.group(1) in COMMON_SECTIONS or (match.group(1) in TABLE_SECTIONS and match.group(2) == wanted)
+        if keep or (line.startswith(b"/*!") and b"@OLD_" in line):
+            yield line
+
+def is_panel_file(name):
+    # A relative member path inside one of the panel roots, without "..", "." or empty parts
+    parts = name.split("/")
+    if name.startswith("/") or any(part in ("", ".", "..") for part in parts):
+        return False
+    return any(name.startswith(root + "/") for root in PANEL_ROOTS)
+
+def restore_entries(archive):
+    # Everything the admin can pick: whole database dumps, single tables and panel files
+    members = archive.members()
+    dumps = sorted(name for name in members if DUMP_DIR.search(name) and name.endswith(".sql"))
+
+    manifest_tables = {}
+    if MANIFEST_NAME in members:
+        with archive.open_member(MANIFEST_NAME) as stream:
+            for key in json.load(stream).get("tables", {}):
+                database, _, table = key.partition(".")
+                manifest_tables.setdefault(database, []).append(table)
+
+    entries = []
+    for dump in dumps:
+        base = os.path.basename(dump)[:-len(".sql")]
+        if base.endswith(".incremental"):
+            entries.append({"kind": "database", "member": dump, "label": f"{base[:-len('.incremental')]} (incremental)"})
+            continue
+        entries.append({"kind": "database", "member": dump, "label": base})
+        tables = manifest_tables.get(base)
+        if tables is None:
+            with archive.open_member(dump) as stream:
+                tables = dump_tables(stream)
+        for table in sorted(tables):
+            entries.append({"kind": "table", "member": dump, "table": table, "label": f"{base}.{table}"})
+
+    for name in sorted(members):
+        if name in dumps or name == MANIFEST_NAME or DUMP_DIR.search(name) or not is_panel_file(name):
+            continue
+        entries.append({"kind": "file", "member": name, "label": "/" + name})
+    return entries
+
+def database_command(config):
+    return ["docker", "exec", "-i", config.get("db_container"), config.get("db_type", "mariadb"),
+            "-u", "root", f"-p{config.get('db_password')}"]
+
+def restore_sql(archive, entry, config):
+    # Stream the dump (or one table of it) straight into the database container
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(database_command(config), stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=errors)
+        try:
+            with archive.open_member(entry["member"]) as stream:
+                if entry["kind"] == "table":
+                    for line in table_statements(stream, entry["table"]):
+                        process.stdin.write(line)
+                else:
+                    shutil.copyfileobj(stream, process.stdin, COPY_CHUNK_SIZE)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # The client exited early; its error output explains why
+        except Exception:
+            process.kill()
+            raise
+        finally:
+            process.wait()
+        if process.returncode != 0:
+            errors.seek(0)
+            raise Exception(f"Restore failed: {errors.read().decode(errors='replace').strip()}")
+
+def restore_file(archive, entry):
+    # Write to a temporary file next to the target and rename it over the target in one step
+    if not is_panel_file(entry["member"]):
+        raise ValueError(f"Refusing to restore {entry['member']}: not inside a panel directory")
+    target = "/" + entry["member"]
+    root = next("/" + root for root in PANEL_ROOTS if entry["member"].startswith(root + "/"))
+    directory = os.path.dirname(target)
+    # A symlink inside the panel directory must not lead the write somewhere else
+    if os.path.islink(target) or not (os.path.realpath(directory) + "/").startswith(os.path.realpath(root) + "/"):
+        raise ValueError(f"Refusing to restore {entry['member']}: the path leaves {root}")
+    os.makedirs(directory, exist_ok=True)
+    # No setuid/setgid bits from an uploaded archive
+    mode = (archive.members().get(entry["member"]) or 0o644) & 0o777
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(target)}.restore-")
+    try:
+        with os.fdopen(fd, 'wb') as output, archive.open_member(entry["member"]) as stream:
+            shutil.copyfileobj(stream, output, COPY_CHUNK_SIZE)
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temp_path, mode)
+        if os.path.exists(target):
+            current = os.stat(target)
+            os.chown(temp_path, current.st_uid, current.st_gid)
+        os.replace(temp_path, target)
+    except Exception:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    return target
+
+def restore_entry(archive, entry, config):
+    if entry["kind"] == "file":
+        return restore_file(archive, entry)
+    restore_sql(archive, entry, config)
+    return entry["label"]
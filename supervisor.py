@@ -0,0 +1,513 @@
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import logging
+import argparse
+import traceback
+from datetime import datetime, timedelta
+import pytz
+
+# One long-running process hosting the MarzBackup services:
+# - bot:     main.py as a child process, restarted when it exits
+# - backup:  runs backup.sh for every tier on its interval, reading the config each tick
+# - usage:   the usage tracker, called in-process on each report interval boundary, or with
+#            usage_source "xray" the Xray stats poller (xray_stats.py)
+# Each service is restarted with exponential backoff when it fails or stops sending heartbeats.
+# `supervisor.py status|restart|stop` talk to the running supervisor over a unix socket.
+
+INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE_PATH = os.environ.get("MARZBACKUP_CONFIG", "/opt/marzbackup/config.json")
+SOCKET_PATH = "/var/run/marzbackup.sock"
+PID_FILE = "/var/run/marzbackup.pid"
+BACKUP_SCRIPT_PATH = os.path.join(INSTALL_DIR, "backup.sh")
+
+TICK_SECONDS = 30
+HEALTHY_AFTER_SECONDS = 120     # a service that ran this long starts its backoff from scratch
+STOP_TIMEOUT_SECONDS = 20       # grace period for child processes on shutdown
+
+tehran_tz = pytz.timezone('Asia/Tehran')
+
+def load_config():
+    try:
+        with open(CONFIG_FILE_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Error loading config file: {e}")
+        return {}
+
+def signal_process(process, sig, group):
+    # Processes started with start_new_session lead their own group; signal all of it so
+    # the children of a shell script (dump, compressor, uploads) stop with it
+    try:
+        if group:
+            os.killpg(process.pid, sig)
+        else:
+            process.send_signal(sig)
+    except ProcessLookupError:
+        pass
+
+async def stop_process(process, timeout=STOP_TIMEOUT_SECONDS, group=False):
+    if process.returncode is not None:
+        return
+    signal_process(process, signal.SIGTERM, group)
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        signal_process(process, signal.SIGKILL, group)
+        await process.wait()
+
+class Service:
+    def __init__(self, name, run, enabled=None, health_timeout=3 * TICK_SECONDS):
+        self.name = name
+        self.run = run
+        self.enabled = enabled or (lambda config: True)
+        self.health_timeout = health_timeout
+        self.task = None
+        self.state = "stopped"
+        self.started_at = None
+        self.last_beat = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+        self.restart_requested = False
+        self.details = {}
+
+    def beat(self, **details):
+        self.last_beat = time.monotonic()
+        self.details.update(details)
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            "state": self.state,
+            "uptime": round(now - self.started_at) if self.started_at and self.state == "running" else None,
+            "last_beat": round(now - self.last_beat) if self.last_beat else None,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            **self.details,
+        }
+
+class Supervisor:
+    def __init__(self, config):
+        self.services = {}
+        self.stopping = asyncio.Event()
+        self.started = time.time()
+        self.backoff_base = config.get("supervisor_backoff_base", 5)
+        self.backoff_max = config.get("supervisor_backoff_max", 300)
+
+    def add(self, service):
+        self.services[service.name] = service
+
+    async def _sleep(self, seconds):
+        # Sleep that ends early when the supervisor is stopping
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _keep_running(self, service):
+        while not self.stopping.is_set():
+            if not service.enabled(load_config()):
+                service.state = "disabled"
+                await self._sleep(TICK_SECONDS)
+                continue
+
+            service.state = "running"
+            service.started_at = time.monotonic()
+            service.details = {}
+            service.beat()
+            service.task = asyncio.create_task(service.run(service))
+            await asyncio.wait([service.task])
+            if self.stopping.is_set():
+                break
+
+            if service.task.cancelled():
+                error = "restart requested" if service.restart_requested else "health check failed"
+            elif service.task.exception() is not None:
+                exception = service.task.exception()
+                error = f"{type(exception).__name__}: {exception}"
+                logging.error(f"Service {service.name} failed:\n" + "".join(traceback.format_exception(exception)))
+            else:
+                error = "exited"
+            service.last_error = error
+            service.restarts += 1
+
+            if service.restart_requested:
+                service.restart_requested = False
+                continue
+            if time.monotonic() - service.started_at > HEALTHY_AFTER_SECONDS:
+                service.failures = 0
+            service.failures += 1
+            delay = min(self.backoff_base * 2 ** (service.failures - 1), self.backoff_max)
+            logging.warning(f"Service {service.name} stopped ({error}); restarting in {delay}s")
+            service.state = "backoff"
+            service.details = {"restart_in": delay}
+            await self._sleep(delay)
+        service.state = "stopped"
+
+    async def _check_health(self):
+        while not self.stopping.is_set():
+            await self._sleep(TICK_SECONDS)
+            now = time.monotonic()
+            for service in self.services.values():
+                if (service.state == "running" and service.task and not service.task.done()
+                        and service.health_timeout and now - service.last_beat > service.health_timeout):
+                    logging.warning(f"Service {service.name} sent no heartbeat for {now - service.last_beat:.0f}s; restarting it")
+                    service.task.cancel()
+
+    def restart(self, name):
+        names = list(self.services) if name == "all" else [name]
+        for service_name in names:
+            service = self.services.get(service_name)
+            if service is None:
+                raise KeyError(f"Unknown service: {service_name}")
+            if service.task and not service.task.done():
+                service.restart_requested = True
+                service.task.cancel()
+        return names
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started),
+            "services": {name: service.status() for name, service in self.services.items()},
+        }
+
+    async def _handle_client(self, reader, writer):
+        try:
+            command = (await reader.readline()).decode().split()
+            if not command or command[0] == "status":
+                response = self.status()
+            elif command[0] == "restart":
+                response = {"restarted": self.restart(command[1] if len(command) > 1 else "all")}
+            elif command[0] == "stop":
+                self.stopping.set()
+                response = {"stopping": True}
+            else:
+                response = {"error": f"Unknown command: {command[0]}"}
+        except KeyError as e:
+            response = {"error": str(e.args[0])}
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+        writer.close()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stopping.set)
+
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        server = await asyncio.start_unix_server(self._handle_client, path=SOCKET_PATH)
+        os.chmod(SOCKET_PATH, 0o600)
+
+        keepers = [asyncio.create_task(self._keep_running(service)) for service in self.services.values()]
+        health = asyncio.create_task(self._check_health())
+        logging.info(f"Supervisor started with services: {', '.join(self.services)}")
+        await self.stopping.wait()
+
+        # Graceful shutdown: every service gets to clean up (children get SIGTERM, then SIGKILL)
+        logging.info("Supervisor stopping")
+        for service in self.services.values():
+            if service.task and not service.task.done():
+                service.task.cancel()
+        await asyncio.gather(*keepers, health, return_exceptions=True)
+        server.close()
+        await server.wait_closed()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        logging.info("Supervisor stopped")
+
+# Services
+
+async def run_bot(service):
+    env = dict(os.environ, MARZBACKUP_SUPERVISED="1")
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(INSTALL_DIR, "main.py"), cwd=INSTALL_DIR, env=env)
+    service.beat(pid=process.pid)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(process.wait(), TICK_SECONDS)
+                raise Exception(f"bot exited with code {process.returncode}")
+            except asyncio.TimeoutError:
+                service.beat()
+    finally:
+        await stop_process(process)
+
+async def list_backup_tiers():
+    # backup.sh owns the tier policies; the critical tier follows backup_interval_minutes
+    process = await asyncio.create_subprocess_exec(
+        "/bin/bash", BACKUP_SCRIPT_PATH, "--list-tiers",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        env=dict(os.environ, MARZBACKUP_CONFIG=CONFIG_FILE_PATH)
+    )
+    stdout, _ = await process.communicate()
+    tiers = {}
+    for line in stdout.decode().splitlines():
+        name, _, interval = line.partition(' ')
+        if interval.strip().isdigit() and int(interval) > 0:
+            tiers[name] = int(interval)
+    return tiers
+
+def next_backup_time(minutes, now):
+    # Same times the cron schedule used: every N minutes or hours from midnight, multi-day tiers at 03:30
+    if minutes < 1440:
+        step = minutes if minutes < 60 else max(round(minutes / 60), 1) * 60
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        elapsed = int((now - midnight).total_seconds() // 60)
+        return midnight + timedelta(minutes=(elapsed // step + 1) * step)
+    days = max(round(minutes / 1440), 1)
+    candidate = now.replace(hour=3, minute=30, second=0, microsecond=0)
+    while candidate <= now or candidate.toordinal() % days:
+        candidate += timedelta(days=1)
+    return candidate
+
+async def run_backup(tier):
+    process = await asyncio.create_subprocess_exec(
+        "/bin/bash", BACKUP_SCRIPT_PATH, "--tier", tier,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    finally:
+        await stop_process(process, group=True)
+    if process.returncode == 0:
+        logging.info(stdout.decode().strip().splitlines()[-1] if stdout.strip() else f"{tier} backup finished")
+        return
+    error = stderr.decode().strip()[-1000:]
+    logging.error(f"{tier} backup failed: {error}")
+    try:
+        from outbox import send_message_sync
+        await asyncio.to_thread(send_message_sync, load_config(), f"خطا در پشتیبان‌گیری ({tier}):\n{error}")
+    except Exception as e:
+        logging.error(f"Error reporting backup failure: {e}")
+
+async def run_backup_scheduler(service):
+    next_runs = {}
+    running = {}
+    try:
+        while True:
+            tiers = await list_backup_tiers()
+            now = datetime.now()
+            for tier, minutes in tiers.items():
+                if tier not in next_runs or next_runs[tier][0] != minutes:
+                    next_runs[tier] = (minutes, next_backup_time(minutes, now))
+                if now >= next_runs[tier][1]:
+                    if tier in running and not running[tier].done():
+                        logging.warning(f"Skipping {tier} backup: the previous run is still in progress")
+                    else:
+                        running[tier] = asyncio.create_task(run_backup(tier))
+                    next_runs[tier] = (minutes, next_backup_time(minutes, now))
+            for tier in set(next_runs) - set(tiers):
+                del next_runs[tier]
+            service.beat(
+                next_runs={tier: when.strftime('%Y-%m-%d %H:%M') for tier, (_, when) in next_runs.items()},
+                running=[tier for tier, task in running.items() if not task.done()],
+            )
+            await asyncio.sleep(TICK_SECONDS)
+    finally:
+        for task in running.values():
+            task.cancel()
+        await asyncio.gather(*running.values(), return_exceptions=True)
+
+def next_report_time(interval, now):
+    # Report periods are aligned to Tehran midnight, like the usage report ranges
+    interval = max(min(int(interval), 1440), 1)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    elapsed = int((now - midnight).total_seconds() // 60)
+    return midnight + timedelta(minutes=(elapsed // interval + 1) * interval)
+
+async def run_usage_tracker(service):
+    # Imported here so a broken database config only fails this service
+    import hourlyReport
+    while True:
+        hourlyReport.refresh_config()
+        due = next_report_time(hourlyReport.REPORT_INTERVAL, datetime.now(tehran_tz))
+        service.beat(next_run=due.strftime('%Y-%m-%d %H:%M'))
+        while (remaining := (due - datetime.now(tehran_tz)).total_seconds()) > 0:
+            await asyncio.sleep(min(remaining, TICK_SECONDS))
+            service.beat()
+        await asyncio.to_thread(hourlyReport.run_tasks, True)
+        service.beat(last_run=due.strftime('%Y-%m-%d %H:%M'))
+
+async def run_xray_usage(service):
+    import hourlyReport
+    from xray_stats import (DEFAULT_SETTINGS, CompetingReaderError, XrayStatsClient, XrayUsageCollector,
+                            build_period_sql, period_rows, log_poll_error)
+
+    hourlyReport.refresh_config()
+    if not await asyncio.to_thread(hourlyReport.update_database_structure):
+        raise Exception("Could not update the UserUsageAnalytics structure")
+    config = load_config()
+    settings = {key: config.get(key, default) for key, default in DEFAULT_SETTINGS.items()}
+    client = XrayStatsClient(settings["xray_api_address"])
+    collector = XrayUsageCollector(client, reset=settings["xray_stats_reset"])
+    failures = 0
+    refused = False
+
+    async def flush(timestamp):
+        period = collector.take_period()
+        if not period:
+            return
+        output = await asyncio.to_thread(hourlyReport.execute_sql_script, build_period_sql(period, timestamp))
+        if output is None:
+            raise Exception(f"Could not write usage period {timestamp}")
+        rows = hourlyReport.parse_table(output)
+        report_number = rows[-1]["report_number"] if rows else "0"
+        logging.info(f"Wrote Xray usage of {len(period)} users for report {report_number}")
+        if hourlyReport.config.get('anomaly_detection', True):
+            await asyncio.to_thread(hourlyReport.detect_anomalies_in_rows, period_rows(period, report_number, timestamp))
+
+    try:
+        due = next_report_time(hourlyReport.REPORT_INTERVAL, datetime.now(tehran_tz))
+        while True:
+            try:
+                await collector.poll()
+                failures = 0
+            except CompetingReaderError as e:
+                # The counted usage is wrong; write nothing and wait until the config is changed
+                collector.discard_period()
+                refused = True
+                await refuse_xray_usage(service, str(e), settings)
+                return
+            except Exception as e:
+                failures += 1
+                log_poll_error(e, failures)
+            service.beat(next_run=due.strftime('%Y-%m-%d %H:%M'), users_in_period=len(collector.period),
+                         poll_failures=failures)
+
+            now = datetime.now(tehran_tz)
+            if now >= due:
+                await flush(due.strftime('%Y-%m-%d %H:%M:%S'))
+                if await asyncio.to_thread(hourlyReport.should_run_cleanup):
+                    await asyncio.to_thread(hourlyReport.cleanup_old_data)
+                hourlyReport.refresh_config()
+                due = next_report_time(hourlyReport.REPORT_INTERVAL, now)
+            await asyncio.sleep(min(settings["xray_poll_seconds"], max((due - now).total_seconds(), 0.1)))
+    finally:
+        # Keep what was counted so far on shutdown or restart
+        if not refused:
+            try:
+                await flush(datetime.now(tehran_tz).strftime('%Y-%m-%d %H:%M:%S'))
+            except Exception as e:
+                logging.error(f"Error writing the last Xray usage period: {e}")
+        await client.close()
+
+async def refuse_xray_usage(service, reason, settings):
+    logging.error(f"Xray usage source stopped: {reason}")
+    from outbox import send_message_sync
+    await asyncio.to_thread(send_message_sync, load_config(),
+                            f"ردیابی مصرف از Xray متوقف شد و داده‌ای ثبت نمی‌شود:\n{reason}\n"
+                            "usage_source را تغییر دهید یا گزارش‌گیر مصرف مرزبان را غیرفعال کنید.")
+    while True:
+        service.beat(refused=reason)
+        await asyncio.sleep(TICK_SECONDS)
+        config = load_config()
+        if (config.get("usage_source") != "xray"
+                or config.get("xray_stats_reset", False) != settings["xray_stats_reset"]):
+            return
+
+async def run_usage(service):
+    if load_config().get("usage_source") == "xray":
+        await run_xray_usage(service)
+    else:
+        await run_usage_tracker(service)
+
+def usage_tracking_enabled(config):
+    return bool(config.get("user_usage_installed")) and not config.get("user_usage_stopped", False)
+
+def build_supervisor(config):
+    supervisor = Supervisor(config)
+    supervisor.add(Service("bot", run_bot))
+    supervisor.add(Service("backup", run_backup_scheduler))
+    # A tracker run blocks its heartbeat while the database procedures run
+    supervisor.add(Service("usage", run_usage, enabled=usage_tracking_enabled, health_timeout=1800))
+    return supervisor
+
+# Command line client
+
+def send_command(command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(10)
+        client.connect(SOCKET_PATH)
+        client.sendall(command.encode() + b"\n")
+        response = b""
+        while chunk := client.recv(65536):
+            response += chunk
+    return json.loads(response)
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m {seconds % 60}s"
+
+def print_status(status):
+    print(f"MarzBackup supervisor is running. PID: {status['pid']}, uptime: {format_duration(status['uptime'])}")
+    for name, service in status["services"].items():
+        line = f"  {name:<7} {service['state']:<9} uptime {format_duration(service['uptime'])}, restarts {service['restarts']}"
+        if service.get("pid"):
+            line += f", pid {service['pid']}"
+        print(line)
+        for key in ("next_run", "last_run", "next_runs", "running", "restart_in"):
+            if service.get(key):
+                print(f"          {key}: {service[key]}")
+        if service.get("last_error"):
+            print(f"          last error: {service['last_error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="MarzBackup service supervisor")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("run")
+    status_parser = subparsers.add_parser("status")
+    status_parser.add_argument("service", nargs="?")
+    restart_parser = subparsers.add_parser("restart")
+    restart_parser.add_argument("service", nargs="?", default="all")
+    subparsers.add_parser("stop")
+    args = parser.parse_args()
+
+    if args.command != "run":
+        try:
+            command = f"restart {args.service}" if args.command == "restart" else args.command
+            response = send_command(command)
+        except (OSError, ValueError):
+            print("MarzBackup supervisor is not running.")
+            sys.exit(1)
+        if "error" in response:
+            print(response["error"])
+            sys.exit(1)
+        if args.command == "status" and args.service:
+            # `status <service>` exits 0 only while that service is running
+            service = response["services"].get(args.service)
+            if service is None:
+                print(f"Unknown service: {args.service}")
+                sys.exit(1)
+            print(f"{args.service}: {service['state']}")
+            sys.exit(0 if service["state"] == "running" else 1)
+        elif args.command == "status":
+            print_status(response)
+        else:
+            print(json.dumps(response))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        send_command("status")
+        print("MarzBackup supervisor is already running.")
+        sys.exit(1)
+    except (OSError, ValueError):
+        pass
+    with open(PID_FILE, 'w') as file:
+        file.write(str(os.getpid()))
+    try:
+        asyncio.run(build_supervisor(load_config()).run())
+    finally:
+        if os.path.exists(PID_FILE):
+            os.remove(PID_FILE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import io
+import os
+import sys
+import time
+import types
+import shutil
+import socket
+import subprocess
+import pytest
+
+pytest.importorskip("aiogram")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import destinations
+from destinations import CHUNK_SIZE, Destination, FanOut, LocalSink
+
+ARCHIVE = os.urandom(3 * CHUNK_SIZE + 12345)
+
+class SlowSink(LocalSink):
+    # A destination that takes a while for every chunk, like a slow uplink
+    def write(self, data):
+        time.sleep(0.05)
+        super().write(data)
+
+class FlakySink(LocalSink):
+    # Fails `failures` times in the middle of the upload, then works
+    failures = 1
+
+    def write(self, data):
+        if FlakySink.failures > 0:
+            FlakySink.failures -= 1
+            raise ConnectionError("connection reset")
+        super().write(data)
+
+class BrokenSink(LocalSink):
+    def begin(self, filename):
+        raise ConnectionError("unreachable")
+
+class FileSink:
+    # Stands in for Telegram, which is sent from the finished archive
+    from_file = True
+    sent = []
+
+    def __init__(self, name, settings, config):
+        pass
+
+    def send(self, path, caption, rate_limit_kb):
+        with open(path, 'rb') as file:
+            FileSink.sent.append((file.read(), caption))
+
+@pytest.fixture(autouse=True)
+def fake_sinks(monkeypatch):
+    for name, sink in (("slow", SlowSink), ("flaky", FlakySink), ("broken", BrokenSink), ("file", FileSink)):
+        monkeypatch.setitem(destinations.SINK_TYPES, name, sink)
+    # No backoff between retries
+    monkeypatch.setattr(destinations, "time", types.SimpleNamespace(monotonic=time.monotonic, sleep=lambda seconds: None))
+    FlakySink.failures = 1
+    FileSink.sent = []
+
+def run_fanout(tmp_path, settings, status="0"):
+    config = {"backup_destinations": {name: dict(value, path=str(tmp_path / name)) for name, value in settings.items()}}
+    status_file = tmp_path / "status"
+    status_file.write_text(status + "\n")
+    fanout = FanOut(str(tmp_path / "backup.tar.gz"), [Destination(name, config) for name in settings], caption="backup")
+    ok = fanout.run(io.BytesIO(ARCHIVE), str(status_file))
+    return ok, {destination.name: destination for destination in fanout.destinations}
+
+def uploaded(tmp_path, name):
+    directory = tmp_path / name
+    return {path.name: path.read_bytes() for path in directory.iterdir()} if directory.exists() else {}
+
+def test_slow_destination_detaches_to_the_spool_and_catches_up(tmp_path):
+    ok, results = run_fanout(tmp_path, {
+        "fast": {"type": "local"},
+        "slow": {"type": "slow", "buffer_mb": 1},
+        "file": {"type": "file"},
+    })
+    assert ok
+    assert (tmp_path / "backup.tar.gz").read_bytes() == ARCHIVE
+    assert uploaded(tmp_path, "fast") == {"backup.tar.gz": ARCHIVE}
+    assert uploaded(tmp_path, "slow") == {"backup.tar.gz": ARCHIVE}
+    assert FileSink.sent == [(ARCHIVE, "backup")]
+    assert not results["fast"].feed.detached
+    assert results["slow"].feed.detached
+    assert "caught up from disk" in results["slow"].report()
+
+def test_failed_upload_is_retried_from_the_spool(tmp_path):
+    ok, results = run_fanout(tmp_path, {"flaky": {"type": "flaky"}, "fast": {"type": "local"}})
+    assert ok
+    assert results["flaky"].attempts == 2
+    assert "2 attempts" in results["flaky"].report()
+    # The failed attempt left no partial file behind
+    assert uploaded(tmp_path, "flaky") == {"backup.tar.gz": ARCHIVE}
+    assert uploaded(tmp_path, "fast") == {"backup.tar.gz": ARCHIVE}
+
+def test_destination_failing_every_attempt_does_not_stop_the_others(tmp_path):
+    ok, results = run_fanout(tmp_path, {"broken": {"type": "broken", "retries": 3}, "fast": {"type": "local"}})
+    assert not ok
+    assert results["broken"].status == "failed"
+    assert results["broken"].attempts == 3
+    assert "failed after 3 attempts" in results["broken"].report()
+    assert uploaded(tmp_path, "fast") == {"backup.tar.gz": ARCHIVE}
+
+def test_incomplete_archive_is_not_sent_anywhere(tmp_path):
+    ok, results = run_fanout(tmp_path, {
+        "fast": {"type": "local"},
+        "slow": {"type": "slow", "buffer_mb": 1},
+        "file": {"type": "file"},
+    }, status="1")
+    assert not ok
+    assert all(destination.status == "aborted" for destination in results.values())
+    assert "the archive was incomplete" in results["fast"].report()
+    assert uploaded(tmp_path, "fast") == {}
+    assert uploaded(tmp_path, "slow") == {}
+    assert FileSink.sent == []
+
+def test_unknown_destination_is_reported_not_raised(tmp_path):
+    destination = Destination("missing", {"backup_destinations": {}})
+    assert destination.status == "failed"
+    assert "not set up" in destination.report()
+
+# The S3 and SFTP sinks run against MinIO and an SFTP server in throwaway containers
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_container(image, port, *args, env=()):
+    if shutil.which("docker") is None:
+        pytest.skip("docker is not available")
+    host_port = free_port()
+    command = ["docker", "run", "-d", "--rm", "-p", f"127.0.0.1:{host_port}:{port}"]
+    for item in env:
+        command += ["-e", item]
+    result = subprocess.run(command + [image, *args], capture_output=True, text=True)
+    if result.returncode != 0:
+        pytest.skip(f"could not start {image}: {result.stderr.strip()}")
+    return result.stdout.strip(), host_port
+
+def wait_until(check, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return check()
+        except Exception:
+            time.sleep(1)
+    pytest.skip("container did not become ready")
+
+@pytest.fixture
+def minio():
+    boto3 = pytest.importorskip("boto3")
+    container, port = start_container("minio/minio", 9000, "server", "/data",
+                                      env=("MINIO_ROOT_USER=marzbackup", "MINIO_ROOT_PASSWORD=marzbackup-secret"))
+    settings = {"type": "s3", "bucket": "backups", "prefix": "marzban/", "endpoint_url": f"http://127.0.0.1:{port}",
+                "access_key": "marzbackup", "secret_key": "marzbackup-secret", "region": "us-east-1", "part_size_mb": 5}
+    client = boto3.client("s3", endpoint_url=settings["endpoint_url"], region_name=settings["region"],
+                          aws_access_key_id=settings["access_key"], aws_secret_access_key=settings["secret_key"])
+    try:
+        wait_until(lambda: client.create_bucket(Bucket="backups"))
+        yield client, settings
+    finally:
+        subprocess.run(["docker", "rm", "-f", container], capture_output=True)
+
+@pytest.fixture
+def sftp_server():
+    paramiko = pytest.importorskip("paramiko")
+    container, port = start_container("atmoz/sftp", 22, "marzbackup:marzbackup-secret:::upload")
+    settings = {"type": "sftp", "host": "127.0.0.1", "port": port, "username": "marzbackup",
+                "password": "marzbackup-secret", "path": "upload", "host_key_policy": "auto_add"}
+
+    def connect():
+        transport = paramiko.Transport(("127.0.0.1", port))
+        transport.connect(username=settings["username"], password=settings["password"])
+        return transport, paramiko.SFTPClient.from_transport(transport)
+
+    try:
+        transport, client = wait_until(connect)
+        yield client, settings
+        transport.close()
+    finally:
+        subprocess.run(["docker", "rm", "-f", container], capture_output=True)
+
+def run_remote(tmp_path, settings, status="0"):
+    config = {"backup_destinations": {"remote": settings}}
+    status_file = tmp_path / "status"
+    status_file.write_text(status + "\n")
+    archive = os.urandom(11 * CHUNK_SIZE)
+    fanout = FanOut(str(tmp_path / "backup.tar.gz"), [Destination("remote", config)])
+    ok = fanout.run(io.BytesIO(archive), str(status_file))
+    return ok, fanout.destinations[0], archive
+
+def test_s3_multipart_upload(tmp_path, minio):
+    client, settings = minio
+    ok, destination, archive = run_remote(tmp_path, settings)
+    assert ok, destination.report()
+    assert client.get_object(Bucket="backups", Key="marzban/backup.tar.gz")["Body"].read() == archive
+
+def test_s3_incomplete_archive_aborts_the_upload(tmp_path, minio):
+    client, settings = minio
+    ok, destination, _ = run_remote(tmp_path, settings, status="1")
+    assert not ok and destination.status == "aborted"
+    assert client.list_objects_v2(Bucket="backups").get("KeyCount", 0) == 0
+    assert not client.list_multipart_uploads(Bucket="backups").get("Uploads")
+
+def test_sftp_upload(tmp_path, sftp_server):
+    client, settings = sftp_server
+    ok, destination, archive = run_remote(tmp_path, settings)
+    assert ok, destination.report()
+    assert client.listdir("upload") == ["backup.tar.gz"]
+    with client.open("upload/backup.tar.gz", 'rb') as file:
+        assert file.read() == archive
+
+def test_sftp_incomplete_archive_leaves_nothing(tmp_path, sftp_server):
+    client, settings = sftp_server
+    ok, destination, _ = run_remote(tmp_path, settings, status="1")
+    assert not ok and destination.status == "aborted"
+    assert client.listdir("upload") == []
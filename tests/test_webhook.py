@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import types
+import signal
+import socket
+import asyncio
+import pytest
+
+pytest.importorskip("aiogram")
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config.py asks for missing settings on import; webhook.py only needs its two helpers
+sys.modules.setdefault("config", types.SimpleNamespace(load_config=lambda: {}, save_config=lambda config: None))
+from webhook import run_webhook
+
+TOKEN = "42:TEST"
+SECRET = "test-secret"
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def start_bot_api(set_webhook_ok=True):
+    # Local stand-in for the Bot API that records the methods called
+    calls = []
+
+    async def handle(request):
+        method = request.match_info["method"]
+        calls.append(method)
+        if method == "setWebhook" and not set_webhook_ok:
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: bad webhook"}, status=400)
+        return web.json_response({"ok": True, "result": True})
+
+    app = web.Application()
+    app.router.add_post(f"/bot{TOKEN}/{{method}}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}", calls
+
+def make_bot(base):
+    return Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base)))
+
+def update(update_id):
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "text": "hi",
+                                                "chat": {"id": 1, "type": "private"}}}
+
+async def wait_for_port(port):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise TimeoutError(f"webhook server did not start on port {port}")
+
+def test_webhook_limits_concurrent_handling_and_stops_on_sigterm():
+    async def scenario():
+        api_runner, base, calls = await start_bot_api()
+        dp = Dispatcher()
+        active = 0
+        peak = 0
+        handled = []
+        shutdowns = []
+
+        @dp.message()
+        async def slow_handler(message):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.3)
+            active -= 1
+            handled.append(message.message_id)
+
+        @dp.shutdown()
+        async def on_shutdown():
+            shutdowns.append(True)
+
+        port = free_port()
+        config = {"webhook_url": "https://example.invalid", "webhook_host": "127.0.0.1", "webhook_port": port,
+                  "webhook_secret": SECRET, "webhook_max_concurrency": 2}
+        task = asyncio.create_task(run_webhook(dp, make_bot(base), config))
+        await wait_for_port(port)
+
+        async with ClientSession() as session:
+            async def post(update_id):
+                started = time.monotonic()
+                async with session.post(f"http://127.0.0.1:{port}/marzbackup/webhook", json=update(update_id),
+                                        headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                    return response.status, time.monotonic() - started
+
+            results = await asyncio.gather(*(post(i) for i in range(1, 7)))
+            async with session.post(f"http://127.0.0.1:{port}/marzbackup/webhook", json=update(99),
+                                    headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                rejected = response.status
+
+        # Updates are acknowledged right away while handling stays within the limit
+        assert all(status == 200 and seconds < 0.25 for status, seconds in results)
+        assert rejected == 401
+        for _ in range(40):
+            if len(handled) == 6:
+                break
+            await asyncio.sleep(0.1)
+        assert sorted(handled) == [1, 2, 3, 4, 5, 6]
+        assert peak == 2
+
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert await asyncio.wait_for(task, 5) is True
+        assert shutdowns == [True]
+        assert "setWebhook" in calls
+        await api_runner.cleanup()
+
+    asyncio.run(scenario())
+
+def test_webhook_reports_failure_when_telegram_refuses_it():
+    async def scenario():
+        api_runner, base, calls = await start_bot_api(set_webhook_ok=False)
+        port = free_port()
+        config = {"webhook_url": "https://example.invalid", "webhook_host": "127.0.0.1", "webhook_port": port,
+                  "webhook_secret": SECRET}
+        assert await run_webhook(Dispatcher(), make_bot(base), config) is False
+        # Nothing is left listening, so polling can take over
+        with pytest.raises(OSError):
+            await asyncio.open_connection("127.0.0.1", port)
+        await api_runner.cleanup()
+
+    asyncio.run(scenario())
@@ -0,0 +1,129 @@
+import os
+import sys
+import asyncio
+import pytest
+
+grpc = pytest.importorskip("grpc")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import xray_stats
+from xray_stats import (COMPETING_WINDOW, CompetingReaderError, XrayStatsClient, XrayUsageCollector,
+                        build_period_sql, encode_varint, iter_fields, period_rows)
+
+class FakeStatsServer:
+    # Answers QueryStats from `counters` and resets them like Xray when asked to
+    def __init__(self):
+        self.counters = {}
+        self.requests = []
+
+    def query_stats(self, request, context):
+        pattern, reset = "", False
+        for field, _, value in iter_fields(request):
+            if field == 1:
+                pattern = value.decode()
+            elif field == 2:
+                reset = bool(value)
+        self.requests.append((pattern, reset))
+        response = b""
+        for name, value in self.counters.items():
+            if pattern not in name:
+                continue
+            encoded = name.encode()
+            stat = b"\x0a" + encode_varint(len(encoded)) + encoded + b"\x10" + encode_varint(value)
+            response += b"\x0a" + encode_varint(len(stat)) + stat
+            if reset:
+                self.counters[name] = 0
+        return response
+
+    async def __aenter__(self):
+        self.server = grpc.aio.server()
+        handler = grpc.method_handlers_generic_handler("xray.app.stats.command.StatsService", {
+            "QueryStats": grpc.unary_unary_rpc_method_handler(self.query_stats),
+        })
+        self.server.add_generic_rpc_handlers((handler,))
+        port = self.server.add_insecure_port("127.0.0.1:0")
+        await self.server.start()
+        self.client = XrayStatsClient(f"127.0.0.1:{port}")
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.close()
+        await self.server.stop(None)
+
+    def add(self, user, direction, amount):
+        name = f"user>>>{user}>>>traffic>>>{direction}"
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+def test_deltas_zero_rows_and_period_sql():
+    async def scenario():
+        async with FakeStatsServer() as xray:
+            xray.add("1.alice", "uplink", 100)
+            xray.add("1.alice", "downlink", 1000)
+            xray.add("2.bob", "downlink", 5)
+            xray.counters["inbound>>>api>>>traffic>>>uplink"] = 7
+            collector = XrayUsageCollector(xray.client)
+
+            await collector.poll()  # baseline only
+            xray.add("1.alice", "uplink", 50)
+            xray.add("3.o'neil", "downlink", 7)
+            await collector.poll()
+            period = collector.take_period()
+            # bob had no traffic but still gets a row, so his statistics decay
+            assert period == {1: ["alice", 50, 0], 2: ["bob", 0, 0], 3: ["o'neil", 0, 7]}
+            assert xray.requests[-1] == ("user>>>", False)
+
+            await collector.poll()
+            assert collector.take_period() == {1: ["alice", 0, 0], 2: ["bob", 0, 0], 3: ["o'neil", 0, 0]}
+
+        sql = build_period_sql(period, "2026-10-19 10:00:00")
+        assert sql.startswith("START TRANSACTION;")
+        assert "(3,'o\\'neil',7,'2026-10-19 10:00:00',@report)" in sql
+        assert "(2,@report,0,0,'2026-10-19 10:00:00')" in sql
+        rows = period_rows(period, 5, "2026-10-19 10:00:00")
+        assert [row["usage_in_period"] for row in rows] == ["50", "0", "7"]
+
+    asyncio.run(scenario())
+
+def test_a_single_drop_counts_as_a_restart():
+    async def scenario():
+        async with FakeStatsServer() as xray:
+            xray.add("1.alice", "uplink", 100)
+            collector = XrayUsageCollector(xray.client)
+            await collector.poll()
+            xray.counters["user>>>1.alice>>>traffic>>>uplink"] = 30  # Xray restarted
+            await collector.poll()
+            assert collector.take_period() == {1: ["alice", 30, 0]}
+
+    asyncio.run(scenario())
+
+def test_competing_reader_is_refused():
+    async def scenario():
+        async with FakeStatsServer() as xray:
+            collector = XrayUsageCollector(xray.client)
+            xray.add("1.alice", "uplink", 100)
+            await collector.poll()
+            with pytest.raises(CompetingReaderError):
+                for index in range(COMPETING_WINDOW):
+                    # Another reader resets the counter between our polls
+                    xray.counters["user>>>1.alice>>>traffic>>>uplink"] = 0
+                    xray.add("1.alice", "uplink", 10 if index % 2 == 0 else 100)
+                    await collector.poll()
+
+    asyncio.run(scenario())
+
+def test_reset_mode_starts_after_a_clean_probe():
+    async def scenario():
+        async with FakeStatsServer() as xray:
+            collector = XrayUsageCollector(xray.client, reset=True)
+            xray.add("1.alice", "downlink", 100)
+            total = 0
+            for _ in range(COMPETING_WINDOW + 3):
+                xray.add("1.alice", "downlink", 10)
+                await collector.poll()
+                total += collector.take_period()[1][2]
+            assert [reset for _, reset in xray.requests] == [False] * COMPETING_WINDOW + [True] * 3
+            # Nothing is lost when switching from reading as-is to query-and-reset
+            assert total == 10 * (COMPETING_WINDOW + 3) - 10
+            assert xray.counters["user>>>1.alice>>>traffic>>>downlink"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+import ssl
+import signal
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import FSInputFile
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from config import load_config, save_config
+
+DEFAULT_WEBHOOK_PATH = "/marzbackup/webhook"
+
+def get_webhook_secret(config):
+    # Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; generate and keep one if none is set
+    secret = config.get("webhook_secret")
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        saved = load_config()
+        saved["webhook_secret"] = secret
+        save_config(saved)
+    return secret
+
+def build_ssl_context(config):
+    cert = config.get("webhook_ssl_cert")
+    key = config.get("webhook_ssl_key")
+    if not cert or not key:
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    # Bound the number of updates handled at once. SimpleRequestHandler answers Telegram right
+    # away and handles the update in a background task, so the limit has to sit around the
+    # dispatcher's update processing rather than the HTTP request; extra updates wait for a slot.
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self.semaphore:
+            return await handler(event, data)
+
+async def run_webhook(dp: Dispatcher, bot: Bot, config):
+    # Serve updates over a webhook. Returns False, with nothing left running, when the server
+    # cannot start or Telegram refuses the webhook so the caller can fall back to polling.
+    webhook_url = config.get("webhook_url")
+    if not webhook_url:
+        logging.error("webhook_url is not set in config")
+        return False
+
+    path = config.get("webhook_path", DEFAULT_WEBHOOK_PATH)
+    host = config.get("webhook_host", "0.0.0.0")
+    port = int(config.get("webhook_port", 8443))
+    max_concurrency = int(config.get("webhook_max_concurrency", 20))
+    secret = get_webhook_secret(config)
+
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(max_concurrency))
+    app = web.Application()
+    # Handled in the background so long handlers (backups, profiling) never hit Telegram's timeout
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True).register(app, path=path)
+
+    runner = web.AppRunner(app)
+    try:
+        ssl_context = build_ssl_context(config)
+        await runner.setup()
+        await web.TCPSite(runner, host, port, ssl_context=ssl_context).start()
+
+        certificate = None
+        if ssl_context and config.get("webhook_self_signed", False):
+            certificate = FSInputFile(config["webhook_ssl_cert"])
+        await bot.set_webhook(
+            url=webhook_url.rstrip("/") + path,
+            certificate=certificate,
+            secret_token=secret,
+            max_connections=max_concurrency,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    except Exception as e:
+        logging.error(f"Could not start webhook mode: {e}")
+        await runner.cleanup()
+        return False
+
+    logging.info(f"Receiving updates via webhook on {host}:{port}{path}")
+    workflow_data = {"dispatcher": dp, "bot": bot, **dp.workflow_data}
+    # Stop on SIGTERM (the supervisor) or SIGINT like start_polling does, so shutdown hooks run
+    # and the outbox is flushed
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    await dp.emit_startup(**workflow_data)
+    try:
+        await stopping.wait()
+        logging.info("Stopping webhook mode")
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+        await dp.emit_shutdown(**workflow_data)
+        await runner.cleanup()
+        await bot.session.close()
+    return True
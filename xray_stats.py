@@ -0,0 +1,240 @@
+import logging
+from collections import deque
+
+# Usage ingestion from the Xray stats API (StatsService.QueryStats over gRPC).
+# Xray keeps per-user counters named "user>>>{email}>>>traffic>>>{uplink|downlink}", and Marzban
+# sets the email of every client to "{user_id}.{username}". Counters are polled every
+# xray_poll_seconds, summed in memory and written to UserUsageAnalytics once per report period.
+#
+# Counters only add up correctly when MarzBackup is their only reader that resets them. Marzban's
+# own usage recorder queries them with reset every few seconds, so on a stock Marzban node this
+# source cannot be used: bytes reset by the other reader between two polls are lost. Counters that
+# keep dropping between polls give the competing reader away, and the collector then refuses to
+# produce data instead of under-counting.
+#
+# The request and response messages are tiny, so they are encoded by hand instead of shipping
+# generated protobuf modules.
+
+QUERY_STATS_METHOD = "/xray.app.stats.command.StatsService/QueryStats"
+USER_STATS_PATTERN = "user>>>"
+INSERT_BATCH_SIZE = 1000
+# A drop now and then is an Xray restart; drops in this many of the last COMPETING_WINDOW polls
+# mean another reader is resetting the counters
+COMPETING_DROPS = 3
+COMPETING_WINDOW = 10
+
+DEFAULT_SETTINGS = {
+    "xray_api_address": "127.0.0.1:62789",
+    "xray_poll_seconds": 10,
+    # Query-and-reset keeps Xray's counters small. Reset mode starts after COMPETING_WINDOW polls
+    # read as-is have shown no competing reader; once MarzBackup resets the counters itself, another
+    # resetting reader can no longer be detected, so only enable it where MarzBackup is the only one.
+    "xray_stats_reset": False,
+}
+
+# Protobuf wire format
+
+def encode_varint(value):
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+def decode_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+def iter_fields(data):
+    # Yield (field number, wire type, value) for every field of a message
+    position = 0
+    while position < len(data):
+        key, position = decode_varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = decode_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position:position + 8], position + 8
+        elif wire_type == 2:
+            length, position = decode_varint(data, position)
+            value, position = data[position:position + length], position + length
+        elif wire_type == 5:
+            value, position = data[position:position + 4], position + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+        yield field, wire_type, value
+
+def encode_query_stats_request(request):
+    # QueryStatsRequest { string pattern = 1; bool reset = 2; }
+    pattern, reset = request
+    encoded = pattern.encode()
+    message = b"\x0a" + encode_varint(len(encoded)) + encoded
+    if reset:
+        message += b"\x10\x01"
+    return message
+
+def decode_query_stats_response(data):
+    # QueryStatsResponse { repeated Stat stat = 1; }  Stat { string name = 1; int64 value = 2; }
+    stats = []
+    for field, wire_type, value in iter_fields(data):
+        if field != 1 or wire_type != 2:
+            continue
+        name, counter = "", 0
+        for stat_field, stat_wire_type, stat_value in iter_fields(value):
+            if stat_field == 1 and stat_wire_type == 2:
+                name = stat_value.decode()
+            elif stat_field == 2 and stat_wire_type == 0:
+                counter = stat_value - (1 << 64) if stat_value >= 1 << 63 else stat_value
+        stats.append((name, counter))
+    return stats
+
+class XrayStatsClient:
+    def __init__(self, address, timeout=10):
+        # grpcio is only needed when usage_source is "xray"
+        import grpc
+        self.channel = grpc.aio.insecure_channel(address)
+        self.timeout = timeout
+        self.query_stats = self.channel.unary_unary(
+            QUERY_STATS_METHOD,
+            request_serializer=encode_query_stats_request,
+            response_deserializer=decode_query_stats_response,
+        )
+
+    async def query(self, pattern, reset):
+        return await self.query_stats((pattern, reset), timeout=self.timeout)
+
+    async def close(self):
+        await self.channel.close()
+
+def parse_user_stat(name):
+    # "user>>>12.alice>>>traffic>>>uplink" -> (12, "alice", "uplink")
+    parts = name.split(">>>")
+    if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic" or parts[3] not in ("uplink", "downlink"):
+        return None
+    user_id, _, username = parts[1].partition(".")
+    if not user_id.isdigit() or not username:
+        return None
+    return int(user_id), username, parts[3]
+
+class CompetingReaderError(Exception):
+    pass
+
+class XrayUsageCollector:
+    def __init__(self, client, reset=False):
+        self.client = client
+        self.reset = reset
+        # Counter values after the last poll (0 after a reset), for the deltas
+        self.last_values = {}
+        self.primed = False
+        self.polls = 0
+        self.recent_drops = deque(maxlen=COMPETING_WINDOW)
+        # Every user seen in the counters, so idle users get an explicit zero row
+        self.known_users = {}
+        # {user_id: [username, uplink, downlink]} for the current period
+        self.period = {}
+
+    def resetting(self):
+        return self.reset and self.polls >= COMPETING_WINDOW
+
+    async def poll(self):
+        reset = self.resetting()
+        stats = await self.client.query(USER_STATS_PATTERN, reset)
+        seen = set()
+        dropped = False
+        for name, value in stats:
+            parsed = parse_user_stat(name)
+            if parsed is None:
+                continue
+            seen.add(name)
+            user_id, username, direction = parsed
+            previous = self.last_values.get(name)
+            if previous is None:
+                # The first poll only sets the baseline; counters that appear later start from zero
+                delta = value if self.primed else 0
+            elif value < previous:
+                # Either Xray restarted or someone else reset the counter since the last poll
+                dropped = True
+                delta = value
+            else:
+                delta = value - previous
+            self.last_values[name] = 0 if reset else value
+            self.known_users[user_id] = username
+            usage = self.period.setdefault(user_id, [username, 0, 0])
+            usage[0] = username
+            usage[1 if direction == "uplink" else 2] += delta
+        # Counters of removed users disappear; if they come back they start from zero
+        for name in set(self.last_values) - seen:
+            del self.last_values[name]
+
+        self.recent_drops.append(dropped)
+        if sum(self.recent_drops) >= COMPETING_DROPS:
+            raise CompetingReaderError(
+                f"Xray counters dropped in {sum(self.recent_drops)} of the last {len(self.recent_drops)} polls; "
+                "another reader (Marzban's usage recorder) is resetting them")
+        self.primed = True
+        self.polls += 1
+        return len(stats)
+
+    def take_period(self):
+        # Users without traffic get a zero row, so their usage statistics keep up with the periods
+        period, self.period = self.period, {}
+        for user_id, username in self.known_users.items():
+            period.setdefault(user_id, [username, 0, 0])
+        return period
+
+    def discard_period(self):
+        self.period = {}
+
+def sql_string(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def build_period_sql(period, timestamp):
+    # One transaction per period: all users' rows in PeriodicUsage and the uplink/downlink split
+    # in PeriodicTraffic, inserted in batches, under the next report number
+    rows = sorted(period.items())
+    ts = sql_string(timestamp)
+    statements = [
+        "START TRANSACTION;",
+        "SELECT COALESCE(MAX(report_number), 0) + 1 INTO @report FROM PeriodicUsage FOR UPDATE;",
+    ]
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        statements.append(
+            "INSERT INTO PeriodicUsage (user_id, username, usage_in_period, timestamp, report_number) VALUES "
+            + ",".join(f"({user_id},{sql_string(username)},{uplink + downlink},{ts},@report)"
+                       for user_id, (username, uplink, downlink) in batch)
+            + ";"
+        )
+        statements.append(
+            "INSERT INTO PeriodicTraffic (user_id, report_number, uplink, downlink, timestamp) VALUES "
+            + ",".join(f"({user_id},@report,{uplink},{downlink},{ts})"
+                       for user_id, (username, uplink, downlink) in batch)
+            + ";"
+        )
+    statements.append("COMMIT;")
+    statements.append("SELECT @report AS report_number;")
+    return "\n".join(statements) + "\n"
+
+def period_rows(period, report_number, timestamp):
+    # The same shape as calculate_usage() rows, for the anomaly detector
+    return [
+        {"user_id": str(user_id), "username": username, "usage_in_period": str(uplink + downlink),
+         "timestamp": timestamp, "report_number": str(report_number)}
+        for user_id, (username, uplink, downlink) in sorted(period.items())
+    ]
+
+def log_poll_error(error, failures):
+    # Log the first failure and then every 30th, so an unreachable API does not flood the log
+    if failures == 1 or failures % 30 == 0:
+        logging.warning(f"Xray stats query failed ({failures} in a row): {error}")